@@ -0,0 +1,11 @@
+import os
+import sys
+import types
+
+# the repository is imported as the drone_data package, whatever its folder name
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'drone_data' not in sys.modules:
+    package = types.ModuleType('drone_data')
+    package.__path__ = [ROOT]
+    sys.modules['drone_data'] = package
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+import rasterio
+from affine import Affine
+
+torch = pytest.importorskip('torch')
+
+from drone_data.uavdl import detectors
+from drone_data.uavdl.detectors import (DroneObjectDetection, Drone_ODetector,
+                                        pipeline_detection)
+
+
+class CellDetector(torch.nn.Module):
+    """
+    YOLO-like model that predicts a box on every 128 pixels cell, its confidence is the cell
+    brightness.
+    """
+    stride = torch.tensor([8., 16., 32.])
+
+    def forward(self, x, augment=False):
+        n, _, h, w = x.shape
+        conf = torch.nn.functional.avg_pool2d(x.mean(1, keepdim=True), 128).flatten(1)
+        gy, gx = torch.meshgrid(torch.arange(h // 128), torch.arange(w // 128), indexing='ij')
+        cx = (gx * 128 + 64).float().flatten().expand(n, -1)
+        cy = (gy * 128 + 64).float().flatten().expand(n, -1)
+        size = torch.full_like(cx, 80)
+
+        return torch.stack([cx, cy, size, size, conf, torch.ones_like(conf)], -1)
+
+
+def bright_detector(image, threshold):
+    meanvalue = image.mean() / 255
+    return ([[0.1, 0.1, 0.5, 0.5]], [meanvalue]) if meanvalue > threshold else ([], [])
+
+
+@pytest.fixture
+def orthomosaic(tmp_path):
+    # dark image with a few bright squares
+    img = np.zeros((3, 192, 192), dtype=np.uint8)
+    for row, col in [(10, 20), (70, 100), (130, 40), (150, 150)]:
+        img[:, row:row + 32, col:col + 32] = 250
+    profile = dict(driver='GTiff', count=3, height=192, width=192, dtype='uint8',
+                   crs='EPSG:32618', transform=Affine(0.01, 0, 500000, 0, -0.01, 4000000))
+    with rasterio.open(tmp_path / 'ortho.tif', 'w', **profile) as dst:
+        dst.write(img)
+
+    return str(tmp_path) + '/'
+
+
+@pytest.mark.parametrize('postworkers', [0, 1, 3])
+@pytest.mark.parametrize('batch_size', [1, 4])
+def test_pipeline_detection_keeps_tile_order(postworkers, batch_size):
+    tiles = [(i, None if i % 5 == 0 else i) for i in range(23)]
+
+    results = list(pipeline_detection(iter(tiles), lambda batch: [v * 2 for v in batch],
+                                      lambda batch, output: output, batch_size=batch_size,
+                                      postworkers=postworkers))
+
+    assert results == [(i, 2 * i) for i in range(23) if i % 5 != 0]
+
+
+def test_serial_pipeline_does_not_start_threads(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('no executor is expected')
+
+    monkeypatch.setattr(detectors, 'ThreadPoolExecutor', fail)
+    results = list(pipeline_detection(iter([(0, 1), (1, 2), (2, 3)]), lambda batch: batch,
+                                      lambda batch, output: output, batch_size=2,
+                                      postworkers=0))
+
+    assert results == [(0, 1), (1, 2), (2, 3)]
+
+
+@pytest.mark.parametrize('batch_size, nworkers', [(4, None), (1, 2), (3, 2)])
+def test_pipelined_yolo_detection_matches_serial(orthomosaic, batch_size, nworkers):
+    uavimage = DroneObjectDetection(orthomosaic, yolo_model=CellDetector(), device='cpu',
+                                    bands=['red', 'green', 'blue'], multiband_image=True)
+    kwargs = dict(imgsize=64, overlap=[0, 0.25], bands=['blue', 'green', 'red'], conf_thres=0.3)
+
+    reference = uavimage.detect_oi_in_uavimage(**kwargs)
+    pipelined = uavimage.detect_oi_in_uavimage(batch_size=batch_size, nworkers=nworkers, **kwargs)
+
+    assert len(reference) > 0
+    assert pipelined.geometry.equals(reference.geometry)
+    assert list(pipelined.score) == list(reference.score)
+
+
+def test_pipelined_odetector_matches_serial(orthomosaic, monkeypatch):
+    # the comparison is done on the tile polygons, before they are merged
+    monkeypatch.setattr(detectors, 'merge_spatial_features',
+                        lambda polygons, mininterectedgeom: [polygons])
+    uavimage = Drone_ODetector(bright_detector, orthomosaic, bands=['red', 'green', 'blue'],
+                               multiband_image=True)
+
+    reference, _ = uavimage.detect_oi_in_uavimage(tilesize=64, threshold_prediction=0.1)
+    pipelined, _ = uavimage.detect_oi_in_uavimage(tilesize=64, threshold_prediction=0.1,
+                                                   nworkers=2)
+
+    assert len(reference) > 0
+    assert pipelined.geometry.equals(reference.geometry)
+    assert list(pipelined.tile) == list(reference.tile)
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pykrige')
+
+from pykrige.ok import OrdinaryKriging
+
+from drone_data.utils.xyz_functions import local_kriging_interpolation
+
+
+def linear_field(x, y):
+    return 19 * (x + y) / 2
+
+
+def tile_edges(shape, tilesize):
+    edges = np.zeros(shape, dtype=bool)
+    for start in range(0, shape[0], tilesize):
+        edges[start, :] = edges[min(start + tilesize, shape[0]) - 1, :] = True
+    for start in range(0, shape[1], tilesize):
+        edges[:, start] = edges[:, min(start + tilesize, shape[1]) - 1] = True
+
+    return edges
+
+
+def test_local_kriging_matches_global_kriging_at_tile_edges():
+    # dense cloud, the neighbours of each tile are a small part of its points, the
+    # tolerance is 1% of the values range
+    rng = np.random.default_rng(0)
+    coords = rng.uniform(0, 1, (1500, 2))
+    values = linear_field(coords[:, 0], coords[:, 1])
+    xvalues = yvalues = np.linspace(0.05, 0.95, 96)
+
+    local = local_kriging_interpolation(coords, values, xvalues, yvalues, nneighbours=64,
+                                        tilesize=32, variogram_model='exponential', njobs=1)
+    ok = OrdinaryKriging(coords[:, 0], coords[:, 1], values, variogram_model='exponential')
+    reference, _ = ok.execute('grid', xvalues, yvalues)
+    truth = linear_field(*np.meshgrid(xvalues, yvalues))
+
+    edges = tile_edges(local.shape, 32)
+    assert np.abs(np.asarray(reference) - truth).max() < 0.05
+    assert np.abs(local - reference)[edges].max() < 0.2
+    assert np.abs(local - reference)[~edges].max() < 0.2
+
+
+def test_local_kriging_keeps_the_channels():
+    rng = np.random.default_rng(1)
+    coords = rng.uniform(0, 1, (300, 2))
+    values = np.stack([linear_field(*coords.T), -linear_field(*coords.T)], axis=1)
+    xvalues = yvalues = np.linspace(0.1, 0.9, 20)
+
+    local = local_kriging_interpolation(coords, values, xvalues, yvalues, nneighbours=32,
+                                        tilesize=8, njobs=1)
+
+    assert local.shape == (2, 20, 20)
+    np.testing.assert_allclose(local[0], -local[1], atol=1e-6)
@@ -16,10 +16,71 @@ import numpy as np
 import tqdm
 import collections
 import torch.optim as optim
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from typing import List, Dict
 import xarray as xr
 
+
+def pipeline_detection(tiles, predict_batch, postprocess, batch_size = 1, postworkers = 1):
+    """
+    Runs the detection as a pipeline, the tiles are consumed as they arrive (e.g. from 
+    DroneData.iter_tiles, which reads them ahead in a pool of threads), the model is called 
+    on batches of tiles and the post processing of each batch runs in a pool of threads 
+    while the next batch is predicted.
+
+    Args:
+        tiles (iterable): pairs of (tile id, prepared tile), the tiles prepared as None are not predicted.
+        predict_batch (callable): function that runs the model on a list of prepared tiles.
+        postprocess (callable): function that takes the list of prepared tiles and the predict_batch 
+            output and returns one result per tile.
+        batch_size (int, optional): number of tiles per model call. Defaults to 1.
+        postworkers (int, optional): number of post processing threads, 0 runs the post processing 
+            in the calling thread after each model call, without a thread pool. Defaults to 1.
+
+    Yields:
+        tuple: tile id and its result, in the tiles order.
+    """
+    
+    if postworkers == 0:
+        for idtiles, prepared in _tile_batches(tiles, batch_size):
+            yield from zip(idtiles, postprocess(prepared, predict_batch(prepared)))
+        return
+    
+    def collect(pending):
+        idtiles, future = pending.popleft()
+        return zip(idtiles, future.result())
+    
+    with ThreadPoolExecutor(max_workers = postworkers) as executor:
+        pending = collections.deque()
+        for idtiles, prepared in _tile_batches(tiles, batch_size):
+            output = predict_batch(prepared)
+            pending.append((idtiles, executor.submit(postprocess, prepared, output)))
+            ## limit the batches waiting for post processing
+            while pending and (pending[0][1].done() or len(pending) > 2 * postworkers):
+                yield from collect(pending)
+        
+        while pending:
+            yield from collect(pending)
+
+
+def _tile_batches(tiles, batch_size):
+    # groups the prepared tiles in (tile ids, prepared tiles) batches, skipping the None ones
+    batch = []
+    for idtile, prepared in tiles:
+        if prepared is not None:
+            batch.append((idtile, prepared))
+        if len(batch) == batch_size:
+            idtiles, prepared = zip(*batch)
+            batch = []
+            yield list(idtiles), list(prepared)
+    
+    if len(batch):
+        idtiles, prepared = zip(*batch)
+        yield list(idtiles), list(prepared)
+
+
 class DroneObjectDetection(DroneData):
     
     """class to detect objects using a YOLOV5 model
@@ -45,68 +106,105 @@ class DroneObjectDetection(DroneData):
             
             if img0.shape[0] == 3:
                 img0 = img0.swapaxes(0, 1).swapaxes(1, 2)
-            xyxylist,yolocoords = xyxy_predicted_box(bbpredictions, img0.shape, img1.shape)
-            
-            ### save as shapefiles
-            crs_system = self.drone_data.attrs['crs']
-            polsshp_list = []
-            
-            if len(xyxylist):
-                for i in range(len(xyxylist)):
-                    bb_polygon = from_bbxarray_2polygon(xyxylist[i][0], self.drone_data)
+            output, yolocoords = self._predictions_asgeodata(bbpredictions, img0.shape, 
+                                                             img1.shape, self.drone_data)
 
-                    pred_score = np.round(xyxylist[i][2] * 100, 3)
+        return output, yolocoords
+    
+    def _predictions_asgeodata(self, bbpredictions, img0shape, img1shape, xrdata):
+        
+        xyxylist,yolocoords = xyxy_predicted_box(bbpredictions, img0shape, img1shape)
+        output = None
+        ### save as shapefiles
+        crs_system = xrdata.attrs['crs']
+        polsshp_list = []
+        
+        if len(xyxylist):
+            for i in range(len(xyxylist)):
+                bb_polygon = from_bbxarray_2polygon(xyxylist[i][0], xrdata)
 
-                    gdr = gpd.GeoDataFrame({'pred': [i],
-                                            'score': [pred_score],
-                                            'geometry': bb_polygon},
-                                        crs=crs_system)
+                pred_score = np.round(xyxylist[i][2] * 100, 3)
 
-                    polsshp_list.append(gdr)
-                output = pd.concat(polsshp_list, ignore_index=True)
+                gdr = gpd.GeoDataFrame({'pred': [i],
+                                        'score': [pred_score],
+                                        'geometry': bb_polygon},
+                                    crs=crs_system)
+
+                polsshp_list.append(gdr)
+            output = pd.concat(polsshp_list, ignore_index=True)
 
         return output, yolocoords
-        
     
     def predict_tile_coords(self, imgtile, bands = ['blue', 'green','red'], **kwargs):
 
+        return self.predict_tiles_coords([imgtile], bands = bands, **kwargs)[0]
+    
+    def _prepare_tile(self, imgtile, bands = ['blue', 'green','red']):
+        
         img0 = imgtile[bands].copy().to_array().values
-        output = None
-        yolocoords = []
-        if not np.isnan(img0.sum()) and img0.shape[1] == img0.shape[2]:
+        ## only square tiles without nan values are predicted
+        if np.isnan(img0.sum()) or img0.shape[1] != img0.shape[2]:
+            return None
         
-            bbpredictions, img1 = self.predict(img0, **kwargs)
+        return imgtile, img0, check_image(img0)
+    
+    def _predict_prepared(self, prepared, **kwargs):
+        
+        return self._predict_checked(np.concatenate([tile[2] for tile in prepared]), **kwargs)
+    
+    def _tiles_asgeodata(self, prepared, output):
+        
+        bbpredictions, img1 = output
+        outputs = []
+        ## scatter the boxes back to their tiles
+        for k, (imgtile, img0, _) in enumerate(prepared):
             if img0.shape[0] == 3:
                 img0 = img0.swapaxes(0, 1).swapaxes(1, 2)
-            xyxylist,yolocoords = xyxy_predicted_box(bbpredictions, img0.shape, img1.shape)
-
-            ### save as shapefiles
-            crs_system = imgtile.attrs['crs']
-            polsshp_list = []
-            
-            if len(xyxylist):
-                for i in range(len(xyxylist)):
-                    bb_polygon = from_bbxarray_2polygon(xyxylist[i][0], imgtile)
-
-                    pred_score = np.round(xyxylist[i][2] * 100, 3)
-
-                    gdr = gpd.GeoDataFrame({'pred': [i],
-                                            'score': [pred_score],
-                                            'geometry': bb_polygon},
-                                        crs=crs_system)
+            outputs.append(self._predictions_asgeodata([bbpredictions[k]], img0.shape, 
+                                                       img1.shape, imgtile))
+        return outputs
+    
+    def predict_tiles_coords(self, imgtiles, bands = ['blue', 'green','red'], **kwargs):
+        """
+        Predict a list of tiles in a single forward pass. Only the square tiles without 
+        nan values are predicted, the rest get (None, []).
 
-                    polsshp_list.append(gdr)
-                output = pd.concat(polsshp_list, ignore_index=True)
+        Args:
+            imgtiles (List[xarray.Dataset]): tiles taken from the UAV image
+            bands (List[str], optional): image bands used by the model. Defaults to ['blue', 'green','red'].
 
-        return output, yolocoords
+        Returns:
+            List[tuple]: the predicted polygons (GeoDataFrame) and yolo coordinates for each tile
+        """
+        prepared = [self._prepare_tile(imgtile, bands) for imgtile in imgtiles]
+        topredict = [j for j, tile in enumerate(prepared) if tile is not None]
+        
+        outputs = [(None, []) for _ in imgtiles]
+        if len(topredict) == 0:
+            return outputs
+        
+        prepared = [prepared[j] for j in topredict]
+        predictions = self._predict_prepared(prepared, **kwargs)
+        for j, output in zip(topredict, self._tiles_asgeodata(prepared, predictions)):
+            outputs[j] = output
+        
+        return outputs
 
-    def detect_oi_in_uavimage(self, imgsize = 512, overlap = None, aoi_limit = 0.5, onlythesetiles = None, **kwargs):
+    def detect_oi_in_uavimage(self, imgsize = 512, overlap = None, aoi_limit = 0.5, onlythesetiles = None, 
+                              batch_size = 1, nworkers = None, prefetch = None, **kwargs):
         """
         a function to detect opbect of interest in a RGB UAV image
 
         parameters:
         ------
         imgpath: str:
+        batch_size: int, optional
+            number of tiles that are stacked and predicted in a single forward pass
+        nworkers: int, optional
+            if it is given, the tiles are read and preprocessed by a pool of nworkers threads ahead 
+            of the model, and the boxes post processing runs concurrently with the next batch
+        prefetch: int, optional
+            maximum number of tiles read ahead, defaults to twice nworkers
         """
         overlap = [0] if overlap is None else overlap
         allpols_pred = []
@@ -117,10 +215,15 @@ class DroneObjectDetection(DroneData):
             else:
                 tileslist =  list(range(len(self._tiles_pols)))
 
-            for i in tqdm.tqdm(tileslist):
-               
-                bbasgeodata, _ = self.predict_tile_coords(self.tiles_data(i), **kwargs)
-                
+            if nworkers is None:
+                batches = [tileslist[j:j+batch_size] for j in range(0, len(tileslist), batch_size)]
+                predictions = (zip(batch, self.predict_tiles_coords([self.tiles_data(i) for i in batch], **kwargs))
+                               for batch in tqdm.tqdm(batches))
+                predictions = (prediction for batchpredictions in predictions for prediction in batchpredictions)
+            else:
+                predictions = self._pipelined_predictions(tileslist, batch_size, nworkers, prefetch, **kwargs)
+            
+            for i, (bbasgeodata, _) in predictions:
                 if bbasgeodata is not None:
                     bbasgeodata['tile']= [i for j in range(bbasgeodata.shape[0])]
                     allpols_pred.append(bbasgeodata)
@@ -138,6 +241,16 @@ class DroneObjectDetection(DroneData):
         
         return total_objects
 
+
+    def _pipelined_predictions(self, tileslist, batch_size, nworkers, prefetch = None, 
+                               bands = ['blue', 'green','red'], **kwargs):
+        
+        tiles = self.iter_tiles(nworkers, prefetch, idtiles = tileslist, 
+                                preprocess = partial(self._prepare_tile, bands = bands))
+        
+        return pipeline_detection(tqdm.tqdm(zip(tileslist, tiles), total = len(tileslist)), 
+                                  partial(self._predict_prepared, **kwargs), self._tiles_asgeodata, 
+                                  batch_size = batch_size)
     
     def predict(self, image, conf_thres=0.5,
                        iou_thres=0.45,
@@ -147,16 +260,38 @@ class DroneObjectDetection(DroneData):
                        max_det=1000):
 
         
-        imgc = check_image(image)
+        if isinstance(image, list):
+            imgc = np.concatenate([check_image(img) for img in image])
+        else:
+            imgc = check_image(image)
+        
+        return self._predict_checked(imgc, conf_thres, iou_thres, classes, agnostic_nms, half, max_det)
+    
+    def _predict_checked(self, imgc, conf_thres=0.5,
+                       iou_thres=0.45,
+                       classes=None,
+                       agnostic_nms=False,
+                       half = False,
+                       max_det=1000):
+        
+        height, width = imgc.shape[2:]
+        imgc = pad_to_stride(imgc, stride = self._model_stride())
+        
         img = torch.from_numpy(imgc).to(self.device)
         img = img.half() if half else img.float()
         
         img = img / 255.
         
-        bounding_box = self.model(img, augment=False)
+        with torch.no_grad():
+            bounding_box = self.model(img, augment=False)
         pred = non_max_suppression(bounding_box, conf_thres, iou_thres, classes,
                                agnostic_nms, max_det=max_det)
-        return pred, img
+        ## the padding is at the bottom and right, so boxes keep the unpadded scale
+        return pred, img[:, :, :height, :width]
+    
+    def _model_stride(self):
+        stride = getattr(self.model, 'stride', None)
+        return 32 if stride is None else int(max(stride))
     
     def export_as_yolo_training(self):
         
@@ -194,7 +329,8 @@ class Drone_ODetector(DroneData):
         self.detector = detector
     
     def detect_oi_in_uavimage(self, tilesize: int = 512, overlap: List = None, 
-                              aoi_limit: float = 0.15, threshold_prediction: float = 0.1):
+                              aoi_limit: float = 0.15, threshold_prediction: float = 0.1,
+                              nworkers: int = None, prefetch: int = None):
         """
         Detect objects of interest in UAV images.
 
@@ -203,6 +339,9 @@ class Drone_ODetector(DroneData):
             overlap (List, optional): List of overlap values for tile splitting. Defaults to None.
             aoi_limit (float, optional): Minimum area of interest limit. Defaults to 0.15.
             threshold_prediction (float, optional): Minimum pprediction accuracy for the prediction. Defaults to 0.1.
+            nworkers (int, optional): If it is given, the tiles are read and preprocessed by a pool of 
+                threads ahead of the detector, and the post processing runs concurrently. Defaults to None.
+            prefetch (int, optional): Maximum number of tiles read ahead. Defaults to twice nworkers.
 
         Returns:
             tuple: Detected boundary boxes and polygons.
@@ -213,15 +352,20 @@ class Drone_ODetector(DroneData):
         allpols_pred = []
         for spl in overlap:
             self.split_into_tiles(width = tilesize, height = tilesize, overlap = spl)
-            ## only tiles with data
-            onlythesetiles = []
-            for i in tqdm.tqdm(range(len(self._tiles_pols))):
-                if np.sum(self.tiles_data(i)[self._bands[0]].values) != 0.0:
-                    bbasgeodata = self.detect(self.tiles_data(i), threshold = threshold_prediction)
-                
-                    if bbasgeodata is not None:
-                        bbasgeodata['tile']= [i for j in range(bbasgeodata.shape[0])]
-                        allpols_pred.append(bbasgeodata)
+            tileslist = list(range(len(self._tiles_pols)))
+            if nworkers is None:
+                tiles = ((i, self._prepare_tile(self.tiles_data(i))) for i in tileslist)
+            else:
+                tiles = zip(tileslist, self.iter_tiles(nworkers, prefetch, preprocess = self._prepare_tile))
+            
+            predictions = pipeline_detection(tqdm.tqdm(tiles, total = len(tileslist)),
+                                             partial(self._detect_prepared, threshold = threshold_prediction),
+                                             self._tiles_asgeodata, postworkers = 0 if nworkers is None else 1)
+            
+            for i, bbasgeodata in predictions:
+                if bbasgeodata is not None:
+                    bbasgeodata['tile']= [i for j in range(bbasgeodata.shape[0])]
+                    allpols_pred.append(bbasgeodata)
                     
         if len(allpols_pred) > 0:
             allpols_pred_gpd = pd.concat(allpols_pred)
@@ -247,15 +391,38 @@ class Drone_ODetector(DroneData):
             pd.DataFrame: Detected objects with their attributes.
         """
         
+        xrimage, tiledata = self._prepare_tile(xrimage, onlywithdata = False)
+        detections = self.detector(image=tiledata, threshold = threshold)
+        
+        return self._detections_asgeodata(detections, xrimage, tiledata)
+    
+    def _prepare_tile(self, xrimage, onlywithdata = True):
+        
+        ## only tiles with data
+        if onlywithdata and np.sum(xrimage[self._bands[0]].values) == 0.0:
+            return None
+        
         if isinstance(xrimage, xr.Dataset):
             tiledata = xrimage.to_array().values.astype(np.uint8)
         else:
             tiledata = xrimage.values.astype(np.uint8)
         # TODO: IMAGE ORDER CHANGE FOR OTHER DETECTORS
         tiledata = tiledata.swapaxes(0,1).swapaxes(1,2)[:,:,[2,1,0]]
-        origsize = tiledata.shape[:2]
-        detections = self.detector(image=tiledata, threshold = threshold)
         
+        return xrimage, tiledata
+    
+    def _detect_prepared(self, prepared, threshold = 0.1):
+        
+        return [self.detector(image=tiledata, threshold = threshold) for _, tiledata in prepared]
+    
+    def _tiles_asgeodata(self, prepared, detections):
+        
+        return [self._detections_asgeodata(tiledetections, *tile) 
+                for tile, tiledetections in zip(prepared, detections)]
+    
+    def _detections_asgeodata(self, detections, xrimage, tiledata):
+        
+        origsize = tiledata.shape[:2]
         xyxylist = [[int(j * origsize[0]) for j in i] for i in detections[0]]
         
         crs_system = None if xrimage.attrs['crs'] is None else xrimage.attrs['crs']
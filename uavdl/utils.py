@@ -169,6 +169,27 @@ def clip_boxes(boxes, shape):
         boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, shape[0])  # y1, y2
 
 
+def pad_to_stride(imgs, stride = 32, value = 0):
+    """
+    Pad a batch of images at the bottom and right, so its height and width are 
+    multiples of the model stride.
+
+    Args:
+        imgs (numpy array): images (N, C, X, Y)
+        stride (int, optional): the model's stride. Defaults to 32.
+        value (int, optional): padding value. Defaults to 0.
+
+    Returns:
+        a 4-D numpy array (N, C, X, Y)
+    """
+    padh = (-imgs.shape[2]) % stride
+    padw = (-imgs.shape[3]) % stride
+    if padh == 0 and padw == 0:
+        return imgs
+    
+    return np.pad(imgs, ((0, 0), (0, 0), (0, padh), (0, padw)), constant_values = value)
+
+
 def xyxy_predicted_box(bbpredicted, im0shape, img1shape):
 
     pred = bbpredicted
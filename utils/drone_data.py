@@ -1,10 +1,7 @@
 import numpy as np
 #from sqlalchemy import over
 import xarray
-import rasterio
-import rasterio.mask
-from rasterio.windows import from_bounds
-import rioxarray as rio
+from affine import Affine
 import os
 import glob
 from PIL import Image
@@ -21,11 +18,13 @@ import geopandas as gpd
 
 from . import gis_functions as gf
 from .xr_functions import split_xarray_data, add_2dlayer_toxarrayr
-from .general import VEGETATION_INDEX
-from .mc_imagery import calculate_vi_fromarray
+from .general import VEGETATION_INDEX, policy_dtype, apply_dtype_policy
+from .mc_imagery import calculate_vi_fromarray, calculate_vi_blockwise
+from .raster_io import (read_raster_bands, read_raster_bands_lazy, write_cog, native_dtype,
+                        MosaicIndex, get_mosaic_index)
 
-import re
-import pickle
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 from typing import List, Optional
 
@@ -169,16 +168,17 @@ def calculate_vi_fromxarray(xarraydata, vi='ndvi', expression=None, label=None,
     
     variable_names = list(xarraydata.keys())
     namask = xarraydata.attrs['nodata']
-    vidata, label = calculate_vi_fromarray(xarraydata.to_array().values, 
+    # .data keeps the dask array of lazy datasets, so the index is computed by blocks
+    vidata, label = calculate_vi_fromarray(xarraydata.to_array().data, 
                            variable_names,vi=vi, 
                            expression=expression, 
                            label=label, navalues = namask, overwrite = overwrite)
     
     if vidata is not None:
-        vidata[np.isnan(vidata)] = xarraydata.attrs['nodata']
-        xarraydata[label] = xarraydata[variable_names[0]].copy()
-        
-        xarraydata[label].values = vidata
+        # np.where instead of an in place assignment, dask arrays do not support it
+        if namask is not None:
+            vidata = np.where(np.isnan(vidata), namask, vidata)
+        xarraydata[label] = xarraydata[variable_names[0]].copy(data = vidata)
         xarraydata.attrs['count'] = len(list(xarraydata.keys()))
 
     else:
@@ -187,10 +187,41 @@ def calculate_vi_fromxarray(xarraydata, vi='ndvi', expression=None, label=None,
     return xarraydata
 
 
-def multiband_totiff(xrdata, filename, varnames=None):
+def xarray_to_cog(xrdata, fn, varnames, dtype = 'native', **kwargs):
+    """
+    Writes variables of a DroneData xarray as a Cloud Optimized GeoTIFF.
+
+    Parameters:
+    ----------
+    xrdata : xarray.Dataset
+        The xarray dataset to be exported.
+    fn : str
+        Output file path.
+    varnames : list of str
+        Variables written as bands, their names are kept as the band descriptions.
+    dtype : str, optional
+        Output dtype. 'native' keeps the dtype of the source images when the values fit
+        in it, None writes the dtype of the arrays.
+    **kwargs
+        Options of raster_io.write_cog, e.g. compress, predictor, blocksize or num_threads.
+    """
+    metadata = xrdata.attrs
+    # the bands are passed as a list, write_cog does not stack them
+    imgs = [np.asarray(xrdata[varname].data) for varname in varnames]
+    nodata = metadata.get('nodata')
+    if dtype == 'native':
+        dtype = native_dtype(imgs, metadata.get('dtype'), nodata)
+
+    transform = metadata['transform']
+    transform = transform if isinstance(transform, Affine) else Affine(*transform[:6])
+    write_cog(fn, imgs, transform, crs = metadata.get('crs'), nodata = nodata,
+              dtype = dtype, band_names = varnames, **kwargs)
+
+
+def multiband_totiff(xrdata, filename, varnames=None, dtype = 'native', **kwargs):
 
     """
-    Converts multiband xarray data to a TIFF file.
+    Converts multiband xarray data to a Cloud Optimized TIFF file.
 
     Parameters:
     ----------
@@ -201,24 +232,29 @@ def multiband_totiff(xrdata, filename, varnames=None):
     varnames : list of str, optional
         Names of the variables (bands) to be included in the TIFF file. If not provided, 
         all bands will be included.
+    dtype : str, optional
+        Output dtype, 'native' keeps the dtype of the source images when the values fit in it.
+    **kwargs
+        Options of raster_io.write_cog, e.g. compress ('deflate', 'zstd' or 'lzw'),
+        predictor, blocksize, overviews or num_threads.
 
     Returns:
     -------
     None
     """
     
-    metadata = xrdata.attrs
-    
     suffix = (len(filename) + 1)
     
     if filename.endswith('tif'):
         suffix = filename.index('tif')
-       
+    
+    if varnames is None:
+        varnames = list(xrdata.keys())
 
     if len(varnames) > 1:
-        metadata['count'] = len(varnames)
+        xrdata.attrs['count'] = len(varnames)
         fn = "{}{}.tif".format(filename[:(suffix - 1)], "_".join(varnames))
-        xrdata.rio.to_raster(fn)
+        xarray_to_cog(xrdata, fn, varnames, dtype = dtype, **kwargs)
 
 ### TODO: create a class that integrate all plots
 class UAVPlots():
@@ -231,13 +267,13 @@ def check_boundarytype(boundsvariable):
 
     Parameters:
     ----------
-    boundsvariable : gpd.GeoDataFrame, gpd.GeoSeries, or list of dict
+    boundsvariable : gpd.GeoDataFrame, gpd.GeoSeries, list of dict or None
         The boundary variable to be checked and standardized.
 
     Returns:
     -------
     list of dict
-        The boundary variable in a standard format.
+        The boundary variable in a standard format, None if there is no boundary.
 
     Raises:
     ------
@@ -245,6 +281,9 @@ def check_boundarytype(boundsvariable):
         If the boundary object is not in a recognized format.
     """
     
+    if boundsvariable is None:
+        return None
+    
     if isinstance(boundsvariable, gpd.GeoDataFrame):
         if boundsvariable.shape[0]> 1:
             print('The GeoDataFrame has more than 1 feature; only the first one will be used.')
@@ -278,7 +317,10 @@ class DroneData:
     """
 
     def __init__(self, inputpath: str, bands: Optional[List[str]] = None,
-                 multiband_image: bool = False, bounds: Optional[dict] = None):
+                 multiband_image: bool = False, bounds: Optional[dict] = None,
+                 lazy: bool = False, chunks = True, target_resolution: Optional[float] = None,
+                 overview_level: Optional[int] = None, dtype_policy: str = 'float32',
+                 nworkers: Optional[int] = None, mosaic: bool = False):
         
         """
         Initialize the DroneData class with the given parameters.
@@ -293,21 +335,60 @@ class DroneData:
             Whether the data is a multistack object or composed of separated bands.
         bounds : dict, optional
             GeoDataFrame, GeoSeries, or a list of GeoJSON-like dict to clip the image.
+        lazy : bool, optional
+            Keep the bands as dask arrays that are read by windows only when they are 
+            needed (requires dask). Only calculate_vi (the index is a new dask array) and 
+            split_into_tiles stay lazy, tiles_data and iter_tiles load only the window of 
+            each tile. The other operations load the bands they use: to_rgbjpg loads the 
+            three channels as uint8 (three bytes per pixel), to_tiff loads every exported 
+            band, and data_astable, clusters, rf_classification, extract_usingpoints and the 
+            plots load the whole bands. calculate_vi_tofile streams from the files in both modes.
+        chunks : bool, int, tuple or dict, optional
+            Dask chunks for the lazy mode, True aligns them to the file internal tiles.
+        target_resolution : float, optional
+            Read the image at a coarser spatial resolution (e.g. for previews), the pixels 
+            come from the internal overviews when the file has them.
+        overview_level : int, optional
+            Read the image at the resolution of an overview level (0 is the first overview).
+        dtype_policy : str, optional
+            dtype of the bands: 'float32' (default) or 'float16', the pixels outside the bounds 
+            are nan, or 'native' to keep the file dtype, the pixels outside the bounds are 
+            then masked with the nodata value.
+        nworkers : int, optional
+            Number of threads that decode the image blocks concurrently, None reads them 
+            sequentially. Whether it is faster depends on the cores and the file compression, 
+            measure it with raster_io.benchmark_threaded_reads. It is also the default number 
+            of threads of iter_tiles.
+        mosaic : bool, optional
+            The orthomosaic is split in several GeoTIFF tiles in inputpath. They are read as a 
+            virtual mosaic, only the tiles that intersect the bounds are opened and merged. It 
+            can not be combined with the lazy mode.
         """
+        if mosaic and lazy:
+            raise ValueError('The lazy mode is not available for mosaics, use the bounds to read '
+                             'only the tiles of the area of interest')
         
+        self.dtype_policy = dtype_policy
+        self.nworkers = nworkers
         self._bands = ['red', 'green', 'blue'] if bands is None else bands
         self._clusters = np.nan
         self._tiles_pols = None
-        self._files_path = self._determine_files_path(inputpath, multiband_image)
+        self._files_path = self._determine_files_path(inputpath, multiband_image, mosaic)
+        self._multiband_image = multiband_image
         self.bounds_asjson = check_boundarytype(bounds)
         
         if len(self._files_path)>0:
-            self.drone_data = self.tif_toxarray(multiband_image, bounds=self.bounds_asjson)
+            self.drone_data = self.tif_toxarray(multiband_image, bounds=self.bounds_asjson,
+                                                lazy = lazy, chunks = chunks,
+                                                target_resolution = target_resolution,
+                                                overview_level = overview_level,
+                                                dtype_policy = dtype_policy,
+                                                nworkers = nworkers)
         else:
             raise FileNotFoundError('No file path was found at the specified input path.')
             
 
-    def _determine_files_path(self, inputpath: str, multiband_image: bool) -> List[str]:
+    def _determine_files_path(self, inputpath: str, multiband_image: bool, mosaic: bool = False) -> list:
         """
         Determine the file paths.
 
@@ -317,17 +398,32 @@ class DroneData:
             The directory path to search for image files.
         multiband_image : bool
             Whether the image data is in multiband format.
+        mosaic : bool, optional
+            Group the tiles of each band in a MosaicIndex.
 
         Returns:
         -------
-        List[str]
-            A list of file paths for the drone data.
+        list
+            A list of file paths (or MosaicIndex) for the drone data.
 
         Raises:
         ------
         ValueError
             If no TIFF files are found in the specified directory.
         """
+        if mosaic:
+            imgfiles = sorted(glob.glob(inputpath + "*.tif"))
+            if multiband_image:
+                tiles = [imgfiles for _ in self._bands]
+            else:
+                # the red tiles must not include the red edge tiles
+                tiles = [[fn for fn in imgfiles if band in os.path.basename(fn) and 
+                          not (band == 'red' and 'edge' in os.path.basename(fn))] for band in self._bands]
+            if any(len(bandtiles) == 0 for bandtiles in tiles):
+                raise ValueError(f"No TIFF tiles found in the directory: {inputpath}")
+            
+            return [get_mosaic_index(bandtiles) for bandtiles in tiles]
+        
         if not multiband_image:
             # If the data is not multiband, find individual files for each band.
             return get_files_paths(inputpath, self._bands)
@@ -399,6 +495,39 @@ class DroneData:
 
         self.drone_data = calculate_vi_fromxarray(self.drone_data, vi, expression, label)
 
+    def calculate_vi_tofile(self, fn: str, vilist: List[str], expressions: Optional[dict] = None,
+                            nworkers: Optional[int] = None, **kwargs) -> str:
+        """
+        Streaming version of calculate_vi, the indices are computed block by block from the
+        source files of the whole orthomosaic (the bounds are not applied) and written into a 
+        tiled GeoTIFF, so the mosaic is never loaded in memory.
+
+        Parameters:
+        ----------
+        fn : str
+            Output GeoTIFF file path, one band per index.
+        vilist : list of str
+            Vegetation indices, e.g. ['ndvi', 'ndre'].
+        expressions : dict, optional
+            Equation of each index, by default VEGETATION_INDEX or MSVEGETATION_INDEX are used.
+        nworkers : int, optional
+            Number of threads. Defaults to the DroneData nworkers, or 4.
+        **kwargs
+            Options of mc_imagery.calculate_vi_blockwise, e.g. blocksize, compress or overviews.
+
+        Return:
+        ----------
+        str
+            Output file path.
+        """
+        if any(isinstance(path, MosaicIndex) for path in self._files_path):
+            raise ValueError('The streaming indices are not available for mosaics, write them per tile')
+        sources = [(path, (i + 1) if self._multiband_image else 1) 
+                   for i, path in enumerate(self._files_path)]
+        
+        return calculate_vi_blockwise(sources, self._bands, vilist, fn, expressions = expressions, 
+                                      nworkers = nworkers or self.nworkers or 4, **kwargs)
+
     def rf_classification(self, model, features=None):
 
         if features is None:
@@ -478,7 +607,10 @@ class DroneData:
                                      bands,
                                      long=long_direction)
 
-    def tif_toxarray(self, multiband: bool = False, bounds: Optional[dict] = None) -> xarray.Dataset:
+    def tif_toxarray(self, multiband: bool = False, bounds: Optional[dict] = None,
+                     lazy: bool = False, chunks = True, target_resolution: Optional[float] = None,
+                     overview_level: Optional[int] = None, dtype_policy: str = 'float32',
+                     nworkers: Optional[int] = None) -> xarray.Dataset:
         
         """
         Converts TIFF images to an xarray dataset.
@@ -489,6 +621,19 @@ class DroneData:
             Whether the image data is in multiband format.
         bounds : dict, optional
             GeoJSON-like dictionary to clip the image.
+        lazy : bool, optional
+            Return dask backed variables, the pixels are read by windows on demand.
+        chunks : bool, int, tuple or dict, optional
+            Dask chunks for the lazy mode, True aligns them to the file internal tiles.
+        target_resolution : float, optional
+            Coarser spatial resolution to read the image, the decimated reads are not lazy.
+        overview_level : int, optional
+            Overview level to read the image, the decimated reads are not lazy.
+        dtype_policy : str, optional
+            'native', 'float32' or 'float16'. With 'native' the bands keep the file dtype and 
+            the pixels outside the bounds take the nodata value instead of nan.
+        nworkers : int, optional
+            Number of threads that decode the blocks of each file concurrently.
 
         Returns:
         -------
@@ -496,47 +641,53 @@ class DroneData:
             The xarray dataset created from the TIFF images.
         """
         riolist = []
-        imgindex = 1
         nodata = None
-        boundswindow = None
+        decimated = target_resolution is not None or overview_level is not None
+        
+        def readbands(*args, **kwargs):
+            if lazy and not decimated:
+                return read_raster_bands_lazy(*args, chunks = chunks, nworkers = nworkers, **kwargs)
+            return read_raster_bands(*args, overview_level = overview_level, 
+                                     target_resolution = target_resolution, nworkers = nworkers, **kwargs)
+        
+        # each file is opened once and all its bands are read in a single call
+        bandsperfile = {}
+        for i, (band, path) in enumerate(zip(self._bands, self._files_path)):
+            bandsperfile.setdefault(path, []).append((band, (i + 1) if multiband else 1))
         
-        for band, path in zip(self._bands, self._files_path):
+        def readmosaic(mosaic, *args, **kwargs):
+            # virtual mosaics are read eagerly, only the tiles that intersect the bounds
+            return mosaic.read(*args, target_resolution = target_resolution, 
+                               overview_level = overview_level, **kwargs)
+        
+        for path, filebands in bandsperfile.items():
+            readpath = readmosaic if isinstance(path, MosaicIndex) else readbands
+            if bounds is not None and dtype_policy == 'native':
+                # pixels outside the boundary are masked with the nodata value
+                imgs, tr, metadata = readpath(path, [idx for _, idx in filebands], shapes = bounds)
+                nodata = metadata['nodata'] if metadata['nodata'] is not None else 0
+            elif bounds is not None:
+                # pixels outside the boundary or flagged as nodata are set as nan, also when 
+                # the raster does not have a nodata value
+                imgs, tr, metadata = readpath(path, [idx for _, idx in filebands], shapes = bounds, 
+                                              fill_value = np.nan, 
+                                              dtype = policy_dtype(float, dtype_policy))
+                nodata = np.nan
+            else:
+                imgs, tr, metadata = readpath(path, [idx for _, idx in filebands])
+                nodata = metadata['nodata']
             
-            with rasterio.open(path) as src:
-                
-                tr = src.transform
-                nodata = src.nodata
-                metadata = src.profile.copy()
-                if bounds is not None:
-                    #boundswindow = from_bounds(bounds[0],bounds[1],bounds[2],bounds[3], src.transform)
-                    #tr = src.window_transform(boundswindow)
-                    img, tr = rasterio.mask.mask(src, bounds, crop=True)
-                   
-                    img = img[(imgindex-1),:,:]
-                    img = img.astype(float)
-                    img[img == nodata] = np.nan
-                    nodata = np.nan
-
-                else:
-                    img = src.read(imgindex, window = boundswindow)
-                    
+            metadata.update({
+                'height': imgs.shape[1],
+                'width': imgs.shape[2],
+                'transform': tr})
+            
+            for (band, _), img in zip(filebands, imgs):
+                img = apply_dtype_policy(img, dtype_policy)
                 
-                metadata.update({
-                    'height': img.shape[0],
-                    'width': img.shape[1],
-                    'transform': tr})
-
-            if img.dtype == 'uint8':
-                img = img.astype(float)
-                metadata['dtype'] == 'float'
-
-
-            xrimg = xarray.DataArray(img)
-            xrimg.name = band
-            riolist.append(xrimg)
-
-            if multiband:
-                imgindex += 1
+                xrimg = xarray.DataArray(img)
+                xrimg.name = band
+                riolist.append(xrimg)
 
         # update nodata attribute
         metadata['nodata'] = nodata
@@ -573,7 +724,9 @@ class DroneData:
         plt.show()
 
     def to_rgbjpg(self, fn, channels = ['red','green','blue'], newshape = None):
-        """_summary_
+        """Exports three channels as a JPEG image. The image is loaded in memory as uint8, 
+        also in the lazy mode, read it with target_resolution or overview_level for previews
+        of large orthomosaics.
 
         Args:
             fn (str): file path
@@ -583,8 +736,9 @@ class DroneData:
          
         fn = fn if fn.endswith('.jpg') else fn+'.jpg'
         
-        imgdrs = self.drone_data[channels].to_array().values.copy()
-        imgpil = Image.fromarray(np.rollaxis(imgdrs, 0,3).astype(np.uint8))
+        # casting before loading the values keeps lazy datasets at one byte per pixel
+        imgdrs = self.drone_data[channels].to_array().astype(np.uint8).values
+        imgpil = Image.fromarray(np.rollaxis(imgdrs, 0,3))
         
         
         if newshape is not None:
@@ -595,35 +749,35 @@ class DroneData:
             
             
         
-    def to_tiff(self, filename, channels='all',multistack = False):
+    def to_tiff(self, filename, channels='all',multistack = False, dtype = 'native', **kwargs):
         """
         Using this function the drone data will be saved as a tiff element in a given 
-        filepath.
+        filepath. The files are written as Cloud Optimized GeoTIFFs (tiled, compressed and 
+        with internal overviews).
         ```
         Args:
             filename: The file name path that will be used to save the spatial data.
             channels: optional, the user can select the exporting channels.
             multistack: boolean, default False, it will export the inofrmation as a multistack array or layer by layer
+            dtype: optional, 'native' keeps the source images dtype when the values fit in it, None writes the arrays dtype
+            kwargs: optional, raster_io.write_cog options, e.g. compress ('deflate', 'zstd' or 'lzw'), predictor, blocksize, overviews or num_threads
 
         Returns:
             NONE
         """
         varnames = self._checkbandstoexport(channels)
-        metadata = self.drone_data.attrs
 
         if filename.endswith('tif'):
             suffix = filename.index('tif')
         else:
             suffix = (len(filename) + 1)
         if multistack:
-            multiband_totiff(self.drone_data, filename, varnames= varnames)
+            multiband_totiff(self.drone_data, filename, varnames= varnames, dtype = dtype, **kwargs)
         else:
             if len(varnames) > 0:
                 for i, varname in enumerate(varnames):
-                    imgtoexport = self.drone_data[varname].data.copy()
                     fn = "{}_{}.tif".format(filename[:(suffix - 1)], varname)
-                    with rasterio.open(fn, 'w', **metadata) as dst:
-                        dst.write_band(1, imgtoexport)
+                    xarray_to_cog(self.drone_data, fn, [varname], dtype = dtype, **kwargs)
 
             else:
                 print('check the bands names that you want to export')
@@ -664,5 +818,50 @@ class DroneData:
 
         return xrmasked
 
+    def iter_tiles(self, nworkers: Optional[int] = None, prefetch: Optional[int] = None,
+                   idtiles: Optional[List[int]] = None, preprocess = None):
+        """
+        Iterates over the tiles defined with split_into_tiles(polygons = False). The tiles
+        are cropped and loaded by a pool of threads ahead of the consumer, for lazy data this
+        means their windows are read and decoded concurrently.
+
+        Parameters:
+        ----------
+        nworkers : int, optional
+            Number of threads. Defaults to the DroneData nworkers, or 4.
+        prefetch : int, optional
+            Maximum number of tiles loaded ahead. Defaults to twice the number of threads.
+        idtiles : List[int], optional
+            Tiles to iterate over. Defaults to all the tiles.
+        preprocess : callable, optional
+            Function applied to each loaded tile inside its thread, its output is yielded
+            instead of the tile.
+
+        Yields:
+        ------
+        xarray.Dataset
+            Tiles in the same order as their windows, or in the idtiles order.
+        """
+        if self._tiles_pols is None:
+            raise ValueError("Use split_into_tiles first")
+
+        nworkers = nworkers or self.nworkers or 4
+        prefetch = prefetch or 2 * nworkers
+        def loadtile(idtile):
+            # each tile is computed inside its thread, dask must not start other threads
+            tile = self.tiles_data(idtile).compute(scheduler = 'synchronous')
+            return tile if preprocess is None else preprocess(tile)
+        
+        idtiles = range(len(self._tiles_pols)) if idtiles is None else idtiles
+
+        with ThreadPoolExecutor(max_workers = nworkers) as executor:
+            pending = deque()
+            for idtile in idtiles:
+                pending.append(executor.submit(loadtile, idtile))
+                if len(pending) >= prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
     
 
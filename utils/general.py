@@ -41,6 +41,53 @@ VEGETATION_INDEX = {# rgb bands
 'reci': '(nir / edge) - 1',
 'negvi': '((nir*nir) - (edge*green))/ ((nir*nir) + (edge*green))'}
 
+# dtypes in which the image layers are kept, 'native' keeps the dtype of the source files
+DTYPE_POLICIES = ['native', 'float32', 'float16']
+
+
+def policy_dtype(dtype, policy = 'float32'):
+    """dtype of a layer following a dtype policy
+
+    Args:
+        dtype (numpy.dtype): current dtype of the layer
+        policy (str, optional): 'native', 'float32' or 'float16'. Defaults to 'float32'.
+
+    Returns:
+        numpy.dtype
+    """
+    if policy not in DTYPE_POLICIES:
+        raise ValueError('the dtype policy must be one of {}'.format(DTYPE_POLICIES))
+    
+    return np.dtype(dtype) if policy == 'native' else np.dtype(policy)
+
+
+def float_dtype(dtype):
+    """floating dtype to store the results that need nan values or decimals, the floating
+    layers keep their dtype and integer layers use float32 instead of float64
+
+    Args:
+        dtype (numpy.dtype): dtype of the input layer
+
+    Returns:
+        numpy.dtype
+    """
+    dtype = np.dtype(dtype)
+    return dtype if np.issubdtype(dtype, np.floating) else np.dtype('float32')
+
+
+def apply_dtype_policy(values, policy = 'float32'):
+    """cast an array (numpy or dask) following a dtype policy
+
+    Args:
+        values (array): layer values
+        policy (str, optional): 'native', 'float32' or 'float16'. Defaults to 'float32'.
+
+    Returns:
+        array
+    """
+    dtype = policy_dtype(values.dtype, policy)
+    return values if values.dtype == dtype else values.astype(dtype)
+
 
 
 
@@ -13,17 +13,18 @@ from rasterio import windows
 from shapely.geometry import Polygon
 
 import math
+from functools import lru_cache
 
 from rasterio.crs import CRS
 from rasterio.transform import Affine
 from rasterio import features
 import rioxarray
 import cv2
-import affine
 
 from skimage.registration import phase_cross_correlation
 from sklearn.impute import KNNImputer
 
+from .general import float_dtype
 from .image_functions import (
     phase_convolution, 
     register_image_shift,
@@ -68,6 +69,74 @@ def estimate_pol_buffer(xcoords: List[float], ycoords: List[float], newarea: flo
 
 
 ## basic
+@lru_cache(maxsize=256)
+def _affine_axes(transform: Affine, height: int, width: int, offset: float) -> Tuple[np.ndarray, np.ndarray]:
+    # x along the first row and y along the first column, same arithmetic as Affine * (col, row)
+    tr = transform * Affine.translation(offset, offset)
+    xvalues = np.arange(width) * tr.a + tr.c
+    yvalues = np.arange(height) * tr.e + tr.f
+    xvalues.flags.writeable = False
+    yvalues.flags.writeable = False
+    
+    return xvalues, yvalues
+
+
+def affine_coordinates(transform, imgsize, offset: float = 0.5, ascending: bool = False) -> List[np.ndarray]:
+    """
+    1-D x and y coordinates of the pixels of a raster, computed directly from the affine 
+    transform. The vectors are memoised on (transform, size, offset).
+
+    Parameters:
+    ----------
+    transform : Affine
+        Raster affine transformation (a list with its six coefficients is also accepted).
+    imgsize : list
+        Image size (height, width).
+    offset : float, optional
+        Position inside the pixel, 0.5 for the centre and 0 for the upper left corner.
+    ascending : bool, optional
+        Sort both vectors in ascending order, otherwise they follow the pixel order.
+
+    Returns:
+    -------
+    List[np.ndarray]
+        x and y coordinates.
+    """
+    transform = transform if isinstance(transform, Affine) else Affine(*list(transform)[:6])
+    xvalues, yvalues = _affine_axes(transform, int(imgsize[0]), int(imgsize[1]), float(offset))
+    if ascending:
+        return [np.sort(xvalues), np.sort(yvalues)]
+    
+    return [xvalues.copy(), yvalues.copy()]
+
+
+def affine_meshgrid(transform, imgsize, offset: float = 0.5) -> List[np.ndarray]:
+    """
+    2-D x and y coordinates (height x width) of the pixels of a raster, rotated transforms 
+    are supported.
+
+    Parameters:
+    ----------
+    transform : Affine
+        Raster affine transformation.
+    imgsize : list
+        Image size (height, width).
+    offset : float, optional
+        Position inside the pixel, 0.5 for the centre and 0 for the upper left corner.
+
+    Returns:
+    -------
+    List[np.ndarray]
+        x and y meshgrids.
+    """
+    transform = transform if isinstance(transform, Affine) else Affine(*list(transform)[:6])
+    tr = transform * Affine.translation(offset, offset)
+    cols = np.arange(imgsize[1])[np.newaxis]
+    rows = np.arange(imgsize[0])[:, np.newaxis]
+    
+    return [cols * tr.a + rows * tr.b + tr.c, cols * tr.d + rows * tr.e + tr.f]
+
+
 def xy_fromtransform(transform, width, height):
     """
     this function is for create longitude and latitude range values from the 
@@ -86,26 +155,8 @@ def xy_fromtransform(transform, width, height):
     ----------
     two list, range of unique values for x and y
     """
-    T0 = transform
-    T1 = T0 * affine.Affine.translation(0.5, 0.5)
-    rc2xy = lambda r, c: T1 * (c, r)
-    xvals = []
-    for i in range(width):
-        xvals.append(rc2xy(0, i)[0])
-
-    yvals = []
-    for i in range(height):
-        yvals.append(rc2xy(i, 0)[1])
-
-    xvals = np.array(xvals)
-    if transform[0] < 0:
-        xvals = np.sort(xvals, axis=0)[::-1]
-
-    yvals = np.array(yvals)
-    if transform[4] < 0:
-        yvals = np.sort(yvals, axis=0)[::-1]
-
-    return [xvals, yvals]
+    # pixel centres in pixel order
+    return affine_coordinates(transform, [height, width], offset = 0.5)
 
 
 def register_xarray(xarraydata, shift):
@@ -362,12 +413,18 @@ def resample_xarray(xarraydata, xrreference, method='linear'):
     
     Returns:
     -------
-    a xarray data with new dimensions
+    a xarray data with new dimensions, floating layers keep their dtype and integer layers
+    are returned as float32
     """
 
     xrresampled = xarraydata.interp(x=xrreference['x'].values,
                                       y=xrreference['y'].values,
                                       method=method)
+    # interp promotes to float64
+    for varname in list(xrresampled.keys()):
+        dtype = float_dtype(xarraydata[varname].dtype)
+        if xrresampled[varname].dtype != dtype:
+            xrresampled[varname] = xrresampled[varname].astype(dtype)
 
     xrresampled.attrs['transform'] = transform_fromxy(
         xrreference.x.values,
@@ -386,11 +443,10 @@ def transform_fromxy(x, y, spr):
         spry = spr
     else:
         sprx, spry = spr
-    gridX, gridY = np.meshgrid(x, y)
 
     return [Affine.translation(
-        gridX[0][0] - sprx / 2, gridY[0][0] - spry / 2) * Affine.scale(sprx, spry),
-            gridX.shape]
+        x[0] - sprx / 2, y[0] - spry / 2) * Affine.scale(sprx, spry),
+            (len(y), len(x))]
 
 
 def transform_frombb(bb, spr):
@@ -409,6 +465,77 @@ def rasterize_using_bb(values, points_geometry, transform, imgsize):
                                out_shape=[imgsize[0], imgsize[1]], transform=transform))
 
 
+def rasterize_points_usingbins(xcoords: np.ndarray, ycoords: np.ndarray, values: np.ndarray, 
+                               transform: Affine, imgsize: List[int], 
+                               reducer: str = 'last', fill: float = 0) -> np.ndarray:
+    """
+    Rasterize point values computing the cell of each point from the affine transform, 
+    all the channels are reduced in a single pass without building point geometries.
+
+    Parameters:
+    -----------
+    xcoords : np.ndarray
+        Points coordinates in x.
+    ycoords : np.ndarray
+        Points coordinates in y.
+    values : np.ndarray
+        Values to rasterize, either one channel (N) or several channels (N x C).
+    transform : Affine
+        Raster affine transformation.
+    imgsize : List[int]
+        Raster size (height, width).
+    reducer : str, optional
+        How the points that fall in the same cell are combined: 'mean', 'max', 'min', 
+        'last' (as rasterio.features.rasterize) or 'count'. Defaults to 'last'.
+    fill : float, optional
+        Value for the cells without points. Defaults to 0.
+
+    Returns:
+    --------
+    np.ndarray
+        Rasterized values with dimensions (C x H x W), for 'count' a single (H x W) array.
+    """
+    
+    if reducer not in ['mean', 'max', 'min', 'last', 'count']:
+        raise ValueError(f"Unsupported reducer: {reducer}")
+    
+    values = np.asarray(values)
+    values = values.reshape(len(values), -1)
+    height, width = imgsize[0], imgsize[1]
+    
+    cols, rows = ~transform * (np.asarray(xcoords), np.asarray(ycoords))
+    cols, rows = np.floor(cols).astype(np.int64), np.floor(rows).astype(np.int64)
+    inside = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+    cellids = rows[inside] * width + cols[inside]
+    values = values[inside]
+    
+    counts = np.bincount(cellids, minlength=height * width)
+    if reducer == 'count':
+        return counts.reshape(height, width)
+    
+    if reducer == 'mean':
+        raster = np.stack([np.bincount(cellids, weights=values[:,i], minlength=height * width)
+                           for i in range(values.shape[1])], axis=1)
+        raster[counts > 0] /= counts[counts > 0, None]
+    
+    elif reducer in ['max', 'min']:
+        dtypeinfo = np.finfo if np.issubdtype(values.dtype, np.floating) else np.iinfo
+        initval = dtypeinfo(values.dtype).min if reducer == 'max' else dtypeinfo(values.dtype).max
+        raster = np.full((height * width, values.shape[1]), initval, dtype=values.dtype)
+        ufunc = np.maximum if reducer == 'max' else np.minimum
+        ufunc.at(raster, cellids, values)
+    
+    else:
+        raster = np.zeros((height * width, values.shape[1]), dtype=values.dtype)
+        # the last point of each cell is the first one in the reversed order
+        uniquecells, lastpos = np.unique(cellids[::-1], return_index=True)
+        raster[uniquecells] = values[len(cellids) - 1 - lastpos]
+    
+    raster[counts == 0] = fill
+    
+    return np.moveaxis(raster, 1, 0).reshape(values.shape[1], height, width)
+
+
 
 def coordinates_fromtransform(transform, imgsize):
     """Create a longitude, latitude meshgrid based on the spatial affine.
@@ -420,19 +547,10 @@ def coordinates_fromtransform(transform, imgsize):
     Returns:
         _type_: coordinates list in columns and rows
     """
-    # All rows and columns
-    rows, cols = np.meshgrid(np.arange(imgsize[0]), np.arange(imgsize[1]))
-
-    # Get affine transform for pixel centres
-    T1 = transform * Affine.translation(0, 0)
-    # Function to convert pixel row/column index (from 0) to easting/northing at centre
-    rc2en = lambda r, c: T1 *(c, r) 
-
-    # All east and north (there is probably a faster way to do this)
-    rows, cols = np.vectorize(rc2en,
-                                       otypes=[np.float64,
-                                               np.float64])(rows, cols)
-    return [cols, rows]
+    # upper left corners, the meshgrids are returned as width x height
+    xvalues, yvalues = affine_meshgrid(transform, imgsize, offset = 0)
+    
+    return [yvalues.T, xvalues.T]
 
 
 def list_tif_2xarray(listraster:List[np.ndarray], transform: Affine, 
@@ -540,10 +658,9 @@ def list_tif_2xarray(listraster:List[np.ndarray], transform: Affine,
         x = dimsvalues['x']
         multi_xarray = multi_xarray.assign_coords(dimsvalues)
     else:
-        y,x = coordinates_fromtransform(transform,
-                                     [height, width])
-        multi_xarray = multi_xarray.assign_coords(x=np.sort(np.unique(x)))
-        multi_xarray = multi_xarray.assign_coords(y=np.sort(np.unique(y)))
+        x, y = affine_coordinates(transform, [height, width], offset = 0, ascending = True)
+        multi_xarray = multi_xarray.assign_coords(x=x)
+        multi_xarray = multi_xarray.assign_coords(y=y)
 
     return multi_xarray
 
@@ -1273,9 +1390,12 @@ def resize_3dxarray(xrdata, new_size, bands = None,
         #image = Image.fromarray(xrdata[varnames[i]].values.copy())
         #imageres = image.resize((newx, newy), Image.BILINEAR)
         image = xrdata[varnames[i]].values.copy()
-        imageres = resize_2dimg(image, newx, newy, 
+        # opencv does not resize float16 images
+        imageres = resize_2dimg(image.astype(np.float32) if image.dtype == np.float16 else image, 
+                                newx, newy, 
                                 interpolation = interpolation, 
                                 flip = flip, blur = blur, kernelsize = kernelsize)
+        imageres = imageres.astype(image.dtype, copy = False)
 
         listnpdata.append(imageres)
 
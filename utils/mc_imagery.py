@@ -1,12 +1,21 @@
 from .data_processing import data_standarization
-from .general import MSVEGETATION_INDEX
+from .general import MSVEGETATION_INDEX, VEGETATION_INDEX, float_dtype
+from .raster_io import get_dataset, build_overviews
 import re
 import numpy as np
 import pickle
 import os
+import threading
+import rasterio
+from rasterio.windows import Window
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import ExitStack
 
 import pandas as pd
 
+from typing import Dict, List, Optional, Tuple
+
 
 def calculate_vi_fromarray(arraydata, variable_names,vi='ndvi', expression='(nir - green)/(nir + green)', label=None, navalues = None, overwrite = False):
     """
@@ -18,14 +27,14 @@ def calculate_vi_fromarray(arraydata, variable_names,vi='ndvi', expression='(nir
         vi (str, optional): which is the name of the vegetation index that the user want to calculate. Defaults to 'ndvi'.
         expression (str, optional): vegetation index equation that makes reference to the channel names. Defaults to '(nir - green)/(nir + green)'.
         label (str, optional): if the vegetation index will have another name. Defaults to None.
-        navalues (float, optional): numerical value which for non values. Defaults to None.
+        navalues (float, optional): numerical value which for non values, these pixels are masked as nan. Defaults to None.
         overwrite (bool, optional): if the vegetation index is inside of the current channel names would you like to still calculate de index. Defaults to False.
 
     Raises:
         ValueError: Raises an error if the equation variables names are not in the provided channels names
 
     Returns:
-        numpy array
+        numpy array: the index keeps the floating dtype of the data, integer data gives float32
     """
     
     if expression is None and vi in list(MSVEGETATION_INDEX.keys()):
@@ -51,17 +60,20 @@ def calculate_vi_fromarray(arraydata, variable_names,vi='ndvi', expression='(nir
     
     
     if vi not in variable_names or overwrite:
-
+        # float16 layers are computed in float32, integer layers are never promoted to float64
+        outdtype = float_dtype(arraydata.dtype)
+        computedtype = np.promote_types(outdtype, np.float32)
         for i, varname in enumerate(varnames):
             if varname in variable_names:
                 pos = [j for j in range(len(variable_names)) if variable_names[j] == varname][0]
 
-                varvalue = arraydata[pos]
-                if navalues:
-                    varvalue[varvalue == navalues] = np.nan
+                varvalue = arraydata[pos].astype(computedtype)
+                if navalues is not None and not np.isnan(navalues):
+                    varvalue[arraydata[pos] == navalues] = np.nan
                 listvar.append(varvalue)
         
         vidata = eval(expression)
+        vidata = vidata if vidata.dtype == outdtype else vidata.astype(outdtype)
             
         if label is None:
             label = vi
@@ -74,6 +86,117 @@ def calculate_vi_fromarray(arraydata, variable_names,vi='ndvi', expression='(nir
     return vidata, label
 
 
+def _vi_expression(vi, variable_names, expressions = None):
+    """vegetation index equation, given by the user or the first default equation whose 
+    channels are available"""
+    if expressions is not None and vi in expressions:
+        return expressions[vi]
+    
+    for vidict in [VEGETATION_INDEX, MSVEGETATION_INDEX]:
+        if vi in vidict:
+            varnames = re.findall(r'[a-zA-Z_]+', vidict[vi])
+            if all(varname in variable_names for varname in varnames):
+                return vidict[vi]
+    
+    raise ValueError('please provide a equation to calculate this index: {}'.format(vi))
+
+
+def _block_windows(width, height, blocksize):
+    return [Window(col, row, min(blocksize, width - col), min(blocksize, height - row))
+            for row in range(0, height, blocksize) for col in range(0, width, blocksize)]
+
+
+def calculate_vi_blockwise(sources: List[Tuple[str, int]], variable_names: List[str], vilist: List[str], 
+                           fn: str, expressions: Optional[Dict[str, str]] = None, nworkers: int = 4,
+                           blocksize: int = 512, compress: str = 'deflate', overviews: bool = False):
+    """
+    Function to calculate vegetation indices over a whole orthomosaic without loading it. The 
+    bands are read block by block by a pool of threads, the indices of each block are evaluated
+    in float32 and written directly into a tiled GeoTIFF, only a few blocks are in memory.
+
+    Args:
+        sources (list): (file path, band index) of each channel, all the files must share the same grid
+        variable_names (list): channel names used in the equations
+        vilist (list): vegetation indices to calculate, one output band per index
+        fn (str): output GeoTIFF file path
+        expressions (dict, optional): equation of each index, by default they are taken from VEGETATION_INDEX or MSVEGETATION_INDEX. Defaults to None.
+        nworkers (int, optional): number of threads that read and compute the blocks. Defaults to 4.
+        blocksize (int, optional): block size in pixels, it is also the output tile size. Defaults to 512.
+        compress (str, optional): output compression. Defaults to 'deflate'.
+        overviews (bool, optional): build the output overviews once it is written. Defaults to False.
+
+    Raises:
+        ValueError: Raises an error if the source files do not share the same grid
+
+    Returns:
+        str: output file path
+    """
+    
+    vilist = [vilist] if isinstance(vilist, str) else list(vilist)
+    viexpressions = [_vi_expression(vi, variable_names, expressions) for vi in vilist]
+    
+    with get_dataset(sources[0][0]) as ref:
+        crs, transform, (height, width) = ref.crs, ref.transform, ref.shape
+    for path, _ in sources:
+        with get_dataset(path) as src:
+            if src.transform != transform or src.shape != (height, width):
+                raise ValueError('the file {} does not share the grid of {}'.format(path, sources[0][0]))
+    
+    profile = dict(driver = 'GTiff', count = len(vilist), height = height, width = width,
+                   dtype = 'float32', crs = crs, transform = transform, nodata = np.nan,
+                   tiled = True, blockxsize = blocksize, blockysize = blocksize,
+                   compress = compress, predictor = 3, num_threads = nworkers, bigtiff = 'IF_SAFER')
+    
+    workerdata = threading.local()
+    leases = ExitStack()
+    leaseslock = threading.Lock()
+    
+    def worker_datasets():
+        # every thread leases its own datasets the first time and keeps them until the end
+        if not hasattr(workerdata, 'srcs'):
+            with leaseslock:
+                workerdata.srcs = {path: leases.enter_context(get_dataset(path)) 
+                                   for path in dict.fromkeys(path for path, _ in sources)}
+        return workerdata.srcs
+    
+    def compute_block(window):
+        srcs = worker_datasets()
+        channels = []
+        for path, idx in sources:
+            img = srcs[path].read(idx, window = window).astype(np.float32)
+            if srcs[path].nodata is not None:
+                img[img == srcs[path].nodata] = np.nan
+            channels.append(img)
+        channels = np.stack(channels)
+        
+        return [calculate_vi_fromarray(channels, variable_names, vi = vi, expression = expression, 
+                                       overwrite = True)[0]
+                for vi, expression in zip(vilist, viexpressions)]
+    
+    # the executor is shut down before the leases are returned
+    with rasterio.open(fn, 'w', **profile) as dst, leases, ThreadPoolExecutor(max_workers = nworkers) as executor:
+        for i, vi in enumerate(vilist):
+            dst.set_band_description(i + 1, vi)
+        
+        def write_block(window, future):
+            for i, vidata in enumerate(future.result()):
+                dst.write(vidata.astype(np.float32, copy = False), i + 1, window = window)
+        
+        # the blocks are written in order by this thread, at most 2 x nworkers are kept in memory
+        pending = deque()
+        for window in _block_windows(width, height, blocksize):
+            pending.append((window, executor.submit(compute_block, window)))
+            if len(pending) >= 2 * nworkers:
+                write_block(*pending.popleft())
+        while pending:
+            write_block(*pending.popleft())
+    
+    if overviews:
+        build_overviews(fn)
+    
+    return fn
+
+
 def get_data_from_dict(data, onlythesechannels = None):
             
         dataasarray = []
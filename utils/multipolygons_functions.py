@@ -13,14 +13,14 @@ import concurrent.futures as cf
 from .data_processing import find_date_instring
 from .gis_functions import clip_xarraydata, resample_xarray, register_xarray,find_shift_between2xarray
 from .xr_functions import stack_as4dxarray,CustomXarray, from_dict_toxarray,from_xarray_to_dict
-from .xyz_functions import CloudPoints
+from .xyz_functions import CloudPoints, extract_cloudpoints_perpolygon
 from .xyz_functions import get_baseline_altitude
 from .gis_functions import impute_4dxarray,xarray_imputation,hist_ndxarrayequalization
 from .xyz_functions import calculate_leaf_angle
 from .drone_data import calculate_vi_fromxarray
 
 from .drone_data import DroneData
-from .general import MSVEGETATION_INDEX
+from .general import MSVEGETATION_INDEX, apply_dtype_policy
 
 from typing import List, Optional, Union, Any
 
@@ -217,7 +217,8 @@ def stack_multisource_data(roi,ms_data: Optional[DroneData] = None,
                            pointclouddata: Optional[xarray.DataArray] = None, 
                            bufferdef: Optional[float] = None, 
                            rgb_asreference: bool = True, 
-                           resamplemethod: str = 'nearest'):
+                           resamplemethod: str = 'nearest',
+                           dtype_policy: str = 'float32'):
     
     """
     Stacks multiple UAV source data (Multispectral, RGB, Point Cloud) into a single dataset.
@@ -238,6 +239,8 @@ def stack_multisource_data(roi,ms_data: Optional[DroneData] = None,
         Use RGB data as the reference for alignment if True.
     resamplemethod : str, optional
         Method for resampling ({"linear", "nearest", "zero", "slinear", "quadratic", "cubic", "polynomial"}, default: "nearest").
+    dtype_policy : str, optional
+        dtype of the stacked layers, 'native', 'float32' or 'float16'. Defaults to 'float32'.
 
     Returns:
     -------
@@ -300,6 +303,8 @@ def stack_multisource_data(roi,ms_data: Optional[DroneData] = None,
 
     if len(imagelist)>0:
         output = imagelist[0] if len(imagelist) == 1 else xarray.merge(imagelist)
+        for varname in list(output.keys()):
+            output[varname] = output[varname].copy(data = apply_dtype_policy(output[varname].data, dtype_policy))
         output.attrs['count'] =len(list(output.keys()))
     else:
         output = None
@@ -329,6 +334,7 @@ class IndividualUAVData(object):
                  rgb_bands = None,
                  ms_bands = None,
                  buffer = 0.6,
+                 dtype_policy: str = 'float32',
         ):
         
         """
@@ -350,6 +356,8 @@ class IndividualUAVData(object):
             Names of multispectral channels.
         buffer : float, optional
             Buffer value for image processing during stacking.
+        dtype_policy : str, optional
+            dtype of the image layers from reading to stacking, 'native', 'float32' or 'float16'.
 
         Notes:
         -----
@@ -359,6 +367,7 @@ class IndividualUAVData(object):
         """
         self.rgb_bands = rgb_bands
         self.ms_bands = ms_bands
+        self.dtype_policy = dtype_policy
 
         self.uav_sources = {'rgb': None,
                             'ms': None,
@@ -465,7 +474,8 @@ class IndividualUAVData(object):
                                 rgb_data = rgb, 
                                 pointclouddata = pointcloud, 
                                 bufferdef = bufferdef, rgb_asreference = rgb_asreference,
-                                resamplemethod = resample_method)
+                                resamplemethod = resample_method,
+                                dtype_policy = self.dtype_policy)
 
         self.uav_sources.update({'stacked':img_stacked})
 
@@ -490,7 +500,7 @@ class IndividualUAVData(object):
             self.rgb_path, 
             bounds = self._boundaries_buffer.copy(), 
             multiband_image=True, 
-            bands = self.rgb_bands, **kwargs)
+            bands = self.rgb_bands, dtype_policy = self.dtype_policy, **kwargs)
         self.uav_sources.update({'rgb':rgb_data})
         self._fnsuffix = self._fnsuffix+ 'rgb'
 
@@ -510,12 +520,13 @@ class IndividualUAVData(object):
 
         ms_data = _set_dronedata(self.ms_input, 
                     bounds = self._boundaries_buffer.copy(),
-                    multiband_image=False, bands = self.ms_bands, **kwargs)
+                    multiband_image=False, bands = self.ms_bands, 
+                    dtype_policy = self.dtype_policy, **kwargs)
 
         self.uav_sources.update({'ms':ms_data})
         self._fnsuffix = self._fnsuffix+ 'ms'
 
-    def pointcloud(self, interpolate = True, **kwargs):
+    def pointcloud(self, interpolate = True, cloud_points = None, **kwargs):
         """
         Processes and stores point cloud data.
 
@@ -523,6 +534,8 @@ class IndividualUAVData(object):
         ----------
         interpolate : bool, optional
             Whether to interpolate point cloud data.
+        cloud_points : pd.DataFrame, optional
+            Points already extracted for the buffered boundaries, if given the XYZ file is not read.
 
         Raises:
         ------
@@ -534,7 +547,7 @@ class IndividualUAVData(object):
         None
         """
         try:
-            if os.path.exists(self.threed_input):
+            if cloud_points is not None or os.path.exists(self.threed_input):
                 buffertmp = self._boundaries_buffer.copy().reset_index()
                 buffertmp = buffertmp[0] if type(buffertmp) == tuple else buffertmp
                 if 0 in buffertmp.columns:
@@ -543,7 +556,8 @@ class IndividualUAVData(object):
                 pcloud_data = CloudPoints(self.threed_input,
                                 #gpdpolygon= self.spatial_boundaries.copy(), 
                                 gpdpolygon=buffertmp,
-                                verbose = False)
+                                verbose = False,
+                                cloud_points = None if cloud_points is None else [cloud_points])
                 pcloud_data.to_xarray(interpolate = interpolate,**kwargs)
                 self._fnsuffix = self._fnsuffix+ 'pointcloud'
         except:
@@ -634,7 +648,10 @@ def extract_uav_datausing_geometry(rgbpath: Optional[str] = None,
                                    buffer: int = 0,
                                    processing_buffer: float = 0, 
                                    interpolate_pc: bool = True, 
-                                   rgb_asreference: bool = True):
+                                   rgb_asreference: bool = True,
+                                   pcdata = None,
+                                   dtype_policy: str = 'float32',
+                                   mosaic: bool = False):
     
     """
     Extracts UAV data using provided paths and geometry information.
@@ -650,6 +667,9 @@ def extract_uav_datausing_geometry(rgbpath: Optional[str] = None,
         processing_buffer (int, optional): Processing buffer size. Defaults to 0.
         interpolate_pc (bool, optional): Flag to interpolate point cloud data. Defaults to True.
         rgb_as_reference (bool, optional): Flag to use RGB as reference. Defaults to True.
+        pcdata (pd.DataFrame, optional): Points already extracted for the geometry. Defaults to None.
+        dtype_policy (str, optional): dtype of the layers, 'native', 'float32' or 'float16'. Defaults to 'float32'.
+        mosaic (bool, optional): The RGB and MS paths contain several GeoTIFF tiles that are read as a virtual mosaic. Defaults to False.
 
     Returns:
         Any: Information extracted from UAV data.
@@ -660,14 +680,15 @@ def extract_uav_datausing_geometry(rgbpath: Optional[str] = None,
                     pcpath, 
                     geometry, 
                     rgb_channels, 
-                    mschannels, buffer = processing_buffer)
+                    mschannels, buffer = processing_buffer,
+                    dtype_policy = dtype_policy)
     
     if rgbpath is not None:
-        uavdata.rgb_uavdata()
+        uavdata.rgb_uavdata(mosaic = mosaic)
     if mspath is not None:
-        uavdata.ms_uavdata()
-    if pcpath is not None:
-        uavdata.pointcloud(interpolate = interpolate_pc)
+        uavdata.ms_uavdata(mosaic = mosaic)
+    if pcpath is not None or pcdata is not None:
+        uavdata.pointcloud(interpolate = interpolate_pc, cloud_points = pcdata)
         
     xrinfo = uavdata.stack_uav_data(bufferdef = buffer, 
         rgb_asreference = rgb_asreference,resample_method = 'nearest')
@@ -701,6 +722,8 @@ class MultiMLTImages(CustomXarray):
                 ms_channels: Optional[List[str]]=None, 
                 path: str = None,
                 processing_buffer: float=0.6,
+                dtype_policy: str = 'float32',
+                mosaic: bool = False,
                 **kwargs):
         
         """
@@ -719,6 +742,8 @@ class MultiMLTImages(CustomXarray):
             ms_channels (list, optional): Names of the channels in the multispectral data.
             path (str, optional): Path to a directory where customdict xarray files are stored as pickle files.
             processing_buffer (float, optional): Buffer value (in meters) used during image processing to handle edge effects.
+            dtype_policy (str, optional): dtype of the data cube layers, 'native', 'float32' or 'float16'. Defaults to 'float32'.
+            mosaic (bool, optional): Each RGB and MS path contains several GeoTIFF tiles that are read as a virtual mosaic, only the tiles that intersect each geometry are read. Defaults to False.
             **kwargs: Additional keyword arguments to be passed to the parent class (CustomXarray).
 
         Raises:
@@ -735,15 +760,26 @@ class MultiMLTImages(CustomXarray):
         self.ms_paths = ms_paths
         self.pointcloud_paths = pointcloud_paths
         self.processing_buffer = processing_buffer
+        self.dtype_policy = dtype_policy
+        self.mosaic = mosaic
         self.rgb_channels = rgb_channels
         self.ms_channels = ms_channels
         self.path = path
+        self.pointclouds = {}
         super().__init__(**kwargs)
         if spatial_file is not None and not os.path.exists(spatial_file):
             raise FileNotFoundError(f"Spatial file not found: {spatial_file}")
 
         self.geometries = gpd.read_file(spatial_file) if spatial_file is not None else None
             
+    def __getstate__(self):
+        """
+        The extracted point clouds are not pickled when the methods are sent to worker 
+        processes, each task receives only the points of its geometry.
+        """
+        state = self.__dict__.copy()
+        state['pointclouds'] = {}
+        return state
     
     @property
     def listcxfiles(self):
@@ -849,7 +885,9 @@ class MultiMLTImages(CustomXarray):
             with cf.ProcessPoolExecutor(max_workers=njobs) as executor:
             
                 futures = {executor.submit(self._export_individual_data, 
-                                           j, path, fns[j], **kwargs) for j in geometries_range}
+                                           j, path, fns[j], 
+                                           pointclouds = self._geometry_pointclouds(j), 
+                                           **kwargs) for j in geometries_range}
                 
                 for future in cf.as_completed(futures):
                     try:
@@ -858,12 +896,33 @@ class MultiMLTImages(CustomXarray):
                         print(f"A task generated an exception: {exc}")
                         raise
         
-    def _time_pointsextraction(self,tp:int):
+    def _geometry_pointclouds(self, geometry_id: int):
+        """
+        Points of a geometry at each time point extracted with extract_pointclouds.
+
+        Args:
+            geometry_id (int): Index of the geometry.
+
+        Returns:
+            dict: Time point and the points of the geometry.
+        """
+        
+        pointclouds = {}
+        for tp, pcdata in self.pointclouds.items():
+            if pcdata.get(geometry_id) is None:
+                raise ValueError('there are no points for geometry {} at time point {}'.format(
+                    geometry_id, tp))
+            pointclouds[tp] = pcdata[geometry_id]
+        
+        return pointclouds
+    
+    def _time_pointsextraction(self,tp:int, pcdata = None):
         """
         Extracts data for a specific time point.
 
         Args:
             tp (int): Time point index.
+            pcdata (optional): Points of the geometry, the point cloud file is read when it is None.
 
         Returns:
             DataArray: Data extracted at the specified time point.
@@ -881,14 +940,47 @@ class MultiMLTImages(CustomXarray):
                         self.ms_channels, 
                         buffer= self._buffer,
                         processing_buffer = self.processing_buffer,
-                        interpolate_pc = self._interpolate_pc, rgb_asreference = self._rgb_asreference)
+                        interpolate_pc = self._interpolate_pc, rgb_asreference = self._rgb_asreference,
+                        pcdata = pcdata, dtype_policy = self.dtype_policy, mosaic = self.mosaic)
+    
+    def extract_pointclouds(self, timepoints: Optional[List[int]] = None, chunksize: int = 1000000,
+                            binary_cache: bool = False, verbose: bool = False):
+        """
+        Extracts the point cloud data of all geometries reading each point cloud only once.
+
+        The points are kept in memory (self.pointclouds) and individual_data uses them instead of 
+        reading the XYZ files again for every geometry.
+
+        Args:
+            timepoints (List[int], optional): Time points to extract. Defaults to all of them.
+            chunksize (int, optional): Number of points read at a time. Defaults to 1000000.
+            binary_cache (bool, optional): Read the points from the XYZ binary stores. Defaults to False.
+            verbose (bool, optional): Whether to display a progress bar.
+
+        Returns:
+            dict: Time point and the points of each geometry.
+        """
+        
+        timepoints = range(len(self.pointcloud_paths)) if timepoints is None else timepoints
+        geometries = self.geometries.geometry.buffer(self.processing_buffer, join_style=2)
         
+        for tp in timepoints:
+            if verbose:
+                print(self.pointcloud_paths[tp])
+            self.pointclouds[tp] = extract_cloudpoints_perpolygon(self.pointcloud_paths[tp], 
+                                                                  geometries,
+                                                                  chunksize = chunksize,
+                                                                  binary_cache = binary_cache,
+                                                                  verbose = verbose)
+        
+        return self.pointclouds
+    
 
     def individual_data(self,  geometry_id, interpolate_pc = True,
                         rgb_asreference = True, 
                         datesnames = None,
                         buffer = None,
-                        paralleltimepoints = False, njobs = None):
+                        paralleltimepoints = False, njobs = None, pointclouds = None):
         """
         Extracts data for an individual geometry.
 
@@ -900,6 +992,7 @@ class MultiMLTImages(CustomXarray):
             buffer (float, optional): Buffer value for geometry extraction. Defaults to None.
             paralleltimepoints (bool, optional): Whether to process time points in parallel. Defaults to False.
             njobs (int, optional): Number of parallel jobs. Defaults to None.
+            pointclouds (dict, optional): Points of the geometry per time point. Defaults to the points extracted with extract_pointclouds.
 
         Returns:
             DataArray: Extracted data for the individual geometry.
@@ -911,6 +1004,8 @@ class MultiMLTImages(CustomXarray):
 
         datalist = []
         self._tmproi,self._buffer,self._rgb_asreference,self._interpolate_pc =  roi, buffer,rgb_asreference,interpolate_pc
+        if pointclouds is None:
+            pointclouds = self._geometry_pointclouds(geometry_id)
         
         if paralleltimepoints:
             if njobs is None:
@@ -920,13 +1015,13 @@ class MultiMLTImages(CustomXarray):
             with cf.ProcessPoolExecutor(max_workers=njobs) as executor:
                 for i in range(len(self.rgb_paths)):
                     results.append(executor.submit(self._time_pointsextraction, 
-                                                    i))
+                                                    i, pointclouds.get(i)))
             #print(results)
             datalist = [future.result() for future in results]
                     
         else:
             for i in range(len(self.rgb_paths)):
-                datalist.append(self._time_pointsextraction(i))
+                datalist.append(self._time_pointsextraction(i, pointclouds.get(i)))
         
         if len(datalist)>1:
             if datesnames is None:
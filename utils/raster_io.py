@@ -0,0 +1,804 @@
+import atexit
+import glob
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+
+import numpy as np
+import rasterio
+import rioxarray as rio
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.env import set_gdal_config
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.mask import raster_geometry_mask
+from rasterio.merge import merge
+from rasterio.shutil import copy as rio_copy
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import bounds as window_bounds
+from shapely.geometry import box, shape
+from shapely.strtree import STRtree
+
+from typing import List, Optional
+
+COG_COMPRESSIONS = ['deflate', 'zstd', 'lzw']
+
+# process-local pool of open datasets, keyed by path and thread
+_DATASET_POOL = OrderedDict()
+_DATASET_POOL_LOCK = threading.Lock()
+_DATASET_POOL_SETTINGS = {'maxsize': 32, 'pid': None}
+# reader threads are kept alive between reads, so their pooled handles are reused
+_READER_POOLS = {}
+
+
+def configure_dataset_pool(maxsize: Optional[int] = None, gdal_cachemax: Optional[int] = None):
+    """
+    Configures the pool of open raster datasets of the current process. It can be used as
+    the initializer of a ProcessPoolExecutor so every worker gets the same settings.
+
+    Parameters:
+    ----------
+    maxsize : int, optional
+        Maximum number of open datasets, the least recently used that are not leased are
+        closed first.
+    gdal_cachemax : int, optional
+        Size of the GDAL block cache in MB (GDAL_CACHEMAX), set it before reading any raster.
+    """
+    if maxsize is not None:
+        _DATASET_POOL_SETTINGS['maxsize'] = maxsize
+        with _DATASET_POOL_LOCK:
+            _trim_dataset_pool()
+    if gdal_cachemax is not None:
+        set_gdal_config('GDAL_CACHEMAX', int(gdal_cachemax))
+
+
+class _PooledDataset:
+    """
+    Open dataset of the pool and the number of active leases on it. A dataset is only
+    closed when nobody is using it.
+    """
+
+    def __init__(self, src, mtime):
+        self.src = src
+        self.mtime = mtime
+        self.users = 0
+        self.retired = False
+
+    def retire(self):
+        # the dataset leaves the pool, it is closed by its last user
+        self.retired = True
+        if self.users == 0:
+            self.src.close()
+
+
+def _trim_dataset_pool():
+    # only the least recently used datasets without active leases are closed, so the pool
+    # may temporarily hold more than maxsize datasets
+    excess = len(_DATASET_POOL) - max(_DATASET_POOL_SETTINGS['maxsize'], 1)
+    if excess <= 0:
+        return
+    idle = [key for key, entry in _DATASET_POOL.items() if entry.users == 0]
+    for key in idle[:excess]:
+        _DATASET_POOL.pop(key).retire()
+
+
+def _lease_dataset(path: str) -> _PooledDataset:
+    with _DATASET_POOL_LOCK:
+        if _DATASET_POOL_SETTINGS['pid'] != os.getpid():
+            # handles inherited from the parent process must not be used nor closed
+            _DATASET_POOL.clear()
+            _DATASET_POOL_SETTINGS['pid'] = os.getpid()
+
+        key = (os.path.abspath(path), threading.get_ident())
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        entry = _DATASET_POOL.pop(key, None)
+        if entry is not None and (entry.src.closed or entry.mtime != mtime):
+            entry.retire()
+            entry = None
+        if entry is None:
+            entry = _PooledDataset(rasterio.open(path), mtime)
+
+        entry.users += 1
+        _DATASET_POOL[key] = entry
+        _trim_dataset_pool()
+
+    return entry
+
+
+def _return_dataset(entry: _PooledDataset):
+    with _DATASET_POOL_LOCK:
+        entry.users -= 1
+        if entry.retired:
+            if entry.users == 0:
+                entry.src.close()
+        else:
+            _trim_dataset_pool()
+
+
+@contextmanager
+def get_dataset(path: str):
+    """
+    Leases an open rasterio dataset from the pool, opening it only the first time. The
+    handles are kept per thread and are discarded in forked processes, so they are never
+    shared. A leased dataset is not closed by the pool until the with block ends, do not
+    keep it after that.
+
+    Parameters:
+    ----------
+    path : str
+        Raster file path.
+
+    Yields:
+    ------
+    rasterio.io.DatasetReader
+        Open dataset.
+    """
+    entry = _lease_dataset(path)
+    try:
+        yield entry.src
+    finally:
+        _return_dataset(entry)
+
+
+def release_datasets(path: Optional[str] = None):
+    """
+    Removes the datasets of a file, or all of them when path is None, from the pool. The
+    idle ones are closed now and the leased ones when their lease ends.
+    """
+    with _DATASET_POOL_LOCK:
+        for key in list(_DATASET_POOL.keys()):
+            if path is None or key[0] == os.path.abspath(path):
+                _DATASET_POOL.pop(key).retire()
+
+
+def build_overviews(path: str, factors: Optional[List[int]] = None, resampling: str = 'average',
+                    minsize: int = 256, force: bool = False) -> List[int]:
+    """
+    Builds the internal overviews of a raster file that does not have them, files that
+    already have overviews are not modified unless force is True.
+
+    Parameters:
+    ----------
+    path : str
+        Raster file path, it is modified in place.
+    factors : List[int], optional
+        Decimation factors. Defaults to powers of 2 until the overview is smaller than minsize.
+    resampling : str, optional
+        Resampling method name, e.g. 'average', 'nearest' or 'bilinear'.
+    minsize : int, optional
+        Size in pixels of the smallest overview when the factors are not given.
+    force : bool, optional
+        Rebuild the overviews when the file already has them.
+
+    Returns:
+    -------
+    List[int]
+        Decimation factors of the overviews.
+    """
+
+    with get_dataset(path) as src:
+        existing = src.overviews(1)
+    if len(existing) > 0 and not force:
+        return existing
+
+    release_datasets(path)
+    with rasterio.open(path, 'r+') as src:
+        if factors is None:
+            factors = []
+            while max(src.width, src.height) / 2**(len(factors)) > minsize:
+                factors.append(2**(len(factors) + 1))
+        if len(factors) > 0:
+            src.build_overviews(factors, Resampling[resampling])
+            src.update_tags(ns = 'rio_overview', resampling = resampling)
+
+    return factors
+
+
+def native_dtype(imgs, dtype: Optional[str] = None, nodata: Optional[float] = None) -> np.dtype:
+    """
+    Smallest dtype to write an image stack without losing information. The source dtype is
+    kept when every valid value is an integer inside its range (nan pixels become nodata),
+    otherwise the dtype of the arrays is used.
+
+    Parameters:
+    ----------
+    imgs : numpy.ndarray or list of numpy.ndarray
+        Image stack (C x H x W) or list of bands (H x W), checked band by band.
+    dtype : str, optional
+        Source dtype, e.g. the 'dtype' attribute of the DroneData xarray.
+    nodata : float, optional
+        Value that will replace the nan pixels.
+
+    Returns:
+    -------
+    numpy.dtype
+    """
+    arraydtype = np.result_type(*imgs) if isinstance(imgs, (list, tuple)) else np.dtype(imgs.dtype)
+    if dtype is None or np.dtype(dtype) == arraydtype:
+        return arraydtype
+
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.integer) or not np.issubdtype(arraydtype, np.floating):
+        return np.promote_types(dtype, arraydtype)
+
+    info = np.iinfo(dtype)
+    if nodata is not None and not (np.isnan(nodata) or info.min <= nodata <= info.max):
+        return arraydtype
+    for band in imgs:
+        if np.all(np.isnan(band)):
+            continue
+        if np.nanmin(band) < info.min or np.nanmax(band) > info.max:
+            return arraydtype
+        with np.errstate(invalid = 'ignore'):
+            fits = band.astype(dtype) == band
+        fits |= np.isnan(band)
+        if not fits.all():
+            return arraydtype
+
+    return dtype
+
+
+def write_cog(path: str, imgs, transform, crs = None, nodata: Optional[float] = None,
+              dtype: Optional[str] = None, band_names: Optional[List[str]] = None,
+              compress: str = 'deflate', predictor: Optional[int] = None, blocksize: int = 512,
+              overviews: bool = True, resampling: str = 'average', num_threads = 'ALL_CPUS'):
+    """
+    Writes an image stack as a Cloud Optimized GeoTIFF: internal tiles, compression with
+    predictor and internal overviews placed before the full resolution data, so windowed
+    and decimated reads only fetch the blocks they need. The bands are written one by one
+    to a temporary tiled GeoTIFF next to the output, where the overviews are built, and
+    it is then copied with the GDAL COG driver (GTiff with the source overviews on GDAL
+    versions without it), so the image is never duplicated in memory.
+
+    Parameters:
+    ----------
+    path : str
+        Output file path.
+    imgs : numpy.ndarray or list of numpy.ndarray
+        Image stack (C x H x W), a single band (H x W) or a list of bands, which avoids
+        stacking them in a new array.
+    transform : Affine
+        Affine transformation of the image.
+    crs : optional
+        Coordinate reference system.
+    nodata : float, optional
+        Nodata value, the nan pixels are written with it when the output dtype is integer.
+    dtype : str, optional
+        Output dtype. Defaults to the arrays dtype.
+    band_names : List[str], optional
+        Band descriptions.
+    compress : str, optional
+        'deflate', 'zstd' or 'lzw'.
+    predictor : int, optional
+        TIFF predictor, 1 none, 2 horizontal and 3 floating point. Defaults to 2 for
+        integers and 3 for floats.
+    blocksize : int, optional
+        Size in pixels of the internal tiles.
+    overviews : bool, optional
+        Build the internal overviews, down to the block size.
+    resampling : str, optional
+        Resampling method of the overviews.
+    num_threads : int or str, optional
+        Threads used by GDAL to compress the tiles.
+    """
+    if compress.lower() not in COG_COMPRESSIONS:
+        raise ValueError(f"Unsupported compression: {compress}, use one of {COG_COMPRESSIONS}")
+
+    if isinstance(imgs, (list, tuple)):
+        imgs = [np.asarray(band) for band in imgs]
+        arraydtype = np.result_type(*imgs)
+    else:
+        imgs = np.asarray(imgs)
+        imgs = imgs[np.newaxis] if imgs.ndim == 2 else imgs
+        arraydtype = imgs.dtype
+    dtype = np.dtype(arraydtype if dtype is None else dtype)
+    fillnan = np.issubdtype(dtype, np.integer) and np.issubdtype(arraydtype, np.floating)
+    if fillnan:
+        nodata = 0 if nodata is None or np.isnan(nodata) else nodata
+    if predictor is None:
+        predictor = 3 if np.issubdtype(dtype, np.floating) else 2
+
+    profile = dict(driver = 'GTiff', count = len(imgs), height = imgs[0].shape[0],
+                   width = imgs[0].shape[1], dtype = dtype.name, crs = crs,
+                   transform = transform, nodata = nodata, tiled = True,
+                   blockxsize = blocksize, blockysize = blocksize, bigtiff = 'IF_SAFER')
+
+    release_datasets(path)
+    tmpfile, tmppath = tempfile.mkstemp(suffix = '.tif', dir = os.path.dirname(os.path.abspath(path)))
+    os.close(tmpfile)
+    try:
+        with rasterio.open(tmppath, 'w', **profile) as tmp:
+            # one band at a time, only a band is converted in memory
+            for i, band in enumerate(imgs):
+                if fillnan:
+                    band = np.where(np.isnan(band), nodata, band)
+                tmp.write(band.astype(dtype, copy = False), i + 1)
+            if band_names is not None:
+                for i, name in enumerate(band_names):
+                    tmp.set_band_description(i + 1, str(name))
+            factors = []
+            while overviews and max(tmp.width, tmp.height) / 2**(len(factors)) > blocksize:
+                factors.append(2**(len(factors) + 1))
+            if len(factors) > 0:
+                tmp.build_overviews(factors, Resampling[resampling])
+
+        with rasterio.Env() as env:
+            cogdriver = 'COG' in env.drivers()
+        if cogdriver:
+            predictors = {1: 'NO', 2: 'STANDARD', 3: 'FLOATING_POINT'}
+            rio_copy(tmppath, path, driver = 'COG', blocksize = blocksize, 
+                     compress = compress.upper(), predictor = predictors[predictor],
+                     overviews = 'FORCE_USE_EXISTING' if len(factors) > 0 else 'NONE',
+                     num_threads = num_threads, bigtiff = 'IF_SAFER')
+        else:
+            # copying with the overviews of the source writes them ahead of the image data
+            rio_copy(tmppath, path, driver = 'GTiff', copy_src_overviews = True, tiled = True,
+                     blockxsize = blocksize, blockysize = blocksize, compress = compress.upper(),
+                     predictor = predictor, num_threads = num_threads, bigtiff = 'IF_SAFER')
+    finally:
+        os.remove(tmppath)
+
+
+def _decimation_factor(src, overview_level: Optional[int] = None,
+                       target_resolution: Optional[float] = None) -> float:
+    """
+    Decimation factor of a read given a target resolution or an overview level, when the
+    level does not exist in the file its power of 2 factor is used.
+    """
+    if target_resolution is not None:
+        return max(target_resolution / abs(src.res[0]), 1)
+
+    if overview_level is not None:
+        overviews = src.overviews(1)
+        return overviews[overview_level] if overview_level < len(overviews) else 2**(overview_level + 1)
+
+    return 1
+
+
+def _reader_pool(nworkers: int) -> ThreadPoolExecutor:
+    key = (os.getpid(), nworkers)
+    with _DATASET_POOL_LOCK:
+        if key not in _READER_POOLS:
+            _READER_POOLS[key] = ThreadPoolExecutor(max_workers = nworkers, 
+                                                    thread_name_prefix = 'raster_io')
+    return _READER_POOLS[key]
+
+
+def release_reader_pools():
+    """
+    Shuts down the reader threads of read_window_threaded, they are created again by the
+    next threaded read. It is called when the interpreter exits.
+    """
+    with _DATASET_POOL_LOCK:
+        pools = list(_READER_POOLS.values())
+        _READER_POOLS.clear()
+    for pool in pools:
+        pool.shutdown(wait = True)
+
+
+atexit.register(release_reader_pools)
+
+
+def _strip_windows(window: Window, blockheight: int, nstrips: int) -> List[Window]:
+    """
+    Splits a window in horizontal strips whose limits follow the file block rows, so every
+    block is decoded by a single strip.
+    """
+    rowoff, height = int(window.row_off), int(window.height)
+    nblocks = -(-height // blockheight)
+    stripheight = blockheight * max(-(-nblocks // max(nstrips, 1)), 1)
+    # the first limit is aligned to the block grid of the file
+    limits = [rowoff] + list(range((rowoff // stripheight + 1) * stripheight, rowoff + height, stripheight))
+    limits.append(rowoff + height)
+
+    return [Window(window.col_off, start, window.width, end - start)
+            for start, end in zip(limits[:-1], limits[1:])]
+
+
+def read_window_threaded(path: str, indexes: List[int], window: Window, masked: bool = False,
+                         nworkers: int = 4):
+    """
+    Reads a window of a raster with a pool of threads, each one decoding a strip of blocks
+    with its own leased dataset handle. GDAL releases the GIL while decompressing, so the
+    strips of compressed files can be decoded concurrently, the gain depends on the number
+    of cores and should be checked with benchmark_threaded_reads.
+
+    Parameters:
+    ----------
+    path : str
+        Raster file path.
+    indexes : List[int]
+        Bands to read (starting from 1).
+    window : Window
+        Window to read.
+    masked : bool, optional
+        Return a masked array with the nodata pixels masked.
+    nworkers : int, optional
+        Number of threads.
+
+    Returns:
+    -------
+    numpy.ndarray or numpy.ma.MaskedArray
+        Image stack (C x H x W).
+    """
+    with get_dataset(path) as src:
+        dtype = np.result_type(*[src.dtypes[idx - 1] for idx in indexes])
+        blockheight = src.block_shapes[0][0]
+    height, width = int(window.height), int(window.width)
+    img = np.empty((len(indexes), height, width), dtype = dtype)
+    mask = np.zeros(img.shape, dtype = bool) if masked else None
+    strips = _strip_windows(window, blockheight, nworkers * 4)
+
+    def read_strip(strip):
+        rows = slice(int(strip.row_off - window.row_off), int(strip.row_off - window.row_off + strip.height))
+        with get_dataset(path) as src:
+            data = src.read(indexes, window = strip, masked = masked)
+        img[:, rows] = np.ma.getdata(data)
+        if masked:
+            mask[:, rows] = np.ma.getmaskarray(data)
+
+    list(_reader_pool(nworkers).map(read_strip, strips))
+
+    return np.ma.MaskedArray(img, mask = mask) if masked else img
+
+
+def benchmark_threaded_reads(path: str, nworkers: List[int] = [1, 2, 4, 8], repeat: int = 3,
+                             indexes: Optional[List[int]] = None) -> dict:
+    """
+    Times the full read of a raster with a different number of threads, the block cache of
+    GDAL is disabled so every run decodes the file again. It only reports the measured 
+    times, a speedup below 1 means the threaded read is slower on this machine.
+
+    Parameters:
+    ----------
+    path : str
+        Raster file path, ideally a compressed and tiled multiband file.
+    nworkers : List[int], optional
+        Number of threads of each run, 1 is the sequential read.
+    repeat : int, optional
+        Times each read is repeated, the best time is kept.
+    indexes : List[int], optional
+        Bands to read. Defaults to all the bands.
+
+    Returns:
+    -------
+    dict
+        Best time in seconds and speedup over the first entry, per number of threads.
+    """
+    results = {}
+    with rasterio.Env(GDAL_CACHEMAX = 0):
+        release_datasets(path)
+        for workers in nworkers:
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                read_raster_bands(path, indexes = indexes, nworkers = workers)
+                times.append(time.perf_counter() - start)
+            results[workers] = {'seconds': min(times)}
+        release_datasets(path)
+
+    reference = results[nworkers[0]]['seconds']
+    for workers in nworkers:
+        results[workers]['speedup'] = reference / results[workers]['seconds']
+
+    return results
+
+
+def read_raster_bands(path: str, indexes: Optional[List[int]] = None, shapes: Optional[list] = None,
+                      fill_value: Optional[float] = None, dtype: Optional[str] = None,
+                      overview_level: Optional[int] = None, target_resolution: Optional[float] = None,
+                      resampling: str = 'nearest', nworkers: Optional[int] = None):
+    """
+    Reads several bands of a raster opening the file only once. When shapes are given, the
+    window that covers them is computed once and all the bands are read in a single windowed
+    call, then the shapes mask is applied to the whole stack.
+
+    Parameters:
+    ----------
+    path : str
+        Raster file path.
+    indexes : List[int], optional
+        Bands to read (starting from 1). Defaults to all the bands.
+    shapes : list, optional
+        GeoJSON-like geometries used to clip the raster.
+    fill_value : float, optional
+        Value assigned to the pixels outside the shapes or flagged as nodata. Defaults to
+        the raster nodata, or 0 if the raster does not have one.
+    dtype : str, optional
+        Output dtype, e.g. 'float' to fill with np.nan. Defaults to the raster dtype.
+    overview_level : int, optional
+        Read at the resolution of an overview level (0 is the first overview).
+    target_resolution : float, optional
+        Read at a coarser spatial resolution, in the units of the raster crs.
+    resampling : str, optional
+        Resampling method of the decimated reads.
+    nworkers : int, optional
+        Number of threads that decode the full resolution reads by strips of blocks, 
+        None or 1 reads sequentially.
+
+    Returns:
+    -------
+    tuple
+        Image stack (C x H x W), affine transform of the image and raster profile.
+    """
+
+    with get_dataset(path) as src:
+        profile = src.profile.copy()
+        indexes = list(range(1, src.count + 1)) if indexes is None else list(indexes)
+        factor = _decimation_factor(src, overview_level, target_resolution)
+        threaded = nworkers is not None and nworkers > 1 and factor == 1
+
+        if shapes is None and factor == 1:
+            img = (read_window_threaded(path, indexes, Window(0, 0, src.width, src.height), 
+                                        nworkers = nworkers) 
+                   if threaded else src.read(indexes))
+            img = img if dtype is None else img.astype(dtype)
+            return img, src.transform, profile
+
+        if shapes is None:
+            window, transform = Window(0, 0, src.width, src.height), src.transform
+        else:
+            shapemask, transform, window = raster_geometry_mask(src, shapes, crop=True)
+
+        if factor > 1:
+            # GDAL serves decimated reads from the internal overviews when they exist
+            outheight = max(int(round(window.height / factor)), 1)
+            outwidth = max(int(round(window.width / factor)), 1)
+            transform = transform * Affine.scale(window.width / outwidth, window.height / outheight)
+            img = src.read(indexes, window=window, masked=shapes is not None,
+                           out_shape=(len(indexes), outheight, outwidth),
+                           resampling=Resampling[resampling])
+            if shapes is None:
+                img = img if dtype is None else img.astype(dtype)
+                return img, transform, profile
+            shapemask = geometry_mask(shapes, (outheight, outwidth), transform)
+        elif threaded:
+            img = read_window_threaded(path, indexes, window, masked = True, nworkers = nworkers)
+        else:
+            img = src.read(indexes, window=window, masked=True)
+
+    if fill_value is None:
+        fill_value = profile['nodata'] if profile['nodata'] is not None else 0
+
+    outside = np.ma.getmaskarray(img) | shapemask[np.newaxis]
+    img = img.data if dtype is None else img.data.astype(dtype)
+    img[outside] = fill_value
+
+    return img, transform, profile
+
+
+def read_raster_bands_lazy(path: str, indexes: Optional[List[int]] = None, shapes: Optional[list] = None,
+                           fill_value: Optional[float] = None, dtype: Optional[str] = None,
+                           chunks = True, nworkers: Optional[int] = None):
+    """
+    Lazy version of read_raster_bands. The bands are returned as a dask array whose blocks
+    are read on demand through rasterio windows, by default the chunks are aligned to the
+    internal tiles of the file. Only the clip window and the shapes mask are computed when
+    it is called.
+
+    Parameters:
+    ----------
+    path : str
+        Raster file path.
+    indexes : List[int], optional
+        Bands to read (starting from 1). Defaults to all the bands.
+    shapes : list, optional
+        GeoJSON-like geometries used to clip the raster.
+    fill_value : float, optional
+        Value assigned to the pixels outside the shapes or flagged as nodata. Defaults to
+        the raster nodata, or 0 if the raster does not have one.
+    dtype : str, optional
+        Output dtype, e.g. 'float' to fill with np.nan. Defaults to the raster dtype.
+    chunks : bool, int, tuple or dict, optional
+        Dask chunks passed to rioxarray.open_rasterio, True uses the file block shape.
+    nworkers : int, optional
+        When it is larger than 1 the file is opened without the rasterio lock, so the dask
+        threads decode the chunks concurrently.
+
+    Returns:
+    -------
+    tuple
+        Dask image stack (C x H x W), affine transform of the image and raster profile.
+    """
+    try:
+        import dask.array as da
+    except ImportError as err:
+        raise ImportError("The lazy reading requires dask, install it with pip install dask") from err
+
+    with get_dataset(path) as src:
+        profile = src.profile.copy()
+        indexes = list(range(1, src.count + 1)) if indexes is None else list(indexes)
+        transform = src.transform
+        if shapes is not None:
+            shapemask, transform, window = raster_geometry_mask(src, shapes, crop=True)
+
+    lock = False if nworkers is not None and nworkers > 1 else None
+    img = rio.open_rasterio(path, chunks = chunks, lock = lock).data
+    img = img[[idx - 1 for idx in indexes]]
+    img = img if dtype is None else img.astype(dtype)
+    if shapes is None:
+        return img, transform, profile
+
+    rows, cols = [slice(int(slc.start), int(slc.stop)) for slc in window.toslices()]
+    img = img[:, rows, cols]
+
+    if fill_value is None:
+        fill_value = profile['nodata'] if profile['nodata'] is not None else 0
+
+    outside = da.from_array(shapemask, chunks = img.chunks[1:])[np.newaxis]
+    if profile['nodata'] is not None:
+        outside = outside | (img == profile['nodata'])
+
+    # the fill value takes the image dtype, as in the eager assignment
+    return da.where(outside, np.asarray(fill_value).astype(img.dtype), img), transform, profile
+
+
+class MosaicIndex:
+    """
+    Virtual mosaic over several GeoTIFF tiles of the same orthomosaic. The footprints of the
+    tiles are kept in a spatial index, so a read only opens and merges the tiles that 
+    intersect the requested area, without a pre-merged file.
+
+    Attributes
+    ----------
+    paths : List[str]
+        Tile file paths.
+    footprints : list
+        Tile bounding boxes as shapely polygons.
+    """
+
+    def __init__(self, paths: List[str]):
+        """
+        Initialize the MosaicIndex class.
+
+        Parameters:
+        ----------
+        paths : List[str]
+            Tile file paths, they must share the crs and the band layout.
+        """
+        if len(paths) == 0:
+            raise ValueError("The mosaic needs at least one file")
+
+        self.paths = list(paths)
+        self.footprints = []
+        crs = None
+        for path in self.paths:
+            with get_dataset(path) as src:
+                if crs is not None and src.crs != crs:
+                    raise ValueError(f"The file {path} does not share the mosaic crs {crs}")
+                crs = src.crs
+                self.footprints.append(box(*src.bounds))
+
+        self.crs = crs
+        self._tree = STRtree(self.footprints)
+
+    @classmethod
+    def from_directory(cls, path: str, pattern: str = '*.tif') -> 'MosaicIndex':
+        """
+        Builds the index with the tiles of a directory.
+        """
+        return cls(sorted(glob.glob(os.path.join(path, pattern))))
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def bounds(self) -> tuple:
+        """
+        Bounding box of the whole mosaic (min_x, min_y, max_x, max_y).
+        """
+        bounds = np.array([footprint.bounds for footprint in self.footprints])
+        return tuple(float(v) for v in np.concatenate([bounds[:, :2].min(axis=0), bounds[:, 2:].max(axis=0)]))
+
+    def query(self, geometry) -> List[str]:
+        """
+        Tiles that intersect a geometry, in the order they were given.
+
+        Parameters:
+        ----------
+        geometry : shapely geometry
+            Query area.
+
+        Returns:
+        -------
+        List[str]
+            Tile file paths.
+        """
+        ids = self._tree.query(geometry, predicate = 'intersects')
+        return [self.paths[i] for i in sorted(ids)]
+
+    def read(self, indexes: Optional[List[int]] = None, shapes: Optional[list] = None,
+             fill_value: Optional[float] = None, dtype: Optional[str] = None,
+             target_resolution: Optional[float] = None, overview_level: Optional[int] = None,
+             resampling: str = 'nearest', **kwargs):
+        """
+        Mosaic version of read_raster_bands. The tiles that intersect the shapes (or all of
+        them) are merged on the pixel grid of the first tile, then the shapes mask is applied.
+        Where the tiles overlap the first one in the list is kept.
+
+        Parameters:
+        ----------
+        indexes : List[int], optional
+            Bands to read (starting from 1). Defaults to all the bands.
+        shapes : list, optional
+            GeoJSON-like geometries used to clip the mosaic.
+        fill_value : float, optional
+            Value assigned to the pixels outside the shapes or flagged as nodata. Defaults to
+            the tiles nodata, or 0 if they do not have one.
+        dtype : str, optional
+            Output dtype, e.g. 'float' to fill with np.nan. Defaults to the tiles dtype.
+        target_resolution : float, optional
+            Read at a coarser spatial resolution, in the units of the crs.
+        overview_level : int, optional
+            Read at the resolution of an overview level of the first tile (0 is the first 
+            overview).
+        resampling : str, optional
+            Resampling method of the decimated reads.
+
+        Returns:
+        -------
+        tuple
+            Image stack (C x H x W), affine transform of the image and raster profile.
+        """
+        if shapes is None:
+            area = box(*self.bounds)
+        else:
+            bounds = np.array([shape(geom).bounds for geom in shapes])
+            area = box(*bounds[:, :2].min(axis=0), *bounds[:, 2:].max(axis=0))
+
+        paths = self.query(area)
+        if len(paths) == 0:
+            raise ValueError("The geometries do not intersect any tile of the mosaic")
+
+        # the tiles stay leased until they are merged, so none of them is closed by the pool
+        with ExitStack() as stack:
+            srcs = [stack.enter_context(get_dataset(path)) for path in paths]
+            ref = srcs[0]
+            profile = ref.profile.copy()
+            indexes = list(range(1, ref.count + 1)) if indexes is None else list(indexes)
+            nodata = profile['nodata']
+
+            # the requested window is computed on the pixel grid of the first tile, as in 
+            # read_raster_bands, and limited to the mosaic extent
+            extent = from_bounds(*self.bounds, transform = ref.transform)
+            window = Window(*[int(round(v)) for v in (extent.col_off, extent.row_off, 
+                                                      extent.width, extent.height)])
+            if shapes is not None:
+                window = geometry_window(ref, shapes, boundless = True).intersection(window)
+            factor = _decimation_factor(ref, overview_level, target_resolution)
+            res = (abs(ref.transform.a) * factor, abs(ref.transform.e) * factor)
+
+            img, transform = merge(srcs, bounds = window_bounds(window, ref.transform), res = res, 
+                                   indexes = indexes, nodata = nodata, 
+                                   resampling = Resampling[resampling])
+
+        if fill_value is None:
+            fill_value = nodata if nodata is not None else 0
+
+        outside = np.zeros(img.shape, dtype = bool) if nodata is None else img == nodata
+        if shapes is not None:
+            outside |= geometry_mask(shapes, img.shape[1:], transform)[np.newaxis]
+        img = img if dtype is None else img.astype(dtype)
+        img[outside] = fill_value
+
+        profile.update({'height': img.shape[1], 'width': img.shape[2], 
+                        'transform': transform, 'count': len(indexes)})
+
+        return img, transform, profile
+
+
+@lru_cache(maxsize=32)
+def _cached_mosaic(paths: tuple) -> MosaicIndex:
+    return MosaicIndex(list(paths))
+
+
+def get_mosaic_index(paths: List[str]) -> MosaicIndex:
+    """
+    Returns the MosaicIndex of a set of tiles, the index is built only once per process.
+    """
+    return _cached_mosaic(tuple(os.path.abspath(path) for path in paths))
@@ -24,6 +24,7 @@ from .gis_functions import (get_tiles, resize_3dxarray,
 from .image_functions import radial_filter, remove_smallpixels,transformto_cielab, transformto_hsv
 
 from .decorators import check_output_fn
+from .general import apply_dtype_policy
 from .data_processing import data_standarization, minmax_scale
 import json
 
@@ -150,7 +151,7 @@ def from_dict_toxarray(dictdata, dimsformat = 'DCHW'):
         
     return datar
 
-def from_xarray_to_dict(xrdata: xarray.Dataset) -> dict:
+def from_xarray_to_dict(xrdata: xarray.Dataset, dtype_policy: str = 'native') -> dict:
     """
     Transform spatial xarray data to a custom dictionary.
 
@@ -158,6 +159,8 @@ def from_xarray_to_dict(xrdata: xarray.Dataset) -> dict:
     -----------
     xrdata : xr.Dataset
         Input xarray dataset to be transformed.
+    dtype_policy : str, optional
+        dtype of the exported variables, 'native' keeps the layers dtype, 'float32' or 'float16'.
 
     Returns:
     --------
@@ -173,7 +176,7 @@ def from_xarray_to_dict(xrdata: xarray.Dataset) -> dict:
     variables = list(xrdata.keys())
     
     for feature in variables:
-        datadict['variables'][feature] = xrdata[feature].values
+        datadict['variables'][feature] = apply_dtype_policy(xrdata[feature].values, dtype_policy)
 
     for dim in xrdata.sizes.keys():
         if dim == 'date':
@@ -344,19 +347,23 @@ class CustomXarray(object):
                 data = data[0]
         return data
       
-    def export_as_dict(self, path: str, fn: str, asjson: bool = False,**kwargs):
+    def export_as_dict(self, path: str, fn: str, asjson: bool = False, dtype_policy: str = 'native', **kwargs):
         """Export data as a dictionary, either in pickle or JSON format.
 
         Args:
             path (str): Path to the export directory.
             fn (str): Filename for export.
             asjson (bool, optional): If True, export as JSON; otherwise, export as pickle.
+            dtype_policy (str, optional): dtype of the exported channels, 'native' keeps the data dtype, 'float32' or 'float16'.
 
         Returns:
             None
         """
         
         self._filetoexport = self.custom_dict
+        if dtype_policy != 'native':
+            self._filetoexport = dict(self._filetoexport, variables = {
+                k: apply_dtype_policy(v, dtype_policy) for k, v in self._filetoexport['variables'].items()})
         if asjson:
             self._export_asjson(path, fn,suffix = '.json')
             
@@ -0,0 +1,212 @@
+import numpy as np
+import pandas as pd
+import xarray
+
+from .gis_functions import transform_frombb, rasterize_points_usingbins, list_tif_2xarray
+from .xyz_functions import baseline_from_histogram
+
+from typing import List
+
+
+def consume_chunks(chunks, consumers: list) -> list:
+    """
+    Feeds every chunk of points to a set of consumers, so several products are
+    computed reading the point cloud only once.
+
+    Parameters:
+    ----------
+    chunks : iterable
+        Chunks of points, e.g. CloudPoints.iter_chunks() or iter_cloudpoints().
+    consumers : list
+        Objects with the update(chunk) and result() methods.
+
+    Returns:
+    -------
+    list
+        The result of each consumer.
+    """
+    for chunk in chunks:
+        for consumer in consumers:
+            consumer.update(chunk)
+
+    return [consumer.result() for consumer in consumers]
+
+
+class ChunkRasterizer:
+    """
+    Rasterizes a point cloud chunk by chunk, only the accumulated rasters are kept in memory.
+
+    Attributes
+    ----------
+    transform : Affine
+        Raster affine transformation.
+    imgsize : list
+        Raster size (height, width).
+    """
+
+    def __init__(self, bounds: tuple, spatial_res: float = 0.01,
+                 columns_name: List[str] = ["z", "red","green", "blue"],
+                 reducer: str = 'mean', crs = None):
+        """
+        Initialize the ChunkRasterizer class.
+
+        Parameters:
+        ----------
+        bounds : tuple
+            Raster bounding box (min_x, min_y, max_x, max_y).
+        spatial_res : float, optional
+            Spatial resolution in meters.
+        columns_name : List[str], optional
+            Names of the variables located after x and y in the chunks.
+        reducer : str, optional
+            How the points of the same pixel are combined: 'mean', 'max', 'min', 'last' or 'count'.
+        crs : int, optional
+            Coordinate reference system code.
+        """
+        if reducer not in ['mean', 'max', 'min', 'last', 'count']:
+            raise ValueError(f"Unsupported reducer: {reducer}")
+
+        self.transform, self.imgsize = transform_frombb(bounds, spatial_res)
+        self.columns_name = columns_name
+        self.reducer = reducer
+        self._crs = crs
+        self._counts = np.zeros(self.imgsize, dtype=np.int64)
+        self._rasters = np.zeros([len(columns_name)] + list(self.imgsize))
+
+    def update(self, chunk: pd.DataFrame):
+        xvalues, yvalues = chunk.iloc[:,0].values, chunk.iloc[:,1].values
+        counts = rasterize_points_usingbins(xvalues, yvalues, xvalues, self.transform,
+                                            self.imgsize, reducer = 'count')
+        self._counts += counts
+        if self.reducer == 'count':
+            return
+
+        values = chunk.iloc[:,2:len(self.columns_name)+2].values.astype(np.float64)
+        rasters = rasterize_points_usingbins(xvalues, yvalues, values, self.transform,
+                                             self.imgsize, reducer = self.reducer)
+        withpoints = counts > 0
+        if self.reducer == 'mean':
+            self._rasters += rasters * counts
+        elif self.reducer == 'last':
+            self._rasters[:, withpoints] = rasters[:, withpoints]
+        else:
+            ufunc = np.maximum if self.reducer == 'max' else np.minimum
+            # pixels seen for the first time take the chunk value
+            firsttime = withpoints & (self._counts == counts)
+            self._rasters[:, firsttime] = rasters[:, firsttime]
+            self._rasters[:, withpoints] = ufunc(self._rasters[:, withpoints], rasters[:, withpoints])
+
+    def result(self) -> xarray.Dataset:
+        if self.reducer == 'count':
+            return list_tif_2xarray([self._counts], self.transform, crs = self._crs, bands_names = ['count'])
+
+        rasters = self._rasters.copy()
+        if self.reducer == 'mean':
+            withpoints = self._counts > 0
+            rasters[:, withpoints] /= self._counts[withpoints]
+
+        return list_tif_2xarray(list(rasters), self.transform, crs = self._crs,
+                                bands_names = self.columns_name)
+
+
+class HeightHistogram:
+    """
+    Accumulates the histogram of the point heights chunk by chunk.
+    """
+
+    def __init__(self, zrange: tuple, nbins: int = 1024):
+        """
+        Initialize the HeightHistogram class.
+
+        Parameters:
+        ----------
+        zrange : tuple
+            Lower and upper height limits of the bins.
+        nbins : int, optional
+            Number of bins.
+        """
+        self.edges = np.linspace(zrange[0], zrange[1], nbins + 1)
+        self.counts = np.zeros(nbins, dtype=np.int64)
+
+    def update(self, chunk: pd.DataFrame):
+        self.counts += np.histogram(chunk.iloc[:,2].values, bins = self.edges)[0]
+
+    def result(self) -> tuple:
+        return self.counts, self.edges
+
+
+class BaselineEstimator:
+    """
+    Out of core version of the 'max_probability' baseline. The heights are accumulated in a
+    (y, z) histogram, once all the chunks are seen the plot edges in y are selected from the
+    y distribution and the baseline is computed from their height histograms.
+    """
+
+    def __init__(self, yrange: tuple, zrange: tuple, nbins: int = 1024,
+                 ybins: int = 256, stdtimes: float = 1):
+        """
+        Initialize the BaselineEstimator class.
+
+        Parameters:
+        ----------
+        yrange : tuple
+            Lower and upper limits in y, e.g. from the polygon bounds.
+        zrange : tuple
+            Lower and upper height limits of the bins.
+        nbins : int, optional
+            Number of height bins.
+        ybins : int, optional
+            Number of bins in y used to select the plot edges.
+        stdtimes : float, optional
+            Standard deviation times that define the plot edges.
+        """
+        self.yedges = np.linspace(yrange[0], yrange[1], ybins + 1)
+        self.zedges = np.linspace(zrange[0], zrange[1], nbins + 1)
+        self.stdtimes = stdtimes
+        self.counts = np.zeros((ybins, nbins), dtype=np.int64)
+
+    def update(self, chunk: pd.DataFrame):
+        zvalues = chunk.iloc[:,2].values
+        nonzero = zvalues != 0
+        self.counts += np.histogram2d(chunk.iloc[:,1].values[nonzero], zvalues[nonzero],
+                                      bins = [self.yedges, self.zedges])[0].astype(np.int64)
+
+    def height_histograms(self) -> list:
+        """
+        Height histograms of the upper and lower edges of the plot.
+        """
+        ycenters = (self.yedges[:-1] + self.yedges[1:])/2
+        ycounts = self.counts.sum(axis=1)
+        ymean = np.sum(ycounts * ycenters) / ycounts.sum()
+        ystd = np.sqrt(np.sum(ycounts * (ycenters - ymean)**2) / ycounts.sum())
+
+        upper = ycenters > (ymean + self.stdtimes * ystd)
+        lower = ycenters < (ymean - self.stdtimes * ystd)
+
+        return [(self.counts[upper].sum(axis=0), self.zedges),
+                (self.counts[lower].sum(axis=0), self.zedges)]
+
+    def result(self) -> float:
+        return baseline_from_histogram(self.height_histograms())
+
+
+class BoundingBox:
+    """
+    Accumulates the spatial and height limits of the points chunk by chunk.
+    """
+
+    def __init__(self):
+        self.mins = np.full(3, np.inf)
+        self.maxs = np.full(3, -np.inf)
+
+    def update(self, chunk: pd.DataFrame):
+        values = chunk.iloc[:,0:3].values
+        self.mins = np.minimum(self.mins, values.min(axis=0))
+        self.maxs = np.maximum(self.maxs, values.max(axis=0))
+
+    @property
+    def zrange(self) -> tuple:
+        return float(self.mins[2]), float(self.maxs[2])
+
+    def result(self) -> tuple:
+        return float(self.mins[0]), float(self.mins[1]), float(self.maxs[0]), float(self.maxs[1])
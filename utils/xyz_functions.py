@@ -1,30 +1,100 @@
-import math
-
 import concurrent.futures as cf
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 
-import linecache
 import xarray
 import os
+import time
+import tqdm
+import warnings
 
+from scipy.signal import fftconvolve
+from scipy.spatial import cKDTree
 from scipy.stats import gaussian_kde
 
 from .classification_functions import kmeans_images
-from .gis_functions import transform_frombb, rasterize_using_bb,list_tif_2xarray
+from .gis_functions import transform_frombb, rasterize_points_usingbins,list_tif_2xarray
 from .plt_functions import plot_2d_cloudpoints
+from .xyz_store import get_xyzstore, read_xyz_typed, xyz_projection
 
-from sklearn.neighbors import KNeighborsRegressor
 from pykrige.ok import OrdinaryKriging
 import shapely
 
 from typing import List, Optional, Union
 
-def getchunksize_forxyzfile(file_path: str, bb: tuple,buffer: float, step: int = 100):
+def _xyzline_at(fileobject, offset: int):
+    """
+    Finds the first complete line that starts at or after a byte offset.
+
+    Parameters:
+    ----------
+    fileobject : file
+        XYZ file opened in binary mode.
+    offset : int
+        Byte position.
+
+    Returns:
+    -------
+    tuple
+        Byte position where the line starts and its first value (x), the value 
+        is None when the end of the file is reached.
+    """
+    
+    # going back one byte resynchronises on the newline without skipping a line starting at offset
+    fileobject.seek(max(offset - 1, 0))
+    if offset > 0:
+        fileobject.readline()
+    linestart = fileobject.tell()
+    line = fileobject.readline()
+    
+    if not line.strip():
+        return linestart, None
+    
+    return linestart, float(line.split(b' ')[0])
+
+
+def find_xyz_byteoffset(fileobject, value: float, filesize: int, side: str = 'left') -> int:
+    """
+    Binary search over the byte offsets of an XYZ file sorted by x.
+
+    Parameters:
+    ----------
+    fileobject : file
+        XYZ file opened in binary mode.
+    value : float
+        x value to look for.
+    filesize : int
+        Size of the file in bytes.
+    side : str, optional
+        'left' returns the first line with x >= value, 'right' the first line with x > value.
+
+    Returns:
+    -------
+    int
+        Byte position where the line starts.
+    """
+    
+    init, end = 0, filesize
+    while init < end:
+        mid = (init + end) // 2
+        _, xvalue = _xyzline_at(fileobject, mid)
+        if xvalue is None or (xvalue >= value if side == 'left' else xvalue > value):
+            end = mid
+        else:
+            init = mid + 1
+    
+    return _xyzline_at(fileobject, init)[0]
+
+
+def getchunksize_forxyzfile(file_path: str, bb: tuple, buffer: float, step: Optional[int] = None, *, 
+                            samplesize: int = 1048576):
     
     """
     Determines the chunk size for reading an XYZ file based on bounding box and buffer.
+    
+    The file is expected to be sorted by x (as Pix4D writes it), the bytes where the x range 
+    starts and ends are found with a binary search, so memory use does not depend on the file size.
 
     Parameters:
     ----------
@@ -35,48 +105,40 @@ def getchunksize_forxyzfile(file_path: str, bb: tuple,buffer: float, step: int =
     buffer : float
         Buffer distance around the bounding box.
     step : int, optional
-        Step size for checking the file.
+        Deprecated, the rows were scanned in steps of this size before the binary search. 
+        It is ignored.
+    samplesize : int, optional
+        Keyword only, number of bytes used to estimate the line length.
 
     Returns:
     -------
     list
-        Starting row index and chunk size.
-    """
-    
-    cond1 = True
-    idinit = 0
-    idx2 = step
-    
-    idxdif= 0
-    #this is a flag to point out that the file doesnt have all information
-    initfinalpos = [0,0]
-    while cond1:
-        try:
-            firstvalueintherow = linecache.getline(file_path,idx2).split(' ')[0]
-            cond2 = float(firstvalueintherow)>=(bb[0] - buffer)
-            if cond2:
-                initfinalpos = [idinit,idx2]
-                cond1 =float(firstvalueintherow)<=(bb[2] + buffer)
-            else:
-                idinit = idx2
-            
-            idx2+=step
-        except:
-            break
+        Starting byte position and the approximate number of rows inside the x range.
+    """
+    if step is not None:
+        warnings.warn('step is deprecated and ignored, the x range is found with a binary search',
+                      DeprecationWarning, stacklevel = 2)
     
-    #if idinit != 0:
-    idxdif = initfinalpos[1] - initfinalpos[0]
-
-    if idxdif < 2000:
-        idxdif=0
-
-    linecache.clearcache()
-    return ([initfinalpos[0], idxdif])
+    filesize = os.path.getsize(file_path)
+    with open(file_path, 'rb') as fileobject:
+        initpos = find_xyz_byteoffset(fileobject, bb[0] - buffer, filesize, side = 'left')
+        endpos = find_xyz_byteoffset(fileobject, bb[2] + buffer, filesize, side = 'right')
+        
+        if endpos <= initpos:
+            return [initpos, 0]
+        
+        fileobject.seek(initpos)
+        sample = fileobject.read(min(samplesize, endpos - initpos))
+    
+    linelength = len(sample) / max(sample.count(b'\n'), 1)
+    
+    return [initpos, int(np.ceil((endpos - initpos) / linelength))]
 
 
 def filterdata_insidebounds(chunks, bb: tuple, buffer: float = 0.0):
     """
-    Generator to filter chunks of data based on bounding box and buffer.
+    Generator to filter chunks of data based on bounding box and buffer. The chunks are
+    expected to be sorted by x, the reading stops once a chunk goes past the bounding box.
 
     Parameters:
     ----------
@@ -101,10 +163,79 @@ def filterdata_insidebounds(chunks, bb: tuple, buffer: float = 0.0):
             yield chunk
         else:
             yield chunk.loc[mask]
-            break
+            if chunk.iloc[-1,0] >= (bb[2]+buffer):
+                break
+
+
+def list_xyzfiles(file_path: str, ext: str = '.xyz') -> List[str]:
+    """
+    Lists the point cloud files given a file path or a directory.
+
+    Parameters:
+    ----------
+    file_path : str
+        Path to the XYZ file or directory containing XYZ files.
+    ext : str, optional
+        File extension of the cloud points file.
+
+    Returns:
+    -------
+    list
+        Paths to the XYZ files.
+    """
+    
+    if file_path.endswith('.xyz'):
+        return [file_path]
+    
+    return [os.path.join(file_path, i) for i in os.listdir(file_path) if i.endswith(ext)]
 
 
-def read_cloudpointsfromxyz(file_path, bb, buffer= 0.1, sp_res = 0.005, ext='.xyz'):
+def read_cloudpointsfrompolygon(file_path, polygon, ext='.xyz', tile_size = 1.0, columns = None):
+    """
+    Reads the cloud points inside a polygon using the binary store and its grid tile index.
+    
+    Unlike read_cloudpointsfromxyz, this does not assume that the XYZ file is sorted by x,
+    only the tiles that intersect the polygon are read.
+
+    Parameters:
+    ----------
+    file_path : str
+        Path to the XYZ file or directory containing XYZ files.
+    polygon : shapely.geometry.Polygon
+        Spatial boundary.
+    ext : str, optional
+        File extension of the cloud points file.
+    tile_size : float, optional
+        Tile size of the index, an existing index with another tile size is rebuilt.
+    columns : list of str, optional
+        Columns to read (x and y are always read). Defaults to all columns.
+
+    Returns:
+    -------
+    pd.DataFrame
+        DataFrame containing the cloud points.
+
+    Raises:
+    ------
+    ValueError
+        If there are no points inside the polygon.
+    """
+    
+    dfp = []
+    for xyzfile in list_xyzfiles(file_path, ext = ext):
+        store = get_xyzstore(xyzfile)
+        store.tile_index(tile_size = tile_size)
+        dfp.append(store.query_polygon(polygon, columns = xyz_projection(columns)))
+    
+    dfp = pd.concat(dfp) if len(dfp) > 0 else []
+    if len(dfp) == 0:
+        raise ValueError('Check the coordinates, there is no intesection in the file')
+    
+    return dfp
+
+
+def read_cloudpointsfromxyz(file_path, bb, buffer= 0.1, sp_res = 0.005, ext='.xyz', binary_cache = False,
+                            columns = None, engine = 'c'):
     """
     Reads cloud points from an XYZ file using spatial boundaries.
 
@@ -120,6 +251,14 @@ def read_cloudpointsfromxyz(file_path, bb, buffer= 0.1, sp_res = 0.005, ext='.xy
         Spatial resolution in meters.
     ext : str, optional
         File extension of the cloud points file.
+    binary_cache : bool, optional
+        If True, the XYZ file is converted once into a columnar binary store sorted on x 
+        and the points are queried from it instead of parsing the text file.
+    columns : list of str, optional
+        Columns to read, e.g. ['z'] when the colors are not needed (x and y are always read). 
+        Defaults to all columns.
+    engine : str, optional
+        Parser used for the text file, 'c' or 'pyarrow' (see read_xyz_typed).
 
     Returns:
     -------
@@ -135,16 +274,9 @@ def read_cloudpointsfromxyz(file_path, bb, buffer= 0.1, sp_res = 0.005, ext='.xy
     width, heigth = abs(bb[0]-bb[2]) + buffer, abs(bb[1]-bb[3]) + buffer
 
     mindata = int(heigth/sp_res * width/sp_res)
-    ### junp every step onf lines in the point cloud file
-    step = int(mindata*0.015)
 
     
-    if file_path.endswith('.xyz'):
-        folders = os.path.split(file_path)
-        file_path = os.path.dirname(file_path)#folders[0]
-        xyzfilenames = [folders[-1]]
-    else:
-        xyzfilenames = [i for i in os.listdir(file_path) if i.endswith(ext)]
+    xyzfilenames = list_xyzfiles(file_path, ext = ext)
     
     count = 0
     dfp = []
@@ -152,15 +284,22 @@ def read_cloudpointsfromxyz(file_path, bb, buffer= 0.1, sp_res = 0.005, ext='.xy
     undermindata = True
     
     while undermindata:
-        tmpfilepath = os.path.join(file_path,xyzfilenames[count])
-        firstrow,chunksize = getchunksize_forxyzfile(
-            tmpfilepath, bb,buffer, step)
+        tmpfilepath = xyzfilenames[count]
+        if binary_cache:
+            df = get_xyzstore(tmpfilepath).query_bounds(bb, buffer, columns = xyz_projection(columns))
+            dfp.append(df)
+            sizefiles += len(df)
+            chunksize = 0
+        else:
+            firstbyte,chunksize = getchunksize_forxyzfile(
+                tmpfilepath, bb,buffer)
         
         if chunksize>0:
-            chunks = pd.read_csv(tmpfilepath,
-                skiprows=firstrow, chunksize=chunksize, header=None, sep = " ")
-            
-            df = pd.concat(filterdata_insidebounds(chunks, bb, buffer))
+            with open(tmpfilepath, 'rb') as fileobject:
+                fileobject.seek(firstbyte)
+                chunks = read_xyz_typed(fileobject, columns = columns, chunksize = chunksize, engine = engine)
+                
+                df = pd.concat(filterdata_insidebounds(chunks, bb, buffer))
             dfp.append(df)
             sizefiles += len(df)
         
@@ -176,8 +315,128 @@ def read_cloudpointsfromxyz(file_path, bb, buffer= 0.1, sp_res = 0.005, ext='.xy
     return dfp
 
 
+def _edge_heights(clouddf: pd.DataFrame, stdtimes: float = 1):
+    """
+    Selects the non zero heights of the points located at both edges of the plot in y, 
+    beyond stdtimes standard deviations from the mean.
+
+    Args:
+        clouddf (pd.DataFrame): DataFrame containing cloud data. It must content columns x, y and z.
+        stdtimes (int, optional): Standard deviation times. Defaults to 1.
+
+    Returns:
+        tuple: heights of the upper and lower edges.
+    """
+    ydata = clouddf.iloc[:,1].values
+    zdata = clouddf.iloc[:,2].values
+    zeromask = np.logical_not(zdata==0)
+    ydata = ydata[zeromask]
+    zdata = zdata[zeromask]
+    
+    ycentermask1 = ydata>(np.mean(ydata)+(stdtimes*np.std(ydata)))
+    ycentermask2 = ydata<(np.mean(ydata)-(stdtimes*np.std(ydata)))
+    
+    return zdata[ycentermask1], zdata[ycentermask2]
+
+
+def histogram_kde_mode(counts: np.ndarray, edges: np.ndarray, bandwidth: float = None):
+    """
+    Finds the mode of a gaussian KDE computed over a histogram, the kernel is convolved 
+    with the bin counts using FFT, so the cost depends on the number of bins instead of 
+    the number of points.
+
+    Args:
+        counts (np.ndarray): Histogram counts.
+        edges (np.ndarray): Histogram bin edges, the bins must have the same width.
+        bandwidth (float, optional): Kernel bandwidth, if None it is computed with Scott's rule 
+            as scipy.stats.gaussian_kde. Defaults to None.
+
+    Returns:
+        float: Center of the bin with the highest density.
+    """
+    counts = np.asarray(counts, dtype=float)
+    centers = (edges[:-1] + edges[1:])/2
+    npoints = counts.sum()
+    if bandwidth is None:
+        meanval = np.sum(counts*centers)/npoints
+        stdval = np.sqrt(np.sum(counts*(centers-meanval)**2)/max(npoints-1, 1))
+        bandwidth = stdval * npoints**(-1/5)
+    
+    sigma = bandwidth / np.mean(np.diff(edges))
+    if sigma > 0:
+        halfwidth = int(np.ceil(4*sigma))
+        kernelpos = np.arange(-halfwidth, halfwidth+1)
+        density = fftconvolve(counts, np.exp(-0.5*(kernelpos/sigma)**2), mode='same')
+    else:
+        density = counts
+    
+    return centers[np.argmax(density)]
+
+
+def kde_mode(values: np.ndarray, kde_method: str = 'binned', nbins: int = 1024):
+    """
+    Finds the value with the highest gaussian KDE density.
+
+    Args:
+        values (np.ndarray): Data values.
+        kde_method (str, optional): 'exact' evaluates scipy's gaussian_kde at every value, 
+            'binned' uses an FFT convolution over a histogram. Defaults to 'binned'.
+        nbins (int, optional): Number of bins for the binned method. Defaults to 1024.
+
+    Returns:
+        float: Mode estimate.
+    """
+    if kde_method == 'exact':
+        data = np.sort(values)
+        return data[np.argmax(gaussian_kde(data)(data))]
+    
+    if kde_method == 'binned':
+        counts, edges = np.histogram(values, bins=nbins)
+        bandwidth = np.std(values, ddof=1) * len(values)**(-1/5)
+        return histogram_kde_mode(counts, edges, bandwidth = bandwidth)
+    
+    raise ValueError(f"Unsupported KDE method: {kde_method}")
+
+
+def height_histograms_fromcloud(clouddf: pd.DataFrame, nbins: int = 1024, stdtimes: float = 1, 
+                                zrange: tuple = None):
+    """
+    Computes the height histograms of the plot edges used by the 'max_probability' baseline, 
+    they can be stored during the extraction and used later with baseline_from_histogram.
+
+    Args:
+        clouddf (pd.DataFrame): DataFrame containing cloud data. It must content columns x, y and z.
+        nbins (int, optional): Number of bins. Defaults to 1024.
+        stdtimes (int, optional): Standard deviation times. Defaults to 1.
+        zrange (tuple, optional): Lower and upper height limits of the bins. Defaults to None.
+
+    Returns:
+        list: (counts, edges) histograms for the upper and lower edges.
+    """
+    return [np.histogram(zdata, bins=nbins, range=zrange) for zdata in _edge_heights(clouddf, stdtimes)]
+
+
+def baseline_from_histogram(histograms: list, bandwidth: float = None):
+    """
+    Calculates the 'max_probability' baseline from precomputed height histograms.
+
+    Args:
+        histograms (list): (counts, edges) histograms, as the ones returned by height_histograms_fromcloud.
+        bandwidth (float, optional): Kernel bandwidth. Defaults to None.
+
+    Returns:
+        float: Baseline altitude value.
+    """
+    if isinstance(histograms, tuple) and len(histograms) == 2 and np.ndim(histograms[0]) == 1:
+        histograms = [histograms]
+
+    return np.mean([histogram_kde_mode(counts, edges, bandwidth = bandwidth) for counts, edges in histograms])
+
+
 def get_baseline_altitude(clouddf: pd.DataFrame, nclusters: int = 15, nmaxcl: int = 4, method: str = 'max_probability', 
-                          quantile_val: float = .85, stdtimes: float = 1):
+                          quantile_val: float = .85, stdtimes: float = 1, kde_method: str = 'exact', 
+                          nbins: int = 1024, subsample: int = None, random_state: int = None,
+                          histograms: list = None):
     """
     Calculate the baseline altitude based on the provided point cloud dataframe.
 
@@ -189,11 +448,20 @@ def get_baseline_altitude(clouddf: pd.DataFrame, nclusters: int = 15, nmaxcl: in
             Options: 'max_probability', 'cluster', 'quantile', 'center'. Defaults to 'max_probability'.
         quantile_val (float, optional): Quantile value. Defaults to 0.85.
         stdtimes (int, optional): Standard deviation times. Defaults to 1.
+        kde_method (str, optional): KDE used by 'max_probability', 'exact' or 'binned'. Defaults to 'exact'.
+        nbins (int, optional): Number of bins for the binned KDE. Defaults to 1024.
+        subsample (int, optional): Maximum number of heights per edge used by 'max_probability'. Defaults to None.
+        random_state (int, optional): Seed for the subsampling. Defaults to None.
+        histograms (list, optional): Precomputed edge histograms for 'max_probability', 
+            when given clouddf is not used. Defaults to None.
 
     Returns:
         float: Baseline altitude value.
     """
     
+    if method == 'max_probability' and histograms is not None:
+        return baseline_from_histogram(histograms)
+    
     df = clouddf.copy()
     bsl = None
     if method == 'cluster':
@@ -206,20 +474,15 @@ def get_baseline_altitude(clouddf: pd.DataFrame, nclusters: int = 15, nmaxcl: in
         return bsl
     if method == 'max_probability':
 
-        ydata = df.iloc[:,1].values.copy()
-        zdata = df.iloc[:,2].values.copy()
-        zeromask = np.logical_not(zdata==0)
-        ydata = ydata[zeromask]
-        zdata = zdata[zeromask]
+        rng = np.random.default_rng(random_state)
+        edgesdata = []
+        for zdata in _edge_heights(df, stdtimes):
+            if subsample is not None and len(zdata) > subsample:
+                zdata = rng.choice(zdata, subsample, replace=False)
+            edgesdata.append(zdata)
         
-        ycentermask1 = ydata>(np.mean(ydata)+(stdtimes*np.std(ydata)))
-        ycentermask2 = ydata<(np.mean(ydata)-(stdtimes*np.std(ydata)))
-        datam = np.sort(zdata[ycentermask1])
-        datah = np.sort(zdata[ycentermask2])
-        ys1 = gaussian_kde(datam)
-        ys2 = gaussian_kde(datah)
-        valmax1 = datam[np.argmax(ys1(datam))]
-        valmax2 = datah[np.argmax(ys2(datah))]
+        valmax1 = kde_mode(edgesdata[0], kde_method = kde_method, nbins = nbins)
+        valmax2 = kde_mode(edgesdata[1], kde_method = kde_method, nbins = nbins)
         bsl = (valmax1 + valmax2)/2
         return bsl
 
@@ -256,6 +519,11 @@ def from_cloudpoints_to_xarray(dfpointcloud,
                                inter_method = 'KNN',
                                knn = 5, weights = "distance",
                                variogram_model = 'exponential',
+                               reducer = 'last',
+                               workers = -1,
+                               kriging_neighbours = 256,
+                               kriging_tilesize = 64,
+                               njobs = None
                                ):
 
     """
@@ -288,6 +556,17 @@ def from_cloudpoints_to_xarray(dfpointcloud,
         Weighting method for interpolation.
     variogram_model : str, optional
         Variogram model for interpolation.
+    reducer : str, optional
+        How the points that fall in the same pixel are combined when rasterizing 
+        ('mean', 'max', 'min', 'last' or 'count').
+    workers : int, optional
+        Number of workers used to query the KD-tree in the KNN interpolation, -1 uses all the CPUs.
+    kriging_neighbours : int, optional
+        Number of nearest points used to krige each tile in the local kriging interpolation.
+    kriging_tilesize : int, optional
+        Tile size in pixels for the local kriging interpolation.
+    njobs : int, optional
+        Number of processes used by the local kriging interpolation, None uses all the CPUs.
 
     Returns:
     -------
@@ -298,35 +577,61 @@ def from_cloudpoints_to_xarray(dfpointcloud,
     trans, imgsize = transform_frombb(bounds, spatial_res)
     totallength = len(columns_name)+2
     xarraylist = []
+    # the count reducer returns a single layer with the number of points per pixel
+    bands_names = ['count'] if not interpolate and reducer == 'count' else columns_name
+    grid = raster_meshgrid(trans, imgsize) if interpolate else None
     for j, df in enumerate(dfpointcloud):
         list_rasters = []
         xycoords = df[[0,1]].values.copy()
 
-        for i in range(2,totallength):
-            valuestorasterize = df.iloc[:,[i]].iloc[:, 0].values
-            
-            if interpolate:
+        if not interpolate:
+            rasters = rasterize_points_usingbins(xycoords.T[0],xycoords.T[1],
+                                                 df.iloc[:,2:totallength].values, 
+                                                 transform = trans, imgsize = imgsize, 
+                                                 reducer = reducer)
+            # the count reducer returns a single (H x W) layer, the others one layer per column
+            list_rasters = [rasters] if reducer == 'count' else list(rasters)
+        
+        elif inter_method == 'KNN':
+            # a single tree and neighbours query for all the channels
+            list_rasters = list(points_rasterinterpolated(
+                (xycoords.T[0],xycoords.T[1],df.iloc[:,2:totallength].values), 
+                transform = trans, 
+                rastershape = imgsize,
+                inter_method= inter_method,
+                grid = grid,
+                knn = knn, weights = weights, workers = workers))
+        
+        elif inter_method == 'local_kriging':
+            list_rasters = list(points_rasterinterpolated(
+                (xycoords.T[0],xycoords.T[1],df.iloc[:,2:totallength].values), 
+                transform = trans, 
+                rastershape = imgsize,
+                inter_method= inter_method,
+                grid = grid,
+                variogram_model = variogram_model,
+                nneighbours = kriging_neighbours, 
+                tilesize = kriging_tilesize, njobs = njobs))
+
+        else:
+            # the other methods interpolate each channel on its own
+            for i in range(2,totallength):
+                valuestorasterize = df.iloc[:,[i]].iloc[:, 0].values
+                
                 rasterinterpolated = points_rasterinterpolated(
                     (xycoords.T[0],xycoords.T[1],valuestorasterize), 
                     transform = trans, 
                     rastershape = imgsize,
                     inter_method= inter_method,
-                               knn = knn, weights = weights,
-                               variogram_model = variogram_model)
-            else:
-                rasterinterpolated = rasterize_using_bb(valuestorasterize, 
-                                                    df.geometry, 
-                                                    transform = trans, imgsize =imgsize)
-
-            
-            
-
-     
-            list_rasters.append(rasterinterpolated)
+                    grid = grid,
+                    knn = knn, weights = weights,
+                    variogram_model = variogram_model)
+                
+                list_rasters.append(rasterinterpolated)
 
         xarraylist.append(list_tif_2xarray(list_rasters, trans, 
                                            crs = coords_system,
-                                           bands_names = columns_name))
+                                           bands_names = bands_names))
 
     if len(xarraylist) > 1:
         mltxarray = xarray.concat(xarraylist, dim=dimension_name)
@@ -343,35 +648,92 @@ def from_cloudpoints_to_xarray(dfpointcloud,
     return mltxarray
 
 
+def voxel_downsample(clouddf: pd.DataFrame, voxel_size: float, reducer: str = 'mean', 
+                     zsize: Optional[float] = None, origin: Optional[tuple] = None) -> pd.DataFrame:
+    """
+    Reduces the point cloud to one point per voxel. The voxel of each point is hashed 
+    into a single integer, so the grouping is done with NumPy without loops. The voxel 
+    grid is anchored to an origin, so when it matches the raster grid (same origin and 
+    voxel size equal to the pixel size) each voxel falls inside a single pixel.
+
+    Parameters:
+    ----------
+    clouddf : pd.DataFrame
+        Point cloud, the first three columns must be x, y and z.
+    voxel_size : float
+        Voxel size in x and y.
+    reducer : str, optional
+        'mean' averages all the columns, 'max_z' keeps the highest point of each voxel 
+        (preserves the canopy maxima) and 'median' computes the median of each column.
+    zsize : float, optional
+        Voxel size in z, if None the points are grouped in a 2D grid (one point per cell).
+    origin : tuple, optional
+        Coordinates of a voxel corner (x, y) or (x, y, z), e.g. the raster transform origin.
+        Defaults to 0, so the voxels are aligned to the multiples of their size.
+
+    Returns:
+    -------
+    pd.DataFrame
+        Downsampled points with the same columns and dtypes.
+    """
+    if reducer not in ['mean', 'max_z', 'median']:
+        raise ValueError(f"Unsupported reducer: {reducer}")
+    if len(clouddf) == 0:
+        return clouddf
+
+    cellsizes = [voxel_size, voxel_size] + ([zsize] if zsize is not None else [])
+    coords = clouddf.iloc[:,:len(cellsizes)].values
+    anchor = np.zeros(len(cellsizes))
+    if origin is not None:
+        anchor[:len(origin)] = origin[:len(cellsizes)]
+    cellidx = np.floor((coords - anchor) / cellsizes).astype(np.int64)
+    cellidx -= cellidx.min(axis=0)
+    # row major hash of the voxel indices
+    ncells = cellidx.max(axis=0) + 1
+    voxelid = np.zeros(len(cellidx), dtype=np.int64)
+    for i in range(len(cellsizes)):
+        voxelid = voxelid * ncells[i] + cellidx[:,i]
+    
+    voxels, inverse, counts = np.unique(voxelid, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+
+    if reducer == 'max_z':
+        # the last point of each voxel after sorting by voxel and height is the highest one
+        order = np.lexsort((clouddf.iloc[:,2].values, inverse))
+        lastpos = np.cumsum(counts) - 1
+        # a new index as the other reducers
+        return clouddf.iloc[order[lastpos]].reset_index(drop=True)
+    
+    reduced = {}
+    for col in clouddf.columns:
+        values = clouddf[col].values
+        if reducer == 'mean':
+            colvalues = np.bincount(inverse, weights=values, minlength=len(voxels)) / counts
+        else:
+            sortedvalues = values[np.lexsort((values, inverse))]
+            initpos = np.cumsum(counts) - counts
+            colvalues = (sortedvalues[initpos + (counts - 1)//2].astype(np.float64) + 
+                         sortedvalues[initpos + counts//2]) / 2
+        
+        if np.issubdtype(values.dtype, np.integer):
+            colvalues = np.round(colvalues)
+        reduced[col] = colvalues.astype(values.dtype)
+
+    return pd.DataFrame(reduced)
+
+
 def calculate_leaf_angle(xrdata, vector = (0,0,1), invert = False,heightvarname = 'z', name4d ='date'):
     
     varnames = list(xrdata.keys())
     if heightvarname is not None and heightvarname not in varnames:
         raise ValueError('{} is not in the xarray'.format(heightvarname))
 
-    anglelist = []
-    #name4d = list(xrdata.dims.keys())[0]
-    if len(xrdata.dims.keys())>2:
-        for dateoi in range(len(xrdata[name4d])):
-            anglelist.append(get_angle_image_fromxarray(
-                xrdata.isel({name4d:dateoi}).copy(), vcenter=vector,heightvarname = heightvarname))
-        
-        xrimg = xarray.DataArray(anglelist)
-        vars = list(xrdata.dims.keys())
-        
-        vars = [vars[i] for i in range(len(vars)) if i != vars.index(name4d)]
-
-        xrimg.name = "leaf_angle"
-        xrimg = xrimg.rename({'dim_0': name4d, 
-                            'dim_1': vars[0],
-                            'dim_2': vars[1]})
-    else:
-        xrimg = xarray.DataArray(get_angle_image_fromxarray(
-                xrdata.copy(), vcenter=vector,heightvarname = heightvarname))
-        vars = list(xrdata.dims.keys())
-        xrimg.name = "leaf_angle"
-        xrimg = xrimg.rename({'dim_0': vars[0], 
-                            'dim_1': vars[1]})
+    # all the dates are computed at once, the angle image has the same dimensions as the height
+    heightdata = xrdata[heightvarname]
+    xrimg = xarray.DataArray(get_angle_image_fromxarray(xrdata, vcenter=vector,heightvarname = heightvarname),
+                             dims = heightdata.dims, 
+                             coords = {dim: heightdata[dim] for dim in heightdata.dims if dim in heightdata.coords},
+                             name = "leaf_angle")
 
     xrdata = xrdata.merge(xrimg)
     
@@ -383,23 +745,63 @@ def calculate_leaf_angle(xrdata, vector = (0,0,1), invert = False,heightvarname
 
 
 def get_angle_image_fromxarray(xrdata, vcenter = (1,1,0),heightvarname = 'z'):
+    """
+    Calculates the angle between a reference vector and the vector that goes from the 
+    image center to each pixel.
 
-    df = xrdata.to_dataframe().copy()
-    
-    ycoords = np.array([float("{}.{}".format(str(i[0]).split('.')[0][-3:], str(i[0]).split('.')[1])) for i in df.index.values])*100
-    xcoords = np.array([float("{}.{}".format(str(i[1]).split('.')[0][-3:], str(i[1]).split('.')[1]))  for i in df.index.values])*100
-    
-    xcenter = np.mean(xcoords)
-    ycenter = np.mean(ycoords)
+    Parameters:
+    ----------
+    xrdata : xarray.Dataset
+        Data with the height variable, the last two dimensions must be y and x, any 
+        leading dimension (e.g. dates) is computed in the same operation.
+    vcenter : tuple, optional
+        Reference vector.
+    heightvarname : str, optional
+        Name of the height variable.
 
-    anglelist = []
-    for x,y,z in zip(xcoords,ycoords,xrdata[heightvarname].values.ravel()):
-        anglelist.append(math.degrees(calculate_angle_twovectors(vcenter , ((x-xcenter), (y-ycenter),z))))
+    Returns:
+    -------
+    np.ndarray
+        Angles in degrees with the same shape as the height variable.
+    """
+    heightdata = xrdata[heightvarname]
+    ydim, xdim = heightdata.dims[-2], heightdata.dims[-1]
+
+    return angle_image_fromarrays(xrdata[xdim].values, xrdata[ydim].values, 
+                                  heightdata.values, vcenter = vcenter)
+
+
+def angle_image_fromarrays(xcoords, ycoords, zvalues, vcenter = (1,1,0)):
+    """
+    Vectorized angle calculation between a reference vector and the vectors 
+    (x - xcenter, y - ycenter, z), the coordinates are centered and scaled to centimeters.
+
+    Parameters:
+    ----------
+    xcoords : np.ndarray
+        Pixel coordinates in x (W).
+    ycoords : np.ndarray
+        Pixel coordinates in y (H).
+    zvalues : np.ndarray
+        Heights with shape (..., H x W).
+    vcenter : tuple, optional
+        Reference vector.
 
+    Returns:
+    -------
+    np.ndarray
+        Angles in degrees with the same shape as zvalues.
+    """
+    xcentered = (xcoords - np.mean(xcoords))*100
+    ycentered = ((ycoords - np.mean(ycoords))*100)[:,np.newaxis]
+    vcenter = np.asarray(vcenter, dtype=float)
+
+    dot_product = vcenter[0]*xcentered + vcenter[1]*ycentered + vcenter[2]*zvalues
+    norms = np.sqrt(xcentered**2 + ycentered**2 + zvalues**2) * np.linalg.norm(vcenter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        angles = np.degrees(np.arccos(np.clip(dot_product / norms, -1, 1)))
     
-    anglelist = np.array(anglelist).reshape(xrdata[heightvarname].shape)
-    #anglelist[xrdata[heightvarname].values == 0] = 0
-    return(anglelist)
+    return angles
 
 
 def remove_bsl_toxarray(xarraydata, baselineval, scale_height = 100):
@@ -415,24 +817,395 @@ def calculate_angle_twovectors(v1,v2):
     dot_product = np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
     return( np.arccos(dot_product))
 
-def clip_cloudpoints_as_gpd(file_name, bb, crs, buffer = 0.1, sp_res = 0.005, ext = '.xyz'):
+def _clip_cloudpoints_timed(file_name, bb, **kwargs):
+    """
+    Runs clip_cloudpoints_as_gpd and measures its duration, it is defined at module 
+    level so it can be sent to the worker processes.
+    """
+    starttime = time.perf_counter()
+    dfcl = clip_cloudpoints_as_gpd(file_name, bb, **kwargs)
+    return dfcl, time.perf_counter() - starttime
+
+
+def clip_cloudpoints_as_gpd(file_name, bb, crs = None, buffer = 0.1, sp_res = 0.005, ext = '.xyz', 
+                            binary_cache = False, spatial_index = False, columns = None):
+    """
+    Reads the cloud points inside a polygon.
+
+    Parameters:
+    ----------
+    file_name : str
+        Path to the XYZ file or directory containing XYZ files.
+    bb : shapely.geometry.Polygon
+        Spatial boundary.
+    crs : int, optional
+        Coordinate reference system code, kept for compatibility; the points are 
+        returned as a plain table without geometries.
+    buffer : float, optional
+        Buffer around the bounding box used to read the file.
+    sp_res : float, optional
+        Spatial resolution in meters.
+    ext : str, optional
+        File extension of the cloud points file.
+    binary_cache : bool, optional
+        Read the points from the binary store of each file.
+    spatial_index : bool, optional
+        Read only the tiles of the binary store that intersect the polygon.
+    columns : list of str, optional
+        Columns to read (x and y are always read). Defaults to all columns.
+
+    Returns:
+    -------
+    pd.DataFrame
+        Points inside the polygon.
+    """
+    
+    if spatial_index:
+        dfcl = read_cloudpointsfrompolygon(file_name, bb, ext = ext, columns = columns)
+    else:
+        dfcl = read_cloudpointsfromxyz(file_name,  
+                                bb.bounds, 
+                                buffer = buffer,
+                                sp_res = sp_res,
+                                ext =ext,
+                                binary_cache = binary_cache,
+                                columns = columns)
+
+    return dfcl.loc[shapely.contains_xy(bb, dfcl.iloc[:,0].values, dfcl.iloc[:,1].values)]
+
+
+def read_xyz_inchunks(file_path, chunksize = 1000000, ext = '.xyz', binary_cache = False, 
+                      columns = None, engine = 'c'):
+    """
+    Generator to read all the points of one or several XYZ files in chunks.
+
+    Parameters:
+    ----------
+    file_path : str
+        Path to the XYZ file or directory containing XYZ files.
+    chunksize : int, optional
+        Number of points per chunk.
+    ext : str, optional
+        File extension of the cloud points file.
+    binary_cache : bool, optional
+        Read the points from the binary store of each file.
+    columns : list of str, optional
+        Columns to read (x and y are always read). Defaults to all columns.
+    engine : str, optional
+        Parser used for the text file, 'c' or 'pyarrow' (see read_xyz_typed).
+
+    Yields:
+    ------
+    DataFrame
+        Chunk of points, the columns are labeled with their position (0: x, 1: y, ...).
+    """
+    
+    for xyzfile in list_xyzfiles(file_path, ext = ext):
+        if binary_cache:
+            store = get_xyzstore(xyzfile)
+            for i in range(0, len(store), chunksize):
+                yield _store_chunk(store, slice(i, i+chunksize), columns = columns)
+        else:
+            yield from read_xyz_typed(xyzfile, columns = columns, chunksize = chunksize, engine = engine)
+
+
+def _store_chunk(store, rows, columns = None):
+    """
+    Reads a set of rows of a binary store as a chunk labeled with the columns position.
+    """
+    values = store.read_columns(rows, columns = xyz_projection(columns))
+    return pd.DataFrame({store.columns_names.index(col): values[col] for col in values})
+
+
+def _iter_xyzfile_chunks(xyzfile, polygon = None, buffer = 0.1, chunksize = 1000000, 
+                         binary_cache = False, spatial_index = False, columns = None, engine = 'c'):
+    """
+    Generator of the chunks of a single XYZ file that can contain points of the polygon, 
+    the chunks still have to be tested against the polygon.
+    """
+    if polygon is None:
+        yield from read_xyz_inchunks(xyzfile, chunksize = chunksize, binary_cache = binary_cache,
+                                     columns = columns, engine = engine)
+        return
+    
+    bb = polygon.bounds
+    if spatial_index:
+        store = get_xyzstore(xyzfile)
+        for rows in store.iter_tile_rows(polygon, chunksize = chunksize):
+            yield _store_chunk(store, rows, columns = columns)
+    
+    elif binary_cache:
+        store = get_xyzstore(xyzfile)
+        rows = store.xrange_slice(bb[0]-buffer, bb[2]+buffer)
+        for i in range(rows.start, rows.stop, chunksize):
+            yield _store_chunk(store, slice(i, min(i+chunksize, rows.stop)), columns = columns)
     
+    else:
+        firstbyte, nrows = getchunksize_forxyzfile(xyzfile, bb, buffer)
+        if nrows > 0:
+            with open(xyzfile, 'rb') as fileobject:
+                fileobject.seek(firstbyte)
+                chunks = read_xyz_typed(fileobject, columns = columns, chunksize = chunksize, engine = engine)
+                yield from filterdata_insidebounds(chunks, bb, buffer)
+
 
-    dfcl = read_cloudpointsfromxyz(file_name,  
-                            bb.bounds, 
-                            buffer = buffer,
-                            sp_res = sp_res,
-                            ext =ext)
+def iter_cloudpoints(file_path, polygon = None, buffer = 0.1, chunksize = 1000000, ext = '.xyz', 
+                     binary_cache = False, spatial_index = False, columns = None, engine = 'c'):
+    """
+    Generator to process the cloud points out of core, the points are read in chunks 
+    so the memory used depends on the chunk size and not on the area.
 
+    Parameters:
+    ----------
+    file_path : str
+        Path to the XYZ file or directory containing XYZ files.
+    polygon : shapely.geometry.Polygon, optional
+        Spatial boundary, if None all the points of the files are returned.
+    buffer : float, optional
+        Buffer around the polygon bounding box used to read the file.
+    chunksize : int, optional
+        Maximum number of points read at a time.
+    ext : str, optional
+        File extension of the cloud points file.
+    binary_cache : bool, optional
+        Read the points from the binary store of each file.
+    spatial_index : bool, optional
+        Read only the tiles of the binary store that intersect the polygon.
+    columns : list of str, optional
+        Columns to read (x and y are always read). Defaults to all columns.
+    engine : str, optional
+        Parser used for the text file, 'c' or 'pyarrow' (see read_xyz_typed).
+
+    Yields:
+    ------
+    DataFrame
+        Non empty chunk of points, the columns are labeled with their position 
+        (0: x, 1: y, ...) and use the compact dtypes of the binary store.
+    """
+    
+    for xyzfile in list_xyzfiles(file_path, ext = ext):
+        for chunk in _iter_xyzfile_chunks(xyzfile, polygon, buffer = buffer, chunksize = chunksize, 
+                                          binary_cache = binary_cache, spatial_index = spatial_index,
+                                          columns = columns, engine = engine):
+            if polygon is not None:
+                chunk = chunk.loc[shapely.contains_xy(polygon, chunk.iloc[:,0].values, chunk.iloc[:,1].values)]
+            if len(chunk) > 0:
+                yield chunk
+
+
+def extract_cloudpoints_perpolygon(file_path, geometries, chunksize = 1000000, ext = '.xyz', 
+                                   binary_cache = False, verbose = False):
+    """
+    Extracts the cloud points of many polygons streaming the point cloud only once.
+
+    All the polygons are indexed in a STRtree, and each chunk of points is routed to 
+    every polygon that contains it.
+
+    Parameters:
+    ----------
+    file_path : str
+        Path to the XYZ file or directory containing XYZ files.
+    geometries : gpd.GeoDataFrame, gpd.GeoSeries or list of shapely.geometry.Polygon
+        Spatial boundaries.
+    chunksize : int, optional
+        Number of points read at a time.
+    ext : str, optional
+        File extension of the cloud points file.
+    binary_cache : bool, optional
+        Read the points from the binary store of each file.
+    verbose : bool, optional
+        Show a progress bar over the chunks.
+
+    Returns:
+    -------
+    dict
+        Position of each polygon and a DataFrame with its points. Polygons without
+        points are not included.
+    """
+    
+    if isinstance(geometries, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        geometries = geometries.geometry.values
+    geometries = np.array(list(geometries))
 
-    dfcl = gpd.GeoDataFrame(dfcl, geometry=gpd.points_from_xy(
-                                    dfcl.iloc[:,0], dfcl.iloc[:,1]), crs=crs)
+    tree = shapely.STRtree(geometries)
+    totalbounds = shapely.total_bounds(geometries)
+    perpolygon = {}
+
+    chunks = read_xyz_inchunks(file_path, chunksize = chunksize, ext = ext, binary_cache = binary_cache)
+    if verbose:
+        chunks = tqdm.tqdm(chunks)
+
+    for chunk in chunks:
+        xvalues, yvalues = chunk.iloc[:,0].values, chunk.iloc[:,1].values
+        # skip the points that are outside all polygons before building geometries
+        inside = np.where(np.logical_and(
+            np.logical_and(xvalues >= totalbounds[0], xvalues <= totalbounds[2]),
+            np.logical_and(yvalues >= totalbounds[1], yvalues <= totalbounds[3])))[0]
+        if len(inside) == 0:
+            continue
+
+        pointsidx, polygonsidx = tree.query(shapely.points(xvalues[inside], yvalues[inside]), 
+                                            predicate='within')
+        order = np.argsort(polygonsidx, kind='stable')
+        pointsidx, polygonsidx = inside[pointsidx[order]], polygonsidx[order]
+        polygonids, initpos = np.unique(polygonsidx, return_index=True)
+        
+        for polygonid, rows in zip(polygonids, np.split(pointsidx, initpos[1:])):
+            perpolygon.setdefault(int(polygonid), []).append(chunk.iloc[rows])
+
+    return {polygonid: pd.concat(dfs) for polygonid, dfs in perpolygon.items()}
+
+def knn_interpolation(coords, values, querycoords, knn = 5, weights = "distance", workers = -1):
+    """
+    Interpolates several channels at once using the k nearest neighbours of each query point, 
+    the neighbours are searched only once in a KD-tree.
+
+    Parameters:
+    ----------
+    coords : np.ndarray
+        Points coordinates (N x 2).
+    values : np.ndarray
+        Values to be interpolated (N) or (N x C).
+    querycoords : np.ndarray
+        Coordinates where the values are estimated (Q x 2).
+    knn : int, optional
+        Number of neighbours.
+    weights : str, optional
+        'distance' weights each neighbour by the inverse of its distance, points that 
+        match the query location take all the weight, 'uniform' uses the mean.
+    workers : int, optional
+        Number of workers used for the query, -1 uses all the CPUs.
+
+    Returns:
+    -------
+    np.ndarray
+        Interpolated values (Q) or (Q x C).
+    """
+    if weights not in ["distance", "uniform"]:
+        raise ValueError(f"Unsupported weights: {weights}")
+    
+    values = np.asarray(values)
+    knn = min(knn, len(coords))
+    tree = cKDTree(coords)
+    distances, indices = tree.query(querycoords, k=knn, workers=workers)
+    if knn == 1:
+        distances, indices = distances[:,np.newaxis], indices[:,np.newaxis]
+
+    if weights == "distance":
+        with np.errstate(divide='ignore'):
+            pointsweight = 1. / distances
+        exactmatch = np.isinf(pointsweight)
+        withmatch = exactmatch.any(axis=1)
+        pointsweight[withmatch] = exactmatch[withmatch]
+    else:
+        pointsweight = np.ones(distances.shape)
+    
+    pointsweight /= pointsweight.sum(axis=1, keepdims=True)
+    
+    if values.ndim == 1:
+        return np.einsum('qk,qk->q', pointsweight, values[indices])
+    
+    return np.einsum('qk,qkc->qc', pointsweight, values[indices])
+
+
+def _krige_tile(coordsx, coordsy, values, xvalues, yvalues, variogram_model):
+    """
+    Kriges each channel of a tile using only the points given, it is defined at module 
+    level so it can be sent to the worker processes.
+    """
+    tileimg = []
+    for i in range(values.shape[1]):
+        ok = OrdinaryKriging(coordsx, coordsy, values[:,i],
+                             variogram_model = variogram_model)
+        imgpredicted, _ = ok.execute("grid", xvalues, yvalues)
+        tileimg.append(np.asarray(imgpredicted))
+    
+    return np.stack(tileimg)
+
+
+def _tile_neighbours(tree, tilex, tiley, nneighbours, margin = 0.25):
+    """
+    Indices of the points used to krige a tile. The nearest points of a regular grid of 
+    anchors, which covers the tile extended by a margin (fraction of the tile size), are 
+    merged rank by rank, so the neighbours are spread over the whole tile and its borders 
+    instead of a patch around its centre.
+    """
+    nanchors = int(np.ceil(np.sqrt(nneighbours)))
+    axes = []
+    for tilevalues in (tilex, tiley):
+        vmin, vmax = np.min(tilevalues), np.max(tilevalues)
+        axes.append(np.linspace(vmin - margin * (vmax - vmin), vmax + margin * (vmax - vmin), nanchors))
+    anchors = np.array(np.meshgrid(*axes)).reshape(2, -1).T
+    _, idx = tree.query(anchors, k=nneighbours)
+    # first the nearest point of every anchor, then the second ones, and so on
+    idx = idx.reshape(len(anchors), -1).T.ravel()
+    _, first = np.unique(idx, return_index=True)
+    
+    return idx[np.sort(first)][:nneighbours]
+
+
+def local_kriging_interpolation(coords, values, xvalues, yvalues, nneighbours = 256, tilesize = 64,
+                                variogram_model = 'exponential', njobs = None):
+    """
+    Ordinary kriging computed by tiles, each tile is kriged using only the points spread 
+    over the tile and its borders, so the memory is bounded by the number of neighbours and the cost grows linearly with 
+    the grid size.
+
+    Parameters:
+    ----------
+    coords : np.ndarray
+        Points coordinates (N x 2).
+    values : np.ndarray
+        Values to be interpolated (N) or (N x C).
+    xvalues : np.ndarray
+        Grid coordinates in x.
+    yvalues : np.ndarray
+        Grid coordinates in y.
+    nneighbours : int, optional
+        Number of points used to krige each tile, selected around the whole tile.
+    tilesize : int, optional
+        Tile size in pixels.
+    variogram_model : str, optional
+        linear, exponential, power, hole-effect
+    njobs : int, optional
+        Number of processes, None uses all the CPUs and 1 runs the tiles sequentially.
+
+    Returns:
+    -------
+    np.ndarray
+        Interpolated image with dimensions (len(yvalues) x len(xvalues)) or (C x len(yvalues) x len(xvalues)).
+    """
+    values = np.asarray(values)
+    onechannel = values.ndim == 1
+    values = values.reshape(len(values), -1)
+    nneighbours = min(nneighbours, len(coords))
+    tree = cKDTree(coords)
+    
+    imgpredicted = np.zeros((values.shape[1], len(yvalues), len(xvalues)))
+    tiles, tasks = [], []
+    for i in range(0, len(yvalues), tilesize):
+        for j in range(0, len(xvalues), tilesize):
+            tilex, tiley = xvalues[j:j+tilesize], yvalues[i:i+tilesize]
+            idx = _tile_neighbours(tree, tilex, tiley, nneighbours)
+            tiles.append((slice(i, i+tilesize), slice(j, j+tilesize)))
+            tasks.append((coords[idx,0], coords[idx,1], values[idx], tilex, tiley, variogram_model))
+    
+    if njobs == 1:
+        results = [_krige_tile(*task) for task in tasks]
+    else:
+        with cf.ProcessPoolExecutor(max_workers = njobs) as executor:
+            results = list(executor.map(_krige_tile, *zip(*tasks)))
+    
+    for (rows, cols), tileimg in zip(tiles, results):
+        imgpredicted[:, rows, cols] = tileimg
+    
+    return imgpredicted[0] if onechannel else imgpredicted
 
-    return dfcl.loc[dfcl.within(bb)]
 
 def points_to_raster_interp(points, grid, method = "KNN", 
                             knn = 5, weights = "distance",
-                            variogram_model = 'hole-effect'):
+                            variogram_model = 'hole-effect', workers = -1,
+                            nneighbours = 256, tilesize = 64, njobs = None):
     """
     this function comput a spatial interpolation using 
 
@@ -440,18 +1213,26 @@ def points_to_raster_interp(points, grid, method = "KNN",
     ----------
     points: list
         this a list that contains three list, points in x, points in y and the 
-        values to be interpolated
+        values to be interpolated, for KNN the values can have several channels (N x C)
     grid: list
         a list that contains the meshgrids in x and y.
     method: str, optional
         a string that describes which interpolated method will be used, 
-        currently only KNN and ordinary_kriging are available
+        currently only KNN, ordinary_kriging and local_kriging are available
     variogram_model: str, optional
         linear, exponential, power, hole-effect
+    workers: int, optional
+        number of workers used to query the KD-tree in the KNN interpolation
+    nneighbours: int, optional
+        number of nearest points used to krige each tile in local_kriging
+    tilesize: int, optional
+        tile size in pixels for local_kriging
+    njobs: int, optional
+        number of processes used by local_kriging
     
     Parameters:
     ----------
-    interpolated image
+    interpolated image, with dimensions (C x H x W) when several channels are given
 
     """
     if len(grid) == 2:
@@ -467,12 +1248,13 @@ def points_to_raster_interp(points, grid, method = "KNN",
         raise ValueError("Points is a list that has three lists, one ofr x, y and Zvalues")
 
     if method == "KNN":
-        regressor = KNeighborsRegressor(n_neighbors = knn, weights = weights)
-        regressor.fit(list(zip(coordsx,coordsy)), values)
-            ## prediction
-        imgpredicted = regressor.predict(
-            np.array((xx.ravel(),yy.ravel())).T).reshape(
-                xx.shape)
+        imgpredicted = knn_interpolation(np.column_stack((coordsx,coordsy)), values,
+                                         np.column_stack((xx.ravel(),yy.ravel())),
+                                         knn = knn, weights = weights, workers = workers)
+        if imgpredicted.ndim == 1:
+            imgpredicted = imgpredicted.reshape(xx.shape)
+        else:
+            imgpredicted = np.moveaxis(imgpredicted, 1, 0).reshape((imgpredicted.shape[1],) + xx.shape)
                 
     #https://mmaelicke.github.io/scikit-gstat/_modules/skgstat/Kriging.html
     if method == "ordinary_kriging":
@@ -483,15 +1265,39 @@ def points_to_raster_interp(points, grid, method = "KNN",
             variogram_model = variogram_model,
         )
         ## prediction
+        # the grid is returned as (y x x), the same layout as the meshgrids
         imgpredicted, _ = ok.execute("grid", 
                 np.unique(xx.ravel()),np.unique(yy.ravel()))
         del ok
-        imgpredicted = imgpredicted.swapaxes(0,1)
+        imgpredicted = np.asarray(imgpredicted)
+    
+    if method == "local_kriging":
+        imgpredicted = local_kriging_interpolation(np.column_stack((coordsx,coordsy)), values,
+                                                   np.unique(xx.ravel()),np.unique(yy.ravel()),
+                                                   nneighbours = nneighbours, tilesize = tilesize,
+                                                   variogram_model = variogram_model, njobs = njobs)
 
     return imgpredicted
 
 
-def points_rasterinterpolated(points, transform, rastershape, inter_method = 'KNN', **kargs):
+def raster_meshgrid(transform, rastershape):
+    """Create the x and y meshgrids of the raster pixels.
+
+    Args:
+        transform (Affine): raster transformation matrix 
+        rastershape (list): image size (Height x Width)
+
+    Returns:
+        tuple: meshgrids in x and y
+    """
+    from drone_data.utils.gis_functions import affine_coordinates
+    xvalues, yvalues = affine_coordinates(transform, [rastershape[0], rastershape[1]],
+                                          offset = 0, ascending = True)
+
+    return np.meshgrid(xvalues, yvalues)
+
+
+def points_rasterinterpolated(points, transform, rastershape, inter_method = 'KNN', grid = None, **kargs):
     """_summary_
 
     Args:
@@ -499,19 +1305,17 @@ def points_rasterinterpolated(points, transform, rastershape, inter_method = 'KN
         transform (Affine): raster transformation matrix 
         rastershape (list): image size (Height x Width)
         inter_method (str, optional): _description_. Defaults to 'KNN'.
+        grid (tuple, optional): precomputed meshgrids from raster_meshgrid. Defaults to None.
 
     Returns:
         numpy array: interpolated image
     """
-    from drone_data.utils.gis_functions import coordinates_fromtransform
-    rows, columns = coordinates_fromtransform(transform,
-                        [rastershape[0], rastershape[1]])
-
-    yy,xx = np.meshgrid(np.sort(np.unique(columns)), np.sort(np.unique(rows)))
+    if grid is None:
+        grid = raster_meshgrid(transform, rastershape)
     
     rastinterp = points_to_raster_interp(
                         points,
-                        (yy,xx), method = inter_method, **kargs)
+                        grid, method = inter_method, **kargs)
 
     return rastinterp
                 
@@ -547,7 +1351,14 @@ class CloudPoints:
                     crs: int = 32654,
                     variables: List[str] = ["z", "red","green", "blue"],
                     verbose: bool = False,
-                    ext: str = '.xyz'):
+                    ext: str = '.xyz',
+                    binary_cache: bool = False,
+                    spatial_index: bool = False,
+                    cloud_points: Optional[List[pd.DataFrame]] = None,
+                    parallel: Optional[str] = None,
+                    nworkers: Optional[int] = None,
+                    lazy: bool = False,
+                    columns: Optional[List[str]] = None):
 
             """
             Initialize the CloudPoints class with given parameters.
@@ -570,6 +1381,27 @@ class CloudPoints:
                 Enables verbose output.
             ext : str, optional
                 File extension for the XYZ files.
+            binary_cache : bool, optional
+                Convert each XYZ file into a memory-mapped binary store (only the first time) 
+                and read the points from it.
+            spatial_index : bool, optional
+                Read only the points of the binary store tiles that intersect the polygon. 
+                Use it when the XYZ files are not sorted by x.
+            cloud_points : List[pd.DataFrame], optional
+                Points already extracted for this polygon (e.g. with extract_cloudpoints_perpolygon), 
+                one table per XYZ file. If given, the XYZ files are not read.
+            parallel : str, optional
+                Read the XYZ files concurrently, 'process' uses a process pool (text files) 
+                and 'thread' a thread pool (suited for files in the binary store). 
+                None reads them sequentially.
+            nworkers : int, optional
+                Number of workers for the parallel reading, None uses the executor default.
+            lazy : bool, optional
+                Do not read the points when the object is created, they are read the first 
+                time cloud_points is accessed. Use it with iter_chunks to process large areas.
+            columns : List[str], optional
+                Columns read from the XYZ files, e.g. ['z'] when the colors are not needed 
+                (x and y are always read), variables must match them. Defaults to all the columns.
 
             Returns:
             -------
@@ -595,28 +1427,78 @@ class CloudPoints:
             self.spatial_res = spatial_res
             self.verbose = verbose
             self._xyz_file_suffix = ext
-            self._cloud_point()
+            self.binary_cache = binary_cache
+            self.spatial_index = spatial_index
+            if parallel not in [None, 'process', 'thread']:
+                raise ValueError(f"Unsupported parallel mode: {parallel}")
+            self.parallel = parallel
+            self.nworkers = nworkers
+            self.loading_times = {}
+            self.columns = columns
+            self._point_cloud = cloud_points
+            if cloud_points is None and not lazy:
+                self._cloud_point()
         
     
     @property
     def cloud_points(self):
+        if self._point_cloud is None:
+            self._cloud_point()
         return self._point_cloud
 
-    def _cloud_point(self):
-        cllist = []
+    def iter_chunks(self, chunksize: int = 1000000, clip: bool = True):
+        """
+        Iterates over the points of all the XYZ files in chunks without keeping them in memory.
 
-        for i in range(len(self.xyzfile)):
-            if self.verbose:
-                print(self.xyzfile[i])
+        Parameters:
+        ----------
+        chunksize : int, optional
+            Maximum number of points per chunk.
+        clip : bool, optional
+            Return only the points inside the polygon, if False all the points of the files are returned.
 
-            gdf =  clip_cloudpoints_as_gpd(self.xyzfile[i],self.geometry, 
-                                            crs=self._crs,
-                                            buffer = self.buffer,
-                                            sp_res = self.spatial_res)
+        Yields:
+        ------
+        pd.DataFrame
+            Chunk of points with the compact dtypes of the binary store.
+        """
+        for xyzfile in self.xyzfile:
+            yield from iter_cloudpoints(xyzfile, self.geometry if clip else None, 
+                                        buffer = self.buffer, chunksize = chunksize, 
+                                        ext = self._xyz_file_suffix, 
+                                        binary_cache = self.binary_cache, 
+                                        spatial_index = self.spatial_index,
+                                        columns = self.columns)
 
-            cllist.append(gdf)
-            
-        self._point_cloud =  cllist   
+    def _cloud_point(self):
+        readargs = dict(crs=self._crs,
+                        buffer = self.buffer,
+                        sp_res = self.spatial_res,
+                        ext = self._xyz_file_suffix,
+                        binary_cache = self.binary_cache,
+                        spatial_index = self.spatial_index,
+                        columns = self.columns)
+        
+        if self.parallel is None:
+            results = []
+            for xyzfile in self.xyzfile:
+                if self.verbose:
+                    print(xyzfile)
+                results.append(_clip_cloudpoints_timed(xyzfile, self.geometry, **readargs))
+        else:
+            poolexecutor = cf.ProcessPoolExecutor if self.parallel == 'process' else cf.ThreadPoolExecutor
+            with poolexecutor(max_workers=self.nworkers) as executor:
+                # futures are kept in submission order so the clouds follow the files order
+                futures = [executor.submit(_clip_cloudpoints_timed, xyzfile, self.geometry, **readargs) 
+                           for xyzfile in self.xyzfile]
+                results = [future.result() for future in futures]
+        
+        self.loading_times = {xyzfile: elapsed for xyzfile, (_, elapsed) in zip(self.xyzfile, results)}
+        if self.verbose:
+            for xyzfile, elapsed in self.loading_times.items():
+                print(f"{xyzfile}: {elapsed:.2f} s")
+        
+        self._point_cloud =  [dfcl for dfcl, _ in results]
 
 
     def to_xarray(self, sp_res: float = 0.01, newdim_values = None, 
@@ -635,7 +1517,7 @@ class CloudPoints:
         interpolate : bool, optional
             Whether to apply spatial interpolation to create the raster.
         inter_method : str, optional
-            Interpolation method to use ('KNN' or 'ordinary_kriging').
+            Interpolation method to use ('KNN', 'ordinary_kriging' or 'local_kriging').
 
         Returns:
         -------
@@ -648,7 +1530,7 @@ class CloudPoints:
             If an unsupported interpolation method is provided.
         """
         
-        if interpolate and inter_method not in ["KNN", "ordinary_kriging"]:
+        if interpolate and inter_method not in ["KNN", "ordinary_kriging", "local_kriging"]:
             raise ValueError(f"Unsupported interpolation method: {inter_method}")
 
         self.twod_image = from_cloudpoints_to_xarray(self.cloud_points,
@@ -701,6 +1583,33 @@ class CloudPoints:
 
                 self.cloud_points[i] = adjusted_data
 
+    def voxel_downsample(self, voxel_size: float = 0.01, reducer: str = 'mean', 
+                         zsize: Optional[float] = None):
+        """
+        Downsamples the cloud points to one point per voxel, so the rasterization and 
+        interpolation run over fewer points. The voxels are anchored to the origin of the 
+        raster built by to_xarray, with voxel_size equal to its sp_res each voxel falls in 
+        a single pixel.
+
+        Parameters:
+        ----------
+        voxel_size : float, optional
+            Voxel size in x and y, the same default as the to_xarray sp_res.
+        reducer : str, optional
+            'mean', 'max_z' (highest point of the voxel) or 'median'.
+        zsize : float, optional
+            Voxel size in z, if None a 2D grid is used.
+
+        Returns:
+        -------
+        None
+        """
+        # same grid as from_cloudpoints_to_xarray
+        transform, _ = transform_frombb(self.geometry.bounds, voxel_size)
+        for i, data in enumerate(self.cloud_points):
+            self.cloud_points[i] = voxel_downsample(data, voxel_size, reducer = reducer, zsize = zsize,
+                                                    origin = (transform.c, transform.f))
+
     def plot_2d_cloudpoints(self, index = 0, figsize = (10,6), xaxis = "latitude",fontsize = 12):
         return plot_2d_cloudpoints(self.cloud_points[index], figsize, xaxis,fontsize=fontsize)
 
@@ -726,25 +1635,3 @@ class CloudPoints:
         adjusted_data.iloc[:, 2] = (adjusted_data.iloc[:,2].values-baseline)*scale_height
         return adjusted_data
 
-
-
-"""
-        if self.multiprocess:
-            #print("Multiprocess initialization")
-            cloud_thread = []
-            with cf.ProcessPoolExecutor(max_workers=self.nworkers) as executor:
-                for i in range(len(self.xyzfile)):
-                    cloud_thread.append({executor.submit(clip_cloudpoints_as_gpd,self.xyzfile[i], 
-                                            self.geometry,
-                                            self._crs,
-                                            self.buffer,
-                                            self.step): i})
-
-            cllist = []
-            for future in cloud_thread:
-                for i in cf.as_completed(future):
-                    cllist.append(i.result())
- 
-           
-        else:
-"""
\ No newline at end of file
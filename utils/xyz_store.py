@@ -0,0 +1,642 @@
+import importlib.util
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from typing import Dict, List, Optional
+
+XYZSTORE_SUFFIX = '_xyzstore'
+XYZSTORE_VERSION = 1
+TILE_SIZE = 1.0
+
+# columns of a Pix4D point cloud and the compact dtype used to store each one
+XYZSTORE_COLUMNS = ['x', 'y', 'z', 'red', 'green', 'blue']
+XYZSTORE_DTYPES = {'x': 'float64',
+                   'y': 'float64',
+                   'z': 'float32',
+                   'red': 'uint8',
+                   'green': 'uint8',
+                   'blue': 'uint8'}
+# approximated length in bytes of a Pix4D XYZ line, used to size the pyarrow blocks
+XYZ_LINE_BYTES = 48
+
+
+def get_xyzstore_path(file_path: str) -> str:
+    """
+    Returns the directory used to cache the binary version of an XYZ file.
+
+    Parameters:
+    ----------
+    file_path : str
+        Path to the XYZ file.
+
+    Returns:
+    -------
+    str
+        Path to the binary store directory.
+    """
+    return os.path.splitext(file_path)[0] + XYZSTORE_SUFFIX
+
+
+def xyz_projection(columns: Optional[List[str]] = None) -> List[str]:
+    """
+    Returns the columns to read from an XYZ file, x and y are always included 
+    because they are needed to locate the points.
+
+    Parameters:
+    ----------
+    columns : list of str, optional
+        Columns required, a subset of XYZSTORE_COLUMNS. Defaults to all columns.
+
+    Returns:
+    -------
+    list of str
+        Columns in the file order.
+    """
+    if columns is None:
+        return list(XYZSTORE_COLUMNS)
+
+    unknown = [col for col in columns if col not in XYZSTORE_COLUMNS]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown XYZ columns: {unknown}, the available ones are {XYZSTORE_COLUMNS}")
+
+    return [col for col in XYZSTORE_COLUMNS if col in ['x', 'y'] or col in columns]
+
+
+def _arrow_todataframe(batch, coltypes: dict) -> pd.DataFrame:
+    """
+    Converts a pyarrow table or record batch to a DataFrame labeled with the columns position.
+    """
+    dfbatch = batch.to_pandas()
+    return dfbatch.rename(columns = {'f{}'.format(i): i for i in coltypes})
+
+
+def _read_xyz_pyarrow(source, coltypes: dict, chunksize: Optional[int] = None):
+    """
+    Parses an XYZ file with the pyarrow CSV reader.
+    """
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pacsv
+    except ImportError as err:
+        raise ImportError("The pyarrow engine requires pyarrow, install it or use engine = 'c'") from err
+
+    parse_options = pacsv.ParseOptions(delimiter = ' ')
+    convert_options = pacsv.ConvertOptions(
+        column_types = {'f{}'.format(i): pa.from_numpy_dtype(np.dtype(dtype)) for i, dtype in coltypes.items()},
+        include_columns = ['f{}'.format(i) for i in coltypes])
+
+    if chunksize is None:
+        table = pacsv.read_csv(source, read_options = pacsv.ReadOptions(autogenerate_column_names = True),
+                               parse_options = parse_options, convert_options = convert_options)
+        return _arrow_todataframe(table, coltypes)
+
+    # pyarrow batches are sized in bytes, the number of rows per chunk is approximated
+    read_options = pacsv.ReadOptions(autogenerate_column_names = True,
+                                     block_size = chunksize * XYZ_LINE_BYTES)
+    reader = pacsv.open_csv(source, read_options = read_options,
+                            parse_options = parse_options, convert_options = convert_options)
+
+    return (_arrow_todataframe(batch, coltypes) for batch in reader)
+
+
+def read_xyz_typed(source, columns: Optional[List[str]] = None, chunksize: Optional[int] = None,
+                   dtypes: Optional[Dict[str, str]] = None, engine: str = 'c'):
+    """
+    Parses a space separated Pix4D XYZ file with explicit dtypes, so pandas does not
+    have to infer them and the colors are kept as uint8.
+
+    Parameters:
+    ----------
+    source : str or file
+        Path to the XYZ file or a file object opened in binary mode (e.g. placed at a byte offset).
+    columns : list of str, optional
+        Columns to read, x and y are always read. Defaults to all columns.
+    chunksize : int, optional
+        Number of rows per chunk, if None the whole file is read.
+    dtypes : dict, optional
+        Dtypes that replace the XYZSTORE_DTYPES defaults, e.g. {'z': 'float64'}.
+    engine : str, optional
+        'c' for the pandas C parser, 'pyarrow' for the pyarrow CSV reader (the chunks
+        size is approximated) or 'auto' to use pyarrow when it is installed.
+
+    Returns:
+    -------
+    pd.DataFrame or iterator of pd.DataFrame
+        Points with the columns labeled with their position (0: x, 1: y, ...).
+    """
+
+    dtypes = {**XYZSTORE_DTYPES, **(dtypes or {})}
+    coltypes = {XYZSTORE_COLUMNS.index(col): dtypes[col] for col in xyz_projection(columns)}
+
+    if engine == 'auto':
+        engine = 'pyarrow' if importlib.util.find_spec('pyarrow') is not None else 'c'
+    if engine == 'pyarrow':
+        return _read_xyz_pyarrow(source, coltypes, chunksize = chunksize)
+    if engine != 'c':
+        raise ValueError(f"Unsupported engine: {engine}")
+
+    return pd.read_csv(source, header = None, sep = " ", engine = 'c',
+                       usecols = list(coltypes), dtype = coltypes, chunksize = chunksize)
+
+
+def _searchsorted_sparse(values, sparseindex, stride, value, side = 'left'):
+    """
+    Binary search over a sorted array using a sparse index first, so only one
+    block of the (memory-mapped) array has to be touched.
+    """
+
+    block = int(np.searchsorted(sparseindex, value, side=side))
+    init = max(block - 1, 0) * stride
+    end = min(block * stride + 1, len(values))
+
+    return init + int(np.searchsorted(values[init:end], value, side=side))
+
+
+def xyz_to_binarystore(file_path: str, store_path: Optional[str] = None,
+                       chunksize: int = 1000000, index_stride: int = 4096,
+                       overwrite: bool = False, engine: str = 'c') -> str:
+    """
+    Converts a Pix4D XYZ text file into a columnar binary store sorted on x.
+
+    Each column is saved as a memory-mappable .npy file using a compact dtype
+    (see XYZSTORE_DTYPES), and a sparse sidecar index with every `index_stride`-th
+    x value is written to speed up the binary search of bounding box queries.
+
+    Parameters:
+    ----------
+    file_path : str
+        Path to the XYZ file.
+    store_path : str, optional
+        Output directory. Defaults to the XYZ file name with the '_xyzstore' suffix.
+    chunksize : int, optional
+        Number of rows parsed at a time from the text file.
+    index_stride : int, optional
+        Distance in rows between the values kept in the sparse x index.
+    overwrite : bool, optional
+        Rebuild the store even if it already exists.
+    engine : str, optional
+        Parser used for the text file, see read_xyz_typed.
+
+    Returns:
+    -------
+    str
+        Path to the binary store directory.
+    """
+
+    store_path = store_path or get_xyzstore_path(file_path)
+    if os.path.exists(os.path.join(store_path, 'metadata.json')) and not overwrite:
+        return store_path
+
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+
+    # first pass: parse the text once and append each column to a raw file
+    rawpaths = {col: os.path.join(store_path, '{}.raw'.format(col)) for col in XYZSTORE_COLUMNS}
+    rawfiles = {col: open(rawpaths[col], 'wb') for col in XYZSTORE_COLUMNS}
+    npoints = 0
+    try:
+        chunks = read_xyz_typed(file_path, chunksize = chunksize, engine = engine)
+        for chunk in chunks:
+            for i, col in enumerate(XYZSTORE_COLUMNS):
+                rawfiles[col].write(
+                    chunk[i].values.astype(XYZSTORE_DTYPES[col], copy = False).tobytes())
+            npoints += len(chunk)
+    finally:
+        for fn in rawfiles.values():
+            fn.close()
+
+    if npoints == 0:
+        raise ValueError('There are no points in {}'.format(file_path))
+
+    # second pass: sort every column on x, writing it block by block
+    xraw = np.memmap(rawpaths['x'], dtype=XYZSTORE_DTYPES['x'], mode='r', shape=(npoints,))
+    order = np.argsort(xraw, kind='stable')
+    del xraw
+
+    for col in XYZSTORE_COLUMNS:
+        rawcol = np.memmap(rawpaths[col], dtype=XYZSTORE_DTYPES[col], mode='r', shape=(npoints,))
+        sortedcol = np.lib.format.open_memmap(os.path.join(store_path, '{}.npy'.format(col)),
+                                              mode='w+', dtype=XYZSTORE_DTYPES[col], shape=(npoints,))
+        for i in range(0, npoints, chunksize):
+            sortedcol[i:i+chunksize] = rawcol[order[i:i+chunksize]]
+        sortedcol.flush()
+        del rawcol, sortedcol
+        os.remove(rawpaths[col])
+    del order
+
+    xsorted = np.load(os.path.join(store_path, 'x.npy'), mmap_mode='r')
+    ysorted = np.load(os.path.join(store_path, 'y.npy'), mmap_mode='r')
+    np.save(os.path.join(store_path, 'xindex.npy'), np.array(xsorted[::index_stride]))
+
+    metadata = {
+        'version': XYZSTORE_VERSION,
+        'source': os.path.abspath(file_path),
+        'source_size': os.path.getsize(file_path),
+        'source_mtime': os.path.getmtime(file_path),
+        'count': int(npoints),
+        'columns': XYZSTORE_COLUMNS,
+        'dtypes': XYZSTORE_DTYPES,
+        'index_stride': index_stride,
+        'bounds': [float(xsorted[0]), float(np.min(ysorted)),
+                   float(xsorted[-1]), float(np.max(ysorted))]
+        }
+    del xsorted, ysorted
+
+    with open(os.path.join(store_path, 'metadata.json'), 'w') as fn:
+        json.dump(metadata, fn, indent=4)
+
+    return store_path
+
+
+def build_tile_index(store_path: str, tile_size: float = TILE_SIZE,
+                     chunksize: int = 1000000, overwrite: bool = False) -> dict:
+    """
+    Creates a persistent grid index over the points of a binary store.
+
+    The bounding box of the point cloud is split into square tiles of `tile_size`, and the
+    row numbers of the points are saved grouped by tile, so a query only has to read the points
+    of the tiles that intersect it whatever the order of the original file.
+
+    Parameters:
+    ----------
+    store_path : str
+        Directory of the binary store.
+    tile_size : float, optional
+        Tile side in the units of the point cloud coordinates system.
+    chunksize : int, optional
+        Number of points processed at a time.
+    overwrite : bool, optional
+        Rebuild the index even if it already exists. An index with a different tile size 
+        is always rebuilt.
+
+    Returns:
+    -------
+    dict
+        Grid definition (origin, tile size and number of tiles in x and y).
+    """
+
+    with open(os.path.join(store_path, 'metadata.json'), 'r') as fn:
+        metadata = json.load(fn)
+
+    if ('tile_index' in metadata and not overwrite and 
+            metadata['tile_index']['tile_size'] == tile_size):
+        return metadata['tile_index']
+
+    npoints = metadata['count']
+    xmin, ymin, xmax, ymax = metadata['bounds']
+    ncols = int(np.floor((xmax - xmin) / tile_size)) + 1
+    nrows = int(np.floor((ymax - ymin) / tile_size)) + 1
+    if ncols * nrows >= np.iinfo(np.int32).max:
+        raise ValueError('tile_size {} is too small for this point cloud'.format(tile_size))
+
+    xvalues = np.load(os.path.join(store_path, 'x.npy'), mmap_mode='r')
+    yvalues = np.load(os.path.join(store_path, 'y.npy'), mmap_mode='r')
+    tileids = np.empty(npoints, dtype=np.int32)
+    for i in range(0, npoints, chunksize):
+        cols = ((xvalues[i:i+chunksize] - xmin) // tile_size).astype(np.int32)
+        rows = ((yvalues[i:i+chunksize] - ymin) // tile_size).astype(np.int32)
+        tileids[i:i+chunksize] = rows * ncols + cols
+    del xvalues, yvalues
+
+    # stable sort keeps the points of each tile ordered by x
+    order = np.argsort(tileids, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(tileids, minlength=ncols * nrows))])
+    del tileids
+
+    orderdtype = np.uint32 if npoints < np.iinfo(np.uint32).max else np.int64
+    # the files are replaced, not overwritten, so open memory maps of a previous index stay valid
+    for name, values in [('tileorder', order.astype(orderdtype)), ('tileoffsets', offsets.astype(np.int64))]:
+        np.save(os.path.join(store_path, name + '.tmp.npy'), values)
+        os.replace(os.path.join(store_path, name + '.tmp.npy'), os.path.join(store_path, name + '.npy'))
+    del order
+
+    metadata['tile_index'] = {'origin': [xmin, ymin],
+                              'tile_size': tile_size,
+                              'shape': [nrows, ncols]}
+
+    with open(os.path.join(store_path, 'metadata.json'), 'w') as fn:
+        json.dump(metadata, fn, indent=4)
+
+    return metadata['tile_index']
+
+
+class XYZStore:
+    """
+    A class to query a point cloud saved as a columnar binary store (see xyz_to_binarystore).
+
+    The columns are memory mapped, so opening a store is cheap and bounding box queries
+    only read the rows that fall inside the x range of the box.
+
+    Attributes
+    ----------
+    path : str
+        Directory of the binary store.
+    metadata : dict
+        Number of points, dtypes, spatial bounds and source file information.
+    """
+
+    def __init__(self, path: str):
+        """
+        Initialize the XYZStore class.
+
+        Parameters:
+        ----------
+        path : str
+            Directory of the binary store.
+        """
+
+        if not os.path.exists(os.path.join(path, 'metadata.json')):
+            raise FileNotFoundError(f"There is no binary store at {path}")
+
+        self.path = path
+        with open(os.path.join(path, 'metadata.json'), 'r') as fn:
+            self.metadata = json.load(fn)
+
+        self._columns = {}
+        self._xindex = np.load(os.path.join(path, 'xindex.npy'))
+        self._tileorder = None
+        self._tileoffsets = None
+
+    def __len__(self):
+        return self.metadata['count']
+
+    @property
+    def bounds(self) -> List[float]:
+        return self.metadata['bounds']
+
+    @property
+    def columns_names(self) -> List[str]:
+        return self.metadata['columns']
+
+    def is_outdated(self, file_path: Optional[str] = None) -> bool:
+        """
+        Checks whether the source XYZ file changed after the store was created.
+        """
+        file_path = file_path or self.metadata['source']
+        if not os.path.exists(file_path):
+            return False
+
+        return (os.path.getsize(file_path) != self.metadata['source_size'] or
+                os.path.getmtime(file_path) != self.metadata['source_mtime'])
+
+    def column(self, name: str) -> np.memmap:
+        """
+        Returns a column as a read-only memory-mapped array.
+        """
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.path, '{}.npy'.format(name)),
+                                          mmap_mode='r')
+        return self._columns[name]
+
+    def xrange_slice(self, xmin: float, xmax: float) -> slice:
+        """
+        Finds the rows whose x values are between xmin and xmax using a binary search.
+
+        Parameters:
+        ----------
+        xmin : float
+            Minimum x value.
+        xmax : float
+            Maximum x value.
+
+        Returns:
+        -------
+        slice
+            Rows slice, it can be used directly on any column without copying data.
+        """
+
+        xvalues = self.column('x')
+        stride = self.metadata['index_stride']
+        init = _searchsorted_sparse(xvalues, self._xindex, stride, xmin, side='left')
+        end = _searchsorted_sparse(xvalues, self._xindex, stride, xmax, side='right')
+
+        return slice(init, max(init, end))
+
+    def read_columns(self, rows = None, columns: Optional[List[str]] = None) -> Dict[str, np.ndarray]:
+        """
+        Reads a set of rows from the store.
+
+        Parameters:
+        ----------
+        rows : slice or array, optional
+            Rows to read. A slice returns memory-mapped views; boolean or integer arrays return copies.
+        columns : list of str, optional
+            Columns to read. Defaults to all columns.
+
+        Returns:
+        -------
+        dict
+            Column name and values.
+        """
+        columns = columns or self.columns_names
+        rows = slice(None) if rows is None else rows
+
+        return {col: self.column(col)[rows] for col in columns}
+
+    def query_bounds(self, bb: tuple, buffer: float = 0.0,
+                     columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Reads the points inside a bounding box.
+
+        Parameters:
+        ----------
+        bb : tuple
+            Spatial bounding box (min_x, min_y, max_x, max_y).
+        buffer : float, optional
+            Buffer distance around the bounding box.
+        columns : list of str, optional
+            Columns to read. Defaults to all columns.
+
+        Returns:
+        -------
+        pd.DataFrame
+            Points inside the box, the columns are labeled with their position (0: x, 1: y, ...)
+            as the tables read from the XYZ text files.
+        """
+
+        columns = columns or self.columns_names
+        slc = self.xrange_slice(bb[0] - buffer, bb[2] + buffer)
+        yvalues = self.column('y')[slc]
+        mask = np.logical_and(yvalues > (bb[1]-buffer), yvalues < (bb[3]+buffer))
+        xvalues = self.column('x')[slc]
+        mask = np.logical_and(mask, np.logical_and(xvalues > (bb[0]-buffer), xvalues < (bb[2]+buffer)))
+
+        return pd.DataFrame({self.columns_names.index(col): self.column(col)[slc][mask]
+                             for col in columns})
+
+    def tile_index(self, tile_size: Optional[float] = None) -> dict:
+        """
+        Returns the grid tile index definition, it is created the first time it is requested.
+        When tile_size differs from the one of the existing index, the index is rebuilt.
+        """
+        current = self.metadata.get('tile_index')
+        if current is None or (tile_size is not None and current['tile_size'] != tile_size):
+            tile_size = TILE_SIZE if tile_size is None else tile_size
+            self.metadata['tile_index'] = build_tile_index(self.path, tile_size=tile_size)
+            self._tileorder = None
+
+        if self._tileorder is None:
+            self._tileorder = np.load(os.path.join(self.path, 'tileorder.npy'), mmap_mode='r')
+            self._tileoffsets = np.load(os.path.join(self.path, 'tileoffsets.npy'))
+
+        return self.metadata['tile_index']
+
+    def tiles_intersecting(self, geometry) -> np.ndarray:
+        """
+        Finds the identifiers of the tiles that intersect a geometry.
+
+        Parameters:
+        ----------
+        geometry : shapely.geometry
+            Query geometry.
+
+        Returns:
+        -------
+        np.ndarray
+            Tile identifiers (row * ncols + col).
+        """
+
+        grid = self.tile_index()
+        (xorig, yorig), tile_size, (nrows, ncols) = grid['origin'], grid['tile_size'], grid['shape']
+        minx, miny, maxx, maxy = geometry.bounds
+        cols = np.arange(max(int((minx - xorig) // tile_size), 0),
+                         min(int((maxx - xorig) // tile_size), ncols - 1) + 1)
+        rows = np.arange(max(int((miny - yorig) // tile_size), 0),
+                         min(int((maxy - yorig) // tile_size), nrows - 1) + 1)
+        if len(cols) == 0 or len(rows) == 0:
+            return np.array([], dtype=np.int64)
+
+        rows, cols = [i.ravel() for i in np.meshgrid(rows, cols, indexing='ij')]
+        boxes = shapely.box(xorig + cols * tile_size, yorig + rows * tile_size,
+                            xorig + (cols + 1) * tile_size, yorig + (rows + 1) * tile_size)
+
+        return (rows * ncols + cols)[shapely.intersects(boxes, geometry)]
+
+    def tile_rows(self, geometry) -> np.ndarray:
+        """
+        Finds the rows of the points located in the tiles that intersect a geometry.
+
+        Parameters:
+        ----------
+        geometry : shapely.geometry
+            Query geometry.
+
+        Returns:
+        -------
+        np.ndarray
+            Rows in ascending order, the points still have to be tested against the geometry.
+        """
+
+        tiles = self.tiles_intersecting(geometry)
+        rows = np.concatenate([np.array([], dtype=np.int64)] + [
+            self._tileorder[self._tileoffsets[t]:self._tileoffsets[t+1]] for t in tiles])
+        # reading the memmaps in ascending order keeps the access close to sequential
+        return np.sort(rows)
+
+    def iter_tile_rows(self, geometry, chunksize: int = 1000000):
+        """
+        Generator version of tile_rows, the rows are yielded in groups of at most chunksize
+        taken from consecutive tiles, so the whole set of rows is never built.
+
+        Parameters:
+        ----------
+        geometry : shapely.geometry
+            Query geometry.
+        chunksize : int, optional
+            Maximum number of rows per group.
+
+        Yields:
+        ------
+        np.ndarray
+            Rows of the group in ascending order, the points still have to be tested 
+            against the geometry.
+        """
+
+        tiles = np.sort(self.tiles_intersecting(geometry))
+        pending, npending = [], 0
+        # the rows of consecutive tiles are contiguous in the tile order
+        for run in np.split(tiles, np.flatnonzero(np.diff(tiles) != 1) + 1):
+            if len(run) == 0:
+                continue
+            start, stop = self._tileoffsets[run[0]], self._tileoffsets[run[-1] + 1]
+            while start < stop:
+                end = min(stop, start + chunksize - npending)
+                pending.append(self._tileorder[start:end])
+                npending += end - start
+                start = end
+                if npending == chunksize:
+                    yield np.sort(np.concatenate(pending))
+                    pending, npending = [], 0
+
+        if npending > 0:
+            yield np.sort(np.concatenate(pending))
+
+    def query_polygon(self, geometry, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Reads the points inside a polygon using the tile index.
+
+        Only the points of the tiles that intersect the polygon are read, then each point
+        is tested against the polygon.
+
+        Parameters:
+        ----------
+        geometry : shapely.geometry.Polygon
+            Query polygon.
+        columns : list of str, optional
+            Columns to read. Defaults to all columns.
+
+        Returns:
+        -------
+        pd.DataFrame
+            Points inside the polygon, the columns are labeled with their position (0: x, 1: y, ...).
+        """
+
+        columns = columns or self.columns_names
+        rows = self.tile_rows(geometry)
+
+        xvalues, yvalues = self.column('x')[rows], self.column('y')[rows]
+        mask = shapely.contains_xy(geometry, xvalues, yvalues)
+        rows = rows[mask]
+
+        return pd.DataFrame({self.columns_names.index(col): self.column(col)[rows]
+                             for col in columns})
+
+
+def get_xyzstore(file_path: str, create: bool = True, **kwargs) -> XYZStore:
+    """
+    Opens the binary store of an XYZ file, creating (or refreshing) it when needed.
+
+    Parameters:
+    ----------
+    file_path : str
+        Path to the XYZ file or to an existing binary store directory.
+    create : bool, optional
+        Create the store if it does not exist or if the XYZ file changed.
+    **kwargs :
+        Additional arguments passed to xyz_to_binarystore.
+
+    Returns:
+    -------
+    XYZStore
+        The point cloud binary store.
+    """
+
+    if os.path.isdir(file_path):
+        return XYZStore(file_path)
+
+    store_path = kwargs.pop('store_path', None) or get_xyzstore_path(file_path)
+    exists = os.path.exists(os.path.join(store_path, 'metadata.json'))
+
+    if exists and not XYZStore(store_path).is_outdated(file_path):
+        return XYZStore(store_path)
+
+    if not create:
+        raise FileNotFoundError(f"There is no binary store for {file_path}")
+
+    xyz_to_binarystore(file_path, store_path=store_path, overwrite=exists, **kwargs)
+
+    return XYZStore(store_path)